@@ -0,0 +1,411 @@
+# Modules importation
+import sys
+import time
+import json
+import argparse
+import statistics
+import math
+import logging
+import datetime
+import os
+import platform
+import threading
+import tempfile
+import random
+import functools
+from lxml import etree
+from Stub_Servers import StubTisseoServer, StubMeteoClient, StubTuyaDevice, write_stub_gtfs
+from DB_Treads import DB_Tread, parse_departures, CHUNK_SIZE
+from History import Departure_History
+from METEO_Treads import METEO_Tread
+from Storage import Departure_Store, SQLite_Backend
+from Dispatcher import Event_Dispatcher
+from Scheduler import Tick_Scheduler, Timer_Scheduler
+from Timetable import Timetable, build_index
+
+# The benchmarks run on the emulated lcd, I2C bus and GPIO, never on the real hardware
+os.environ["TISSEO_HARDWARE"] = "emulator"
+import hw_emulator
+from HI_Treads import LCDscreen, Led, Button_Retreiver, GPIO_device, TuyaBulb_device, SCREEN_PAGES
+
+# Logger Init
+logger = logging.getLogger()
+
+# Samples needed before a 90th percentile is reported
+PERCENTILE_MIN_SAMPLES = 10
+
+
+def measure(function, repeat=5, warmup=1):
+    """Calls function warmup + repeat times and returns the median and max duration of the measured calls in seconds"""
+    for _ in range(warmup):
+        function()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return {'median': statistics.median(durations), 'max': max(durations)}
+
+
+def summarize(durations):
+    """Returns the median, 90th percentile (None under PERCENTILE_MIN_SAMPLES samples) and max of durations in seconds"""
+    durations = sorted(durations)
+    if not durations:
+        return {'median': None, 'p90': None, 'max': None}
+    # Nearest-rank percentile : the smallest duration with at least 90 % of the samples at or below it
+    p90 = durations[math.ceil(0.9 * len(durations)) - 1] if len(durations) >= PERCENTILE_MIN_SAMPLES else None
+    return {'median': statistics.median(durations), 'p90': p90, 'max': durations[-1]}
+
+
+def build_stack(stops=3, latency=0.0):
+    """Builds the Screen_Test display stack on the stub API, stub weather, SQLite and the emulated hardware"""
+    stack = {'stub': StubTisseoServer(latency=latency).start(), 'timers': Timer_Scheduler()}
+    stack['timers'].start()
+    storage = Departure_Store(SQLite_Backend(os.path.join(tempfile.mkdtemp(prefix="bench-"), "departures.db")))
+    stack['DB_T'] = DB_Tread(None, None, None, None, {"Stop_%02d" % i: stack['stub'].url(i) for i in range(stops)},
+                             "stub", storage=storage)
+    stack['DB_T'].RecupAndUpload()
+    stack['METEO_T'] = METEO_Tread(client=StubMeteoClient(), cache_file=None, timers=stack['timers'])
+    stack['METEO_T'].retreiveAndExtract()
+    stack['LED'] = Led(12, timers=stack['timers'])
+    stack['MAINBULB_TUYA'] = TuyaBulb_device("stub", "127.0.0.1", "stub", "Main Bulb", device=StubTuyaDevice())
+    stack['LCD'] = LCDscreen(DB_object=stack['DB_T'], LED_object=stack['LED'], METEO_object=stack['METEO_T'],
+                             IMPR3D_object=GPIO_device(40, "Impr 3D"), MAINBULB_TUYA=stack['MAINBULB_TUYA'])
+    stack['MAINBULB_TUYA'].on_change = stack['LCD'].refresh
+    stack['DISPATCHER'] = Event_Dispatcher(lambda: stack['LCD'].requestedMode)
+    stack['DISPATCHER'].bind(None, 'RIGHT', lambda: stack['LCD'].shift_mode(1))
+    stack['DISPATCHER'].bind(None, 'LEFT', lambda: stack['LCD'].shift_mode(-1))
+    stack['BT_R'] = Button_Retreiver(on_press=stack['DISPATCHER'].post_button)
+    return stack
+
+
+def start_stack(stack):
+    """Starts the threads of a display stack"""
+    stack['dispatcher_thread'] = threading.Thread(target=stack['DISPATCHER'].run, name="Dispatcher", daemon=True)
+    for name in ('MAINBULB_TUYA', 'BT_R', 'DB_T', 'LCD', 'dispatcher_thread'):
+        stack[name].start()
+    stack['METEO_T'].start()
+
+
+def stop_stack(stack):
+    """Stops the threads of a display stack"""
+    for name in ('BT_R', 'DB_T', 'LCD', 'MAINBULB_TUYA', 'METEO_T', 'DISPATCHER'):
+        stack[name].stop()
+    for name in ('BT_R', 'DB_T', 'LCD', 'MAINBULB_TUYA', 'dispatcher_thread'):
+        if stack.get(name) is not None and stack[name].is_alive():
+            stack[name].join(5)
+    stack['LED'].cancel()
+    stack['timers'].stop()
+    stack['stub'].stop()
+
+
+def bench_multistop(counts=(1, 5, 20), latency=0.05, repeat=5):
+    """Measures the refresh time of 1, 5 and 20 stops against the stub API, sequentially and concurrently"""
+    stub = StubTisseoServer(latency=latency).start()
+    results = {}
+    for count in counts:
+        requests = {"Stop_%02d" % i: stub.url(i) for i in range(count)}
+        results[count] = {}
+        for name, workers in (('sequential', 1), ('concurrent', 8)):
+            DB_T = DB_Tread(None, None, None, None, requests, "stub", max_workers=workers)
+            results[count][name] = measure(DB_T.fetch_all, repeat)
+            DB_T.stop()
+    stub.stop()
+    return results
+
+
+def legacy_parse(body, number=3):
+    """Former RecupAndUpload parsing : full tree, xpath and strptime, kept as the reference of bench_parse"""
+    ExtractedData = []
+    FormatedData = []
+    xmlf = etree.fromstring(body.decode('utf-8').encode('utf-8'))
+    for departure in xmlf.xpath('/departures/departure'):
+        ExtractedData.append([departure.get('dateTime'), departure.get('realTime')])
+    for passage in ExtractedData[:number]:
+        FormatedData.append([datetime.datetime.strptime(passage[0], "%Y-%m-%d %H:%M:%S"), passage[1] == "yes"])
+    return FormatedData
+
+
+def bench_parse(sizes=(3, 50, 500), repeat=50):
+    """Measures the parsing of the first 3 departures of answers holding 3, 50 and 500 departures"""
+    stub = StubTisseoServer()
+    results = {}
+    for size in sizes:
+        body = stub.build_departures(1, size)
+        chunks = [body[i:i + CHUNK_SIZE] for i in range(0, len(body), CHUNK_SIZE)]
+        results[size] = {'bytes': len(body),
+                         'legacy': measure(lambda: legacy_parse(body), repeat),
+                         'streaming': measure(lambda: parse_departures(chunks), repeat)}
+    stub.server.server_close()
+    return results
+
+
+def bench_history(months=6, stops=5, per_day=150, repeat=5):
+    """Measures the batched writes and the punctuality query of months of history for several stops"""
+    directory = tempfile.mkdtemp(prefix="history-")
+    history = Departure_History(directory, batch_size=500)
+    end = time.time()
+    start = end - months * 30 * 86400
+    step = 86400 / per_day
+    count = 0
+    begin = time.perf_counter()
+    for stop in range(stops):
+        predicted = start
+        while predicted < end:
+            history.buffer.append(("Stop_%02d" % stop, {'line': "79", 'destination': "Périgord",
+                                                        'scheduled': int(predicted) - 60 * (count % 4),
+                                                        'predicted': int(predicted), 'first_seen': int(predicted) - 1800,
+                                                        'last_seen': int(predicted), 'realtime': count % 3 != 0,
+                                                        'observations': 10}))
+            count += 1
+            predicted += step
+            if len(history.buffer) >= history.batch_size:
+                history.flush()
+    history.flush()
+    results = {'rows': count, 'write_rows_per_s': count / (time.perf_counter() - begin),
+               'query_one_stop_30d': measure(lambda: history.punctuality("Stop_00", end - 30 * 86400, end), repeat),
+               'query_one_stop_all': measure(lambda: history.punctuality("Stop_00", start, end), repeat),
+               'query_all_stops_all': measure(lambda: history.punctuality(None, start, end), repeat)}
+    history.close()
+    return results
+
+
+def legacy_meteo_boot(client):
+    """Former METEO_Tread startup : the first forecast is retreived synchronously"""
+    rawDatas = client.get_forecast(latitude=43.534240, longitude=1.518130)
+    return {'T_real': round(rawDatas.current_forecast["T"]["value"])}
+
+
+def bench_meteo_boot(latency=1.5):
+    """Measures the cold-boot time until the weather page has data, before and after the disk cache"""
+    cache_file = os.path.join(tempfile.mkdtemp(prefix="meteo-"), "meteo_cache.json")
+    results = {}
+
+    start = time.perf_counter()
+    legacy_meteo_boot(StubMeteoClient(latency))
+    results['legacy_blocking'] = time.perf_counter() - start
+
+    # First boot ever : no cache, startup is not blocked but the data arrives with the first refresh
+    start = time.perf_counter()
+    meteo = METEO_Tread(client=StubMeteoClient(latency), cache_file=cache_file)
+    results['constructor_no_cache'] = time.perf_counter() - start
+    meteo.start()
+    while not meteo.read():
+        time.sleep(0.001)
+    results['first_data_no_cache'] = time.perf_counter() - start
+    meteo.stop()
+
+    # Following boots : the cached forecast is shown at once and refreshed in the background
+    start = time.perf_counter()
+    meteo = METEO_Tread(client=StubMeteoClient(latency), cache_file=cache_file)
+    meteo.start()
+    meteo.read()
+    results['first_data_cached'] = time.perf_counter() - start
+    meteo.stop()
+    return results
+
+
+def bench_recup(stops=(1, 5), latency=0.01, repeat=20):
+    """Measures RecupAndUpload (fetch, parse, publish and SQLite write queueing) of 1 and 5 stops, with and without ETag"""
+    results = {}
+    for count in stops:
+        results[count] = {}
+        for name, etag in (('full', False), ('conditional', True)):
+            stub = StubTisseoServer(latency=latency, etag=etag).start()
+            storage = Departure_Store(SQLite_Backend(os.path.join(tempfile.mkdtemp(prefix="bench-"), "departures.db")))
+            DB_T = DB_Tread(None, None, None, None, {"Stop_%02d" % i: stub.url(i) for i in range(count)}, "stub",
+                            storage=storage)
+            results[count][name] = measure(DB_T.RecupAndUpload, repeat)
+            DB_T.stop()
+            storage.close()
+            stub.stop()
+    return results
+
+
+def bench_frames(seconds=3):
+    """Measures the I2C traffic and render time of each LCDscreen page, on a page switch and per second"""
+    stack = build_stack()
+    LCD = stack['LCD']
+    results = {}
+    for mode, (name, rows) in enumerate(SCREEN_PAGES):
+        LCD.mode = mode
+        LCD.lcd.lcd_bus_stats(reset=True)
+        LCD.render(force=True)
+        switchTransactions, switchBytes = LCD.lcd.lcd_bus_stats(reset=True)
+
+        # One frame per second boundary, like the render thread
+        ticker = Tick_Scheduler()
+        durations = []
+        for _ in range(seconds):
+            time.sleep(ticker.timeout())
+            ticker.tick()
+            start = time.perf_counter()
+            LCD.render()
+            durations.append(time.perf_counter() - start)
+        transactions, written = LCD.lcd.lcd_bus_stats(reset=True)
+        results[name] = {'switch_transactions': switchTransactions, 'switch_bytes': switchBytes,
+                         'transactions_per_frame': transactions / seconds, 'bytes_per_frame': written / seconds,
+                         'render': summarize(durations)}
+    stop_stack(stack)
+    return results
+
+
+def bench_press_to_pixel(presses=20, timeout=2.0):
+    """Measures the time between a button edge and the new page on the emulated panel"""
+    stack = build_stack()
+    start_stack(stack)
+    time.sleep(0.5)
+    right = stack['BT_R'].BT_RG
+    latencies = []
+    missed = 0
+    for _ in range(presses):
+        before = hw_emulator.LCD_PANEL.screen()[0]
+        start = time.perf_counter()
+        hw_emulator.GPIO.press(right)
+        while hw_emulator.LCD_PANEL.screen()[0] == before:
+            if time.perf_counter() - start > timeout:
+                missed += 1
+                break
+            time.sleep(0.0002)
+        else:
+            latencies.append(time.perf_counter() - start)
+        # Waits for the end of the debounce window
+        time.sleep(0.1)
+    results = {'presses': presses, 'missed': missed, 'latency': summarize(latencies),
+               'dispatch_latency_max': stack['DISPATCHER'].read_stats()['max_latency'],
+               'message_to_frame_max': stack['LCD'].latency_stats()['max']}
+    stop_stack(stack)
+    return results
+
+
+def bench_idle(seconds=20):
+    """Measures the CPU time and the wake-ups of the whole stack while nobody presses a button, per minute"""
+    stack = build_stack()
+    start_stack(stack)
+    time.sleep(1)
+    LCD, timers = stack['LCD'], stack['timers']
+    before = {'frames': LCD.ticker.stats['ticks'] + LCD.ticker.stats['early'],
+              'timers': timers.stats['fired'], 'dispatcher': stack['DISPATCHER'].stats['wakeups'],
+              'api_requests': stack['DB_T'].client.read_stats()['requests']}
+    cpu, start = time.process_time(), time.perf_counter()
+    time.sleep(seconds)
+    cpu, elapsed = time.process_time() - cpu, time.perf_counter() - start
+    after = {'frames': LCD.ticker.stats['ticks'] + LCD.ticker.stats['early'],
+             'timers': timers.stats['fired'], 'dispatcher': stack['DISPATCHER'].stats['wakeups'],
+             'api_requests': stack['DB_T'].client.read_stats()['requests']}
+    stop_stack(stack)
+
+    # The stub API is served by this process, its CPU time is included
+    wakeups = {name: (after[name] - before[name]) * 60 / elapsed for name in after}
+    return {'cpu_seconds_per_minute': cpu * 60 / elapsed, 'cpu_percent': 100 * cpu / elapsed,
+            'wakeups_per_minute': wakeups, 'total_wakeups_per_minute': sum(wakeups.values())}
+
+
+def bench_timetable(gtfs=None, queries=2000):
+    """Measures the import of a GTFS feed (a synthetic Toulouse-sized one by default) and the next departures queries"""
+    directory = tempfile.mkdtemp(prefix="timetable-")
+    if gtfs is None:
+        gtfs = write_stub_gtfs(os.path.join(directory, "gtfs"))
+    index = os.path.join(directory, "timetable.idx")
+    start = time.perf_counter()
+    count = build_index(gtfs, index)
+    importTime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    timetable = Timetable(index)
+    openTime = time.perf_counter() - start
+    stops = sorted(timetable.stops)
+    now = datetime.datetime.now()
+    random.seed(0)
+    requests = [([random.choice(stops)], now + datetime.timedelta(seconds=random.randint(0, 7 * 86400)))
+                for _ in range(queries)]
+    start = time.perf_counter()
+    timetable.next_departures(*requests[0])
+    firstQuery = time.perf_counter() - start
+    durations = []
+    for stopIds, after in requests:
+        start = time.perf_counter()
+        timetable.next_departures(stopIds, after, 3)
+        durations.append(time.perf_counter() - start)
+    timetable.close()
+    return {'departures': count, 'stops': len(stops), 'import': importTime, 'import_rows_per_s': count / importTime,
+            'index_bytes': os.path.getsize(index), 'open': openTime, 'first_query': firstQuery,
+            'query': summarize(durations)}
+
+
+BENCHMARKS = {'multistop': bench_multistop, 'parse': bench_parse, 'history': bench_history,
+              'meteo_boot': bench_meteo_boot, 'recup': bench_recup, 'frames': bench_frames,
+              'press_to_pixel': bench_press_to_pixel, 'idle': bench_idle, 'timetable': bench_timetable}
+
+
+def flatten(results, prefix=""):
+    """Returns the numeric values of nested results, keyed by their dotted path"""
+    values = {}
+    for key, value in results.items():
+        path = prefix + str(key)
+        if isinstance(value, dict):
+            values.update(flatten(value, path + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[path] = value
+    return values
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Returns the (path, baseline, current, relative change) of the values worse than the baseline by more than tolerance"""
+    current, reference = flatten(results), flatten(baseline)
+    regressions = []
+    for path, value in sorted(current.items()):
+        old = reference.get(path)
+        if old is None or path.startswith('_meta'):
+            continue
+        # Rates are better when higher, durations, bytes, misses and wake-ups when lower
+        higherIsBetter = path.endswith('_per_s')
+        if old == 0:
+            # No relative change from a zero baseline : any rise of a lower-is-better value is a regression
+            if value > 0 and not higherIsBetter:
+                regressions.append((path, old, value, float('inf')))
+            continue
+        change = (value - old) / abs(old)
+        worse = -change if higherIsBetter else change
+        if worse > tolerance:
+            regressions.append((path, old, value, change))
+    return regressions
+
+
+# Runs the benchmarks and prints the results
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TisseoDisplay offline benchmarks")
+    parser.add_argument('names', nargs='*', default=list(BENCHMARKS), help="Benchmarks to run")
+    parser.add_argument('--json', action='store_true', help="Prints the results as JSON")
+    parser.add_argument('--save', metavar='FILE', help="Saves the results as a JSON baseline")
+    parser.add_argument('--compare', metavar='FILE', help="Compares the results with a JSON baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Relative change tolerated before a value is reported as a regression")
+    parser.add_argument('--gtfs', metavar='PATH', help="GTFS feed (directory or zip) imported by the timetable benchmark")
+    args = parser.parse_args()
+    if args.gtfs:
+        BENCHMARKS['timetable'] = functools.partial(bench_timetable, gtfs=args.gtfs)
+
+    logging.basicConfig(level=logging.ERROR)
+    results = {name: BENCHMARKS[name]() for name in args.names}
+    results['_meta'] = {'python': platform.python_version(), 'machine': platform.machine(),
+                        'time': datetime.datetime.now().isoformat(timespec='seconds')}
+    if args.save:
+        with open(args.save, 'w') as baseline:
+            json.dump(results, baseline, indent=2)
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        for name, result in results.items():
+            print("==", name)
+            for key, value in result.items():
+                print("  ", key, value)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        for path, old, value, change in regressions:
+            print("REGRESSION %s : %.6g -> %.6g (%+.0f%%)" % (path, old, value, 100 * change))
+        print("%d regression(s) against %s" % (len(regressions), args.compare))
+        sys.exit(1 if regressions else 0)
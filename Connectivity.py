@@ -0,0 +1,138 @@
+# Modules importation
+import socket
+import threading
+import random
+import time
+import logging
+
+# Logger Init
+logger = logging.getLogger()
+
+
+class Connectivity_Monitor(threading.Thread):
+    """
+    Returns a Connectivity_Monitor object that publishes a cached internet link state
+
+    The state is inferred from the outcome of the requests of the other threads (report()). A TCP probe
+    is only sent when no request reported for stale_after seconds, or after a failed request, with an
+    exponential backoff while the link stays down.
+
+    Attributes
+    ----------
+    online : boolean or None
+        Cached link state, read for free by the renderer (None while a failed request is being confirmed)
+    probe_host : tuple
+        (host, port) opened by the active probes
+    probe_timeout : float
+        Maximum time of a probe in seconds
+    stale_after : float
+        Time without report after which the link is probed in seconds
+    min_backoff : float
+        Time before the second probe while the link is down in seconds
+    max_backoff : float
+        Maximum time between two probes while the link is down in seconds
+    retryDelay : float
+        Time between the last probe and the next one while the link is down in seconds
+    lastReport : float
+        Time (time.monotonic) of the last report or probe
+    probes : int
+        Number of active probes sent
+    reports : dict
+        Number of successful and failed requests reported by each source
+    wantstop : boolean
+        Shows if the user or program wants to stop the current thread
+
+    Methods
+    -------
+    run()
+        Reserved function for the treading process
+    report(source, success)
+        Records the outcome of a request sent by another thread
+    is_online()
+        Returns the cached link state
+    next_probe()
+        Returns the time (time.monotonic) of the next active probe
+    probe()
+        Opens a TCP connection to probe_host and returns True if it succeeded
+    set_state(online)
+        Updates the cached link state
+    stop()
+        Stops the current tread
+    """
+    def __init__(self, probe_host=("8.8.8.8", 53), probe_timeout=1, stale_after=60, min_backoff=2, max_backoff=300):
+        """Constructs all attributes, the link is assumed up until a failure is seen"""
+        threading.Thread.__init__(self, name="Connectivity Monitor", daemon=True)
+        self.online = True
+        self.probe_host = probe_host
+        self.probe_timeout = probe_timeout
+        self.stale_after = stale_after
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.retryDelay = min_backoff
+        self.lastReport = time.monotonic()
+        self.probes = 0
+        self.reports = {}
+        self.failures = 0
+        self.wakeEvent = threading.Event()
+        self.wantstop = False
+
+    def run(self):
+        """Reserved function for the treading process"""
+        while not self.wantstop:
+            timeout = self.next_probe() - time.monotonic()
+            if timeout > 0:
+                # Woken up early by stop() or by a report changing the state
+                self.wakeEvent.wait(timeout)
+                self.wakeEvent.clear()
+                continue
+            self.set_state(self.probe())
+
+    def report(self, source, success):
+        """Records the outcome of a request sent by another thread (success is False only for network errors)"""
+        counts = self.reports.setdefault(source, [0, 0])
+        counts[0 if success else 1] += 1
+        self.lastReport = time.monotonic()
+        if success:
+            if self.online is not True:
+                self.set_state(True)
+                self.wakeEvent.set()
+        elif self.online is True:
+            # A failed request is confirmed by a probe before the link is declared down
+            self.online = None
+            self.wakeEvent.set()
+
+    def is_online(self):
+        """Returns the cached link state"""
+        return self.online is not False
+
+    def next_probe(self):
+        """Returns the time (time.monotonic) of the next active probe"""
+        if self.online is True:
+            return self.lastReport + self.stale_after
+        if self.online is None:
+            return 0
+        return self.lastReport + self.retryDelay
+
+    def probe(self):
+        """Opens a TCP connection to probe_host and returns True if it succeeded"""
+        self.probes += 1
+        try:
+            socket.create_connection(self.probe_host, timeout=self.probe_timeout).close()
+            return True
+        except OSError:
+            return False
+
+    def set_state(self, online):
+        """Updates the cached link state"""
+        self.lastReport = time.monotonic()
+        self.failures = 0 if online else self.failures + 1
+        # Exponential backoff with jitter while the link is down
+        self.retryDelay = random.uniform(0.5, 1) * min(self.max_backoff, self.min_backoff * 2 ** self.failures)
+        if online != self.is_online():
+            logger.warning("Internet link %s", "up" if online else "down")
+        self.online = online
+
+    def stop(self):
+        """Stops the current tread"""
+        self.wantstop = True
+        self.wakeEvent.set()
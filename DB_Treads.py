@@ -3,14 +3,192 @@ from lxml import etree
 import requests
 import sys
 import threading
+import collections
+import concurrent.futures
 import datetime
-import mysql.connector
+from Storage import Departure_Store, MySQL_Backend, DEPARTURES_NUMBER, DEPARTURES_TABLE
+from Metrics import REGISTRY
+from StateStore import State_Store
 import time
+import random
 import logging
 
 # Logger Init
 logger = logging.getLogger()
 
+# Stop name used when a single request is given
+DEFAULT_STOP = "79_Ramonville_Périgord"
+# Size of the chunks read from the API answers
+CHUNK_SIZE = 4096
+# Key of the departures of every stop in the state store
+DEPARTURES_KEY = 'departures'
+# Highest power of 2 applied to the poll period after consecutive failures
+MAX_BACKOFF_EXPONENT = 16
+# Departures taken from the offline timetable, enough to cover the polls backoff
+TIMETABLE_DEPARTURES = 10
+
+# Departure record built from the Tisseo XML (epoch is the departure time in integer epoch seconds)
+Departure = collections.namedtuple('Departure', ['dateTime', 'realTime', 'line', 'destination', 'epoch'])
+
+
+def parse_departures(chunks, number=DEPARTURES_NUMBER):
+    """Parses the /departures/departure elements of an iterable of XML bytes chunks, stops after number departures"""
+    departures = []
+    parser = etree.XMLPullParser(events=('end',), tag='departure')
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            parent = element.getparent()
+            # Only the direct children of the root element are departures
+            if parent is None or parent.getparent() is not None:
+                continue
+            line, destination = element.find('line'), element.find('destination')
+            dateTime = datetime.datetime.fromisoformat(element.get('dateTime'))
+            departures.append(Departure(dateTime,
+                                        element.get('realTime') == "yes",
+                                        line.get('shortName') if line is not None else None,
+                                        destination.get('name') if destination is not None else None,
+                                        int(dateTime.timestamp())))
+            # Frees the parsed departures
+            element.clear()
+            while element.getprevious() is not None:
+                del parent[0]
+            if len(departures) >= number:
+                return departures
+    parser.close()
+    return departures
+
+
+
+class API_Client():
+    """
+    Returns an API_Client object that keeps a pooled keep-alive HTTP session to the Tisseo API
+
+    Attributes
+    ----------
+    session : requests.Session object
+        Long-lived session whose connections are reused between two polls
+    timeout : tuple of float
+        Connect and read timeouts of a request in seconds
+    validators : dict
+        ETag, Last-Modified and body (or parsed body) of the last answer of each url, used for conditional requests
+    stats : dict
+        Number of requests, errors, 304 answers and latencies (seconds) of the requests
+    connectivity : Connectivity_Monitor object
+        Monitor told about the requests that reached or failed to reach the API (None to disable)
+
+    Methods
+    -------
+    get(url, parser)
+        Returns the body of the url (or what parser built from it), reusing the last one on 304 Not Modified
+    read_stats()
+        Returns a copy of the latency and error counters
+    close()
+        Closes the pooled connections
+    """
+    def __init__(self, connect_timeout=3.05, read_timeout=10, pool_size=4, connectivity=None):
+        """
+        Constructor for API_Client class
+
+        Parameters
+        ----------
+            connect_timeout (float) : Maximum time to establish a connection in seconds
+            read_timeout (float) : Maximum time between two bytes received from the API in seconds
+            pool_size (int) : Number of connections kept alive
+            connectivity (Connectivity_Monitor) : Monitor told about the outcome of the requests
+        """
+        self.timeout = (float(connect_timeout), float(read_timeout))
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+        self.validators = {}
+        self.connectivity = connectivity
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'errors': 0, 'not_modified': 0,
+                      'last_latency': 0.0, 'max_latency': 0.0, 'total_latency': 0.0}
+        self.requestTime = REGISTRY.histogram("tisseo_api_request_seconds", "Time of an API request, parsing included")
+        self.parseTime = REGISTRY.histogram("tisseo_api_parse_seconds", "Time reading and parsing a streamed answer")
+        self.errorCount = REGISTRY.counter("tisseo_api_errors_total", "API requests that failed")
+        self.notModifiedCount = REGISTRY.counter("tisseo_api_not_modified_total", "API answers 304 Not Modified")
+
+    def get(self, url, parser=None):
+        """
+        Returns the body of the url, reusing the last one when the API answers 304 Not Modified
+
+        Parameters
+        ----------
+            url (str) : Requested url
+            parser (function) : When given, the answer is streamed to parser as an iterable of bytes chunks
+                                and the result of parser is returned instead of the body
+        """
+        headers = {}
+        cached = self.validators.get(url)
+        if cached is not None:
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        start = time.monotonic()
+        notModified = False
+        response = None
+        try:
+            try:
+                response = self.session.get(url, headers=headers, timeout=self.timeout, stream=parser is not None)
+            except (requests.ConnectionError, requests.Timeout):
+                if self.connectivity is not None:
+                    self.connectivity.report("Tisseo API", False)
+                raise
+            # Any answer, even an HTTP error, proves the link is up
+            if self.connectivity is not None:
+                self.connectivity.report("Tisseo API", True)
+            if response.status_code == 304 and cached is not None:
+                notModified = True
+                content = cached['content']
+            else:
+                response.raise_for_status()
+                if parser is None:
+                    content = response.content
+                else:
+                    with self.parseTime.time():
+                        content = parser(response.iter_content(CHUNK_SIZE))
+                    # Reads the unparsed end of the answer so that the connection can be reused
+                    response.raw.drain_conn()
+                etag, lastModified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+                if etag or lastModified:
+                    self.validators[url] = {'etag': etag, 'last_modified': lastModified, 'content': content}
+        except Exception:
+            with self.lock:
+                self.stats['errors'] += 1
+            self.errorCount.inc()
+            raise
+        finally:
+            # A streamed answer holds its pooled connection until closed, even after an error
+            if response is not None:
+                response.close()
+            latency = time.monotonic() - start
+            self.requestTime.observe(latency)
+            if notModified:
+                self.notModifiedCount.inc()
+            with self.lock:
+                self.stats['requests'] += 1
+                self.stats['not_modified'] += notModified
+                self.stats['last_latency'] = latency
+                self.stats['total_latency'] += latency
+                self.stats['max_latency'] = max(self.stats['max_latency'], latency)
+        return content
+
+    def read_stats(self):
+        """Returns a copy of the latency and error counters"""
+        with self.lock:
+            return dict(self.stats)
+
+    def close(self):
+        """Closes the pooled connections"""
+        self.session.close()
+
 
 class DB_Tread(threading.Thread):
     """
@@ -19,122 +197,263 @@ class DB_Tread(threading.Thread):
     Attributes
     ----------
     updt_rate : float
-        Time between two updates of the DB in seconds
+        Time between two updates of the DB in seconds while a bus is close
+    fast_window : float
+        A bus leaving in less than fast_window seconds is polled every updt_rate seconds
+    max_rate : float
+        Maximum time between two updates while departures are announced in seconds
+    idle_rate : float
+        Time between two updates when no departure is announced (end of the service day) in seconds
+    max_backoff : float
+        Maximum time between two updates after network failures in seconds
+    failures : int
+        Number of consecutive failed updates
+    nextPollDelay : float
+        Time until the next update in seconds
     wantstop : boolean
         Shows if the user or program want to stop the current thread
-    HTTPRequest : str
-        Contains the body of the Tisseo API HTTP request
+    Requests : dict
+        Body of the Tisseo API HTTP request of each stop, keyed by stop name
     APIKey : str
         Contains the API key sent by Tisseo (If you want to obtain it, please send an email to opendata@tisseo.fr)
-    mydb : mysql.connector object
-        mysql.connector object created if the connection process succeeds
-    addNextStopData : tuple with str inside
-        Contains the structure of mysql request to send data to the DB
+    client : API_Client object
+        Keep-alive HTTP client used to query the Tisseo API
+    pool : concurrent.futures.ThreadPoolExecutor object
+        Workers fetching the stops concurrently
+    state : StateStore.State_Store object
+        Store where the departures of every stop are published as a single snapshot
+    StopsData : mappingproxy
+        Latest Departure records of each stop, keyed by stop name (the last published snapshot)
+    savedVersion : int
+        Version of the last departures snapshot queued for the DB
+    storage : Departure_Store object
+        Store saving the departures of every stop (None without DB)
+    history : Departure_History object
+        Append-only history of the observed departures (None without history)
+    timetable : Timetable.Timetable object
+        Offline timetable giving the scheduled departures of the stops the API did not answer (None without it)
+    timetableStops : dict
+        (GTFS stop ids, line short names or None) of each stop, keyed by stop name
+    timetableLock : threading.Lock
+        Held by the timetable queries, so a replaced timetable is only closed once no query uses it
 
     Methods
     -------
     RecupAndUpload()
-        Sends the HTTP request and uploads filtered data to mysql DB
+        Sends the HTTP requests and uploads filtered data to mysql DB
+    fetch_stop(stop)
+        Sends the HTTP request of a stop and returns its next departures
+    fetch_all()
+        Fetches all the stops concurrently and returns the stops that answered
+    scheduled_departures(stop, now)
+        Returns the next departures of a stop from the offline timetable
+    set_timetable(timetable)
+        Replaces the offline timetable (a new index built in the background) and closes the previous one
+    upload()
+        Queues the departures of every stop for the DB writer
+    next_poll_delay(success, now)
+        Returns the time to wait before the next update in seconds
     run()
         Reserved function for the treading process
     stop()
         Stops the current tread
-    read()
-        Returns latest autobus data
+    read(stop)
+        Returns latest autobus data of a stop (the first one by default)
+    read_all()
+        Returns latest autobus data of every stop
     """
-    def __init__(self, host, user, password, database, request, api_key, updt_rate=5):
+    def __init__(self, host, user, password, database, request, api_key, updt_rate=5,
+                 connect_timeout=3.05, read_timeout=10, fast_window=180, max_rate=120, idle_rate=900,
+                 max_backoff=300, table=DEPARTURES_TABLE, max_workers=8, storage=None, db_deadline=2.0,
+                 history=None, connectivity=None, state=None, timetable=None, timetable_stops=None):
         """
         Constructor for DB_Tread class
 
         Parameters
         ----------
-            host (str) : Host name or adress for the mysql DB
+            host (str) : Host name or adress for the mysql DB (None to run without DB, unless storage is given)
             user (str) : User name of mysql DB
             password (str) : Password for selected user
             database (str) : Database name that contain your autobus lines data
-            request (str) : String that contains the body of the Tisseo API HTTP request
+            request (str or dict) : Body of the Tisseo API HTTP request, or dict of requests keyed by stop name
             api_key (str) : String that contains the API key sent by Tisseo (If you want to obtain it, please send an email to opendata@tisseo.fr)
             updt_rate (float) : Time between two updates of the DB in seconds
+            connect_timeout (float) : Maximum time to connect to the Tisseo API in seconds
+            read_timeout (float) : Maximum time to wait for the Tisseo API answer in seconds
+            fast_window (float) : A bus leaving in less than fast_window seconds is polled every updt_rate seconds
+            max_rate (float) : Maximum time between two updates while departures are announced in seconds
+            idle_rate (float) : Time between two updates when no departure is announced in seconds
+            max_backoff (float) : Maximum time between two updates after network failures in seconds
+            table (str) : Name of the table keyed by stop name that stores the next departures
+            max_workers (int) : Maximum number of stops fetched at the same time
+            storage (Departure_Store) : Store used instead of the mysql DB described by host, user, password and database
+            db_deadline (float) : Maximum time the update waits for room in the DB write queue in seconds
+            history (Departure_History) : History recording every departure observed
+            connectivity (Connectivity_Monitor) : Monitor told about the outcome of the API requests
+            state (State_Store) : Store where the departures are published (a private one by default)
+            timetable (Timetable) : Offline timetable used when the API does not answer
+            timetable_stops (dict) : (GTFS stop ids, line short names or None) of each stop, keyed by stop name
         """
         threading.Thread.__init__(self)
-        self.updt_rate = updt_rate
+        self.updt_rate = float(updt_rate)
+        self.fast_window = float(fast_window)
+        self.max_rate = float(max_rate)
+        self.idle_rate = float(idle_rate)
+        self.max_backoff = float(max_backoff)
+        self.failures = 0
+        self.nextPollDelay = 0.0
+        self.stopEvent = threading.Event()
         self.wantstop = False
-        self.HTTPRequest = request
+        self.Requests = dict(request) if isinstance(request, dict) else {DEFAULT_STOP: request}
         self.APIKey = api_key
+        self.client = API_Client(connect_timeout, read_timeout, pool_size=min(max_workers, len(self.Requests)),
+                                 connectivity=connectivity)
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(self.Requests)),
+                                                          thread_name_prefix="Tisseo fetch")
+        self.state = state if state is not None else State_Store()
+        self.state.publish(DEPARTURES_KEY, {stop: [] for stop in self.Requests})
+        self.StopsData = self.state.read(DEPARTURES_KEY)
+        self.savedVersion = None
+        self.storage = storage
+        self.history = history
+        self.timetable = timetable
+        self.timetableStops = dict(timetable_stops or {})
+        self.timetableLock = threading.Lock()
 
-        # Establishing a connection with the DB
-        try:
-            self.mydb = mysql.connector.connect(host=host, user=user, password=password, database=database)
-            cursor = self.mydb.cursor()
+        # Pool of connections to the DB, opened on first write
+        if self.storage is None and host is not None:
+            self.storage = Departure_Store(MySQL_Backend(host, user, password, database), table, db_deadline)
 
-            '''
-            addNextStopData = ("INSERT INTO 79_Ramonville_Périgord "
-                                "(Next_Bus_1, Real_Time_1, Next_Bus_2, Real_Time_2, Next_Bus_3, Real_Time_3) "
-                                "VALUES (%s, %s, %s, %s, %s, %s)")
-            '''
+        self.pollTime = REGISTRY.histogram("tisseo_poll_seconds", "Time of a RecupAndUpload (fetch, parse, publish, DB queueing)")
+        self.pollFailures = REGISTRY.counter("tisseo_poll_failures_total", "Polls where no stop answered")
+        self.pollOverruns = REGISTRY.counter("tisseo_poll_overruns_total", "Polls longer than the fastest poll period")
+        REGISTRY.gauge("tisseo_next_poll_seconds", "Time before the next poll", lambda: self.nextPollDelay)
 
-            self.addNextStopData = ("UPDATE 79_Ramonville_Périgord SET Next_Bus_1 = %s, Real_Time_1 = %s, Next_Bus_2 = %s, Real_Time_2 = %s, Next_Bus_3 = %s, Real_Time_3 = %s")
+    def fetch_stop(self, stop):
+        """Sends the HTTP request of a stop and returns its next departures"""
+        # Retreiving and parsing XML data from Tisseo API as it is received
+        return self.client.get(self.Requests[stop] + "&key=" + self.APIKey, parse_departures)
 
-            logger.warning("Connection Opened !!")
-        except mysql.connector.Error as details:
-            logger.critical("Error While Connecting to the DataBase : %s", details)
+    def fetch_all(self):
+        """Fetches all the stops concurrently, publishes their departures and returns the stops that answered"""
+        futures = {stop: self.pool.submit(self.fetch_stop, stop) for stop in self.Requests}
+        # Filled aside, the readers only see the complete snapshot
+        stopsData = {}
+        fetched = []
+        for stop, future in futures.items():
+            try:
+                stopsData[stop] = future.result()
+                fetched.append(stop)
+            except Exception as details:
+                logger.critical("Network Failed for %s !! %s", stop, details)
+                stopsData[stop] = self.scheduled_departures(stop)
+        self.state.publish(DEPARTURES_KEY, stopsData)
+        self.StopsData = self.state.read(DEPARTURES_KEY)
+        return fetched
+
+    def scheduled_departures(self, stop, now=None):
+        """Returns the next departures of a stop from the offline timetable, marked as not real-time"""
+        if self.timetable is None or stop not in self.timetableStops:
+            return []
+        stopIds, lines = self.timetableStops[stop]
+        now = now if now is not None else datetime.datetime.now()
+        try:
+            with self.timetableLock:
+                departures = self.timetable.next_departures(stopIds, now, TIMETABLE_DEPARTURES, lines)
+        except Exception as details:
+            logger.error("Timetable of %s not read : %s", stop, details)
+            return []
+        logger.warning("Scheduled departures shown for %s", stop)
+        return [Departure(dateTime, False, line, destination, int(dateTime.timestamp()))
+                for dateTime, line, destination in departures]
+
+    def set_timetable(self, timetable):
+        """Replaces the offline timetable (a new index built in the background) and closes the previous one"""
+        # The previous index is unmapped once the query running on it (a few microseconds) has ended
+        with self.timetableLock:
+            previous, self.timetable = self.timetable, timetable
+            if previous is not None and previous is not timetable:
+                previous.close()
+        logger.info("Offline timetable %s loaded", timetable.path)
+
+    def upload(self):
+        """Queues the departures of every stop for the DB writer, returns True if none was dropped"""
+        if self.storage is None:
+            return False
+        return self.storage.write(self.StopsData)
 
     def RecupAndUpload(self):
-        """Sends the HTTP request and upload filtered data to mysql DB"""
-        ExtractedData = []
-        self.FormatedData = []
+        """Sends the HTTP requests, publishes and queues the filtered data for the mysql DB, returns True if the API answered"""
+        fetched = self.fetch_all()
+        # Published first, the DB writer only gets the departures that changed since the last queued ones
+        version = self.state.version(DEPARTURES_KEY)
+        if version != self.savedVersion and self.upload():
+            self.savedVersion = version
+        if self.history is not None:
+            for stop in fetched:
+                self.history.observe(stop, self.StopsData[stop])
+        return bool(fetched)
 
-        cursor = self.mydb.cursor()
+    def next_poll_delay(self, success=True, now=None):
+        """Returns the time to wait before the next update in seconds"""
+        if not success:
+            # Exponential backoff with jitter after network failures
+            # The exponent is capped, the delay reaches max_backoff long before and 2 ** 1024 overflows a float
+            backoff = min(self.max_backoff, self.updt_rate * 2 ** min(self.failures, MAX_BACKOFF_EXPONENT))
+            return random.uniform(self.updt_rate, max(self.updt_rate, backoff))
 
-        # Retreiving XML data from Tisseo API
-        try:
-            queryAsw = requests.get(self.HTTPRequest + "&key=" + self.APIKey).text.encode('utf-8')
-            # XML data exctraction
-            xmlf = etree.fromstring(queryAsw)
-            for departure in xmlf.xpath('/departures/departure'):
-                ExtractedData.append([departure.get('dateTime'), departure.get('realTime')])
-
-            for passage in ExtractedData[:3]:
-                passDateTime = datetime.datetime.strptime(passage[0], "%Y-%m-%d %H:%M:%S")
-                if passage[1] == "yes":
-                    passage[1] = True
-                else:
-                    passage[1] = False
-                self.FormatedData.append([passDateTime, passage[1]])
-
-            # Sending extracted data to mysql DB
-            cursor.execute(self.addNextStopData, (self.FormatedData[0][0], self.FormatedData[0][1],
-                                                  self.FormatedData[1][0], self.FormatedData[1][1],
-                                                  self.FormatedData[2][0], self.FormatedData[2][1]))
-            self.mydb.commit()
-        except Exception:
-            logger.critical("Network Failed !!")
-        cursor.close()
+        # No departure announced : the service day is over
+        nextDepartures = [departures[0][0] for departures in self.StopsData.values() if departures]
+        if not nextDepartures:
+            return self.idle_rate
+
+        now = now if now is not None else datetime.datetime.now()
+        wait = (min(nextDepartures) - now).total_seconds()
+        if wait <= self.fast_window:
+            return self.updt_rate
+        # Halves the time left before the bus enters the fast window
+        return min(self.max_rate, max(self.updt_rate, (wait - self.fast_window) / 2))
 
     def run(self):
         """Reserved function for the treading process"""
         while not self.wantstop:
-            self.RecupAndUpload()
-            time.sleep(5)
+            start = time.monotonic()
+            success = self.RecupAndUpload()
+            duration = time.monotonic() - start
+            self.pollTime.observe(duration)
+            if duration > self.updt_rate:
+                self.pollOverruns.inc()
+            if not success:
+                self.pollFailures.inc()
+            self.failures = 0 if success else self.failures + 1
+            self.nextPollDelay = self.next_poll_delay(success)
+            logger.debug("Next Tisseo update in %.1f s", self.nextPollDelay)
+            self.stopEvent.wait(self.nextPollDelay)
+
+    def read(self, stop=None):
+        """Returns latest autobus data of a stop (the first one by default)"""
+        stopsData = self.state.read(DEPARTURES_KEY)
+        return stopsData.get(next(iter(self.Requests)) if stop is None else stop, ())
 
-    def read(self):
-        """Returns latest autobus data"""
-        return self.FormatedData
+    def read_all(self):
+        """Returns latest autobus data of every stop"""
+        return self.state.read(DEPARTURES_KEY)
 
     def stop(self):
         """Stops the current tread"""
-        try:
-            self.mydb.close()
-            logger.warning("Connection Closed !!")
-        except mysql.connector.Error as details:
-            logger.error("Error While Disconnecting from the DataBase : ", details)
-
         self.wantstop = True
+        self.stopEvent.set()
+        self.pool.shutdown(wait=False)
+        self.client.close()
+        if self.storage is not None:
+            self.storage.close()
+        if self.history is not None:
+            self.history.close()
 
 
 # Test code which uploads Tisseo data to mysql DB
 if __name__ == "__main__":
-    DB_T = DB_Tread('localhost', 'User', 'password', 'db_name')
+    DB_T = DB_Tread('localhost', 'User', 'password', 'db_name', sys.argv[1], sys.argv[2])
     DB_T.start()
 
     while True:
@@ -0,0 +1,134 @@
+# Modules importation
+import queue
+import time
+import logging
+from Metrics import REGISTRY
+
+# Logger Init
+logger = logging.getLogger()
+
+# Names of the buttons, in the order of the Button_Retreiver tuples
+BUTTON_KEYS = ('UP', 'DOWN', 'LEFT', 'RIGHT', 'OK')
+
+
+class Event_Dispatcher():
+    """
+    Returns an Event_Dispatcher object that blocks until an input or timer event arrives and runs its action
+
+    Actions are looked up in a (page, key) table, a None page matches every page.
+
+    Attributes
+    ----------
+    queue : queue.Queue
+        FIFO of (kind, key, posting time) events
+    page : function
+        Returns the page currently shown
+    actions : dict
+        Action of each (page, key)
+    hooks : dict
+        Functions called with the event before its action, for each kind of event
+    wantstop : boolean
+        Shows if the user or program wants to stop the dispatcher
+    stats : dict
+        Number of wake-ups, dispatched events and dispatch latencies in seconds
+
+    Methods
+    -------
+    bind(page, key, action)
+        Registers the action of a key on a page (every page when page is None)
+    add_hook(kind, function)
+        Registers a function called with every event of a kind before its action
+    post(kind, key, timestamp)
+        Adds an event to the queue
+    post_button(state, timestamp)
+        Adds the events of a Button_Retreiver buttons configuration
+    dispatch(event)
+        Runs the hooks and the action of an event
+    run()
+        Waits for the events and dispatches them until stop() is called
+    stop()
+        Stops the dispatcher
+    read_stats()
+        Returns a copy of the wake-up and latency counters
+    """
+    def __init__(self, page):
+        """
+        Constructor for Event_Dispatcher class
+
+        Parameters
+        ----------
+            page (function) : Returns the page currently shown
+        """
+        self.queue = queue.Queue()
+        self.page = page
+        self.actions = {}
+        self.hooks = {}
+        self.wantstop = False
+        self.startTime = time.monotonic()
+        self.stats = {'wakeups': 0, 'dispatched': 0, 'unbound': 0,
+                      'last_latency': 0.0, 'max_latency': 0.0, 'total_latency': 0.0}
+        self.dispatchLatency = REGISTRY.histogram("dispatch_latency_seconds", "Time between an event and its action")
+        REGISTRY.gauge("dispatch_queue_depth", "Events waiting for the dispatcher", lambda: self.queue.qsize())
+
+    def bind(self, page, key, action):
+        """Registers the action of a key on a page (every page when page is None)"""
+        self.actions[(page, key)] = action
+
+    def add_hook(self, kind, function):
+        """Registers a function called with every event of a kind before its action"""
+        self.hooks.setdefault(kind, []).append(function)
+
+    def post(self, kind, key, timestamp=None):
+        """Adds an event to the queue"""
+        self.queue.put((kind, key, timestamp if timestamp is not None else time.monotonic()))
+
+    def post_button(self, state, timestamp=None):
+        """Adds the events of a Button_Retreiver buttons configuration"""
+        for key, pressed in zip(BUTTON_KEYS, state):
+            if pressed:
+                self.post('button', key, timestamp)
+
+    def dispatch(self, event):
+        """Runs the hooks and the action of an event"""
+        kind, key, timestamp = event
+        for hook in self.hooks.get(kind, ()):
+            hook(event)
+
+        page = self.page()
+        action = self.actions.get((page, key), self.actions.get((None, key)))
+        if action is None:
+            self.stats['unbound'] += 1
+        else:
+            action()
+
+        latency = time.monotonic() - timestamp
+        self.stats['dispatched'] += 1
+        self.stats['last_latency'] = latency
+        self.stats['total_latency'] += latency
+        self.stats['max_latency'] = max(self.stats['max_latency'], latency)
+        self.dispatchLatency.observe(latency)
+
+    def run(self):
+        """Waits for the events and dispatches them until stop() is called"""
+        while not self.wantstop:
+            event = self.queue.get()
+            self.stats['wakeups'] += 1
+            if event[0] == 'stop':
+                break
+            try:
+                self.dispatch(event)
+            except Exception as e:
+                logger.error(e)
+
+    def stop(self):
+        """Stops the dispatcher"""
+        self.wantstop = True
+        self.post('stop', None)
+
+    def read_stats(self):
+        """Returns a copy of the wake-up and latency counters"""
+        stats = dict(self.stats)
+        elapsed = time.monotonic() - self.startTime
+        stats['wakeups_per_minute'] = stats['wakeups'] * 60 / elapsed if elapsed else 0.0
+        stats['mean_latency'] = stats['total_latency'] / stats['dispatched'] if stats['dispatched'] else 0.0
+        return stats
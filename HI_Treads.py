@@ -1,65 +1,141 @@
 # Modules importation
-from DB_Treads import DB_Tread
+from DB_Treads import DB_Tread, DEPARTURES_KEY
 import sys
+import bisect
 import threading
+import queue
 import time
-import RPi.GPIO as GPIO
-import datetime
+from hal import GPIO
 
-import socket
 import lcddriver
+from Templates import compile_pages
+from Scheduler import Tick_Scheduler, shared_timers
+from Metrics import REGISTRY
 import logging
 import tinytuya
 
 # Logger Init
 logger = logging.getLogger()
 
+# Menus of the LCDscreen, made of fixed text and {name:kind:width} fields
+# (a * between a stop and its countdown marks a scheduled time, not a real-time one,
+# a ! before the clock of the Meteo page marks a forecast that could not be refreshed)
+SCREEN_PAGES = [("Departures", [" Prch Passages {clock:clock:5}",
+                                "{label_0:str:8}{mark_0:str:1}{wait_0:countdown:11}",
+                                "{label_1:str:8}{mark_1:str:1}{wait_1:countdown:11}",
+                                "{label_2:str:8}{mark_2:str:1}{wait_2:countdown:11}"]),
+                ("Meteo", ["{sky:str:1}    Meteo    {stale:str:1}{clock:clock:5}",
+                           "Wind: {wind_spd:int:2}km/h {wind_dir:str:1} {wind_hdg:int:3}",
+                           "Clouds: {clds:int:2}% - Rn: {rain:int:2}",
+                           "{thermometer:str:1}: {t_real:int:2}/{t_ressent:int:2}C - {drop:str:1}: {hum:int:2}%"]),
+                ("Switches", [" Interrupteurs {clock:clock:5}",
+                              "{cursor_0:str:1}Impr 3d         {impr3d:onoff:3}",
+                              "{cursor_1:str:1}Main Bulb      {mainbulb:rstr:4}",
+                              "{cursor_2:str:1}"]),
+                ("Settings", ["  Parametres   {clock:clock:5}",
+                              "{cursor_0:str:1}Mode Nuit       {nightmode:onoff:3}",
+                              "{cursor_1:str:1}",
+                              "{cursor_2:str:1}"])]
+
+DISCONNECTED_PAGE = ["*------------------*",
+                     "|     Internet     |",
+                     "|   Disconnected   |",
+                     "*------------------*"]
+
+
+# Led patterns : duty cycles (%) played in equal steps over one period
+LED_PATTERNS = {'fade': tuple(range(0, 100, 10)) + tuple(range(100, 0, -10)),
+                'double_pulse': (100, 0, 100, 0, 0, 0, 0, 0, 0, 0)}
+# PWM frequency used to dim the led in the patterns
+LED_DIMMING_FREQUENCY = 200
+
 
 class Led():
     """
     Returns a Led Object
 
+    Blinking is done by the GPIO.PWM output (no Python code runs between two edges) and the patterns
+    only change its duty cycle a few times per period. A mode is only reconfigured when the (mode, option)
+    pair changes.
+
     Attributes
     ----------
     LED_1 : int
         Pin connected to the led
     mode : int
         Indicates the current mode for the led
-    option : float
+    option : float or tuple
         Indicates the current option for the led
-    timer : treading.Timer object
-        Timer which is used for the blinking mode
+    timers : Scheduler.Timer_Scheduler object
+        Timers thread which plays the patterns (and blinks the led without PWM)
+    timer : Scheduler.Timer_Handle object
+        Repeated timer of the current pattern or blinking (None when not used)
+    pwm : GPIO.PWM object
+        PWM output of the led pin (None when PWM is disabled)
+    pwmStarted : boolean
+        Indicates if the PWM output is running
+    pattern : tuple
+        Duty cycles of the current pattern
+    step : int
+        Index of the current duty cycle of the pattern
     blinkstate : int
         Indicates if the led is powered on or off
+    generation : int
+        Number of the current mode, the timer calls of a previous mode are ignored
+    lock : threading.RLock
+        Serialises the mode changes and the timer calls
 
     Methods
     -------
-    blink()
-        Blink function that works with a timer which is called after a specified number of seconds
+    blink(generation)
+        Blink function that is called every option seconds by the timers thread, when PWM is disabled
+    play(generation)
+        Applies the next duty cycle of the current pattern
     set(mode, option)
         Sets a new mode for the led with a specified mode and an associed option
+    start(mode, option)
+        Starts a mode that was checked by set
     cancel()
-        Cancels the timer to kill the Tread process
+        Stops the PWM output and the pattern or blinking timer
     """
-    def __init__(self, pin):
+    def __init__(self, pin, timers=None, pwm=True):
         GPIO.setmode(GPIO.BOARD)
         GPIO.setup(int(pin), GPIO.OUT)
         self.LED_1 = int(pin)
         self.mode = 0
-        self.lastmode = 0
         self.option = 0
-        self.lastoption = 0
-        self.timer = threading.Timer(self.option, self.blink)
+        self.timers = timers if timers is not None else shared_timers()
+        self.timer = None
+        self.pwm = GPIO.PWM(self.LED_1, LED_DIMMING_FREQUENCY) if pwm else None
+        self.pwmStarted = False
+        self.pattern = ()
+        self.step = 0
         self.blinkstate = 0
+        self.generation = 0
+        self.lock = threading.RLock()
         GPIO.output(self.LED_1, 0)
 
-    def blink(self):
-        """Blink function that works with a timer which is called after a specified number of seconds"""
-        self.blinkstate = (self.blinkstate + 1) % 2
-        GPIO.output(self.LED_1, self.blinkstate)
+    def blink(self, generation=None):
+        """Blink function that is called every option seconds by the timers thread, when PWM is disabled"""
+        with self.lock:
+            # A call from a timer of a previous mode, already running when it was cancelled, is ignored
+            if generation is not None and generation != self.generation:
+                return
+            self.blinkstate = (self.blinkstate + 1) % 2
+            GPIO.output(self.LED_1, self.blinkstate)
         logger.debug("Led state is : %s", self.blinkstate)
-        self.timer = threading.Timer(self.option, self.blink)
-        self.timer.start()
+
+    def play(self, generation=None):
+        """Applies the next duty cycle of the current pattern"""
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            duty = self.pattern[self.step]
+            self.step = (self.step + 1) % len(self.pattern)
+            if self.pwm is not None:
+                self.pwm.ChangeDutyCycle(duty)
+            else:
+                GPIO.output(self.LED_1, 1 if duty >= 50 else 0)
 
     def set(self, mode, option):
         """
@@ -70,47 +146,75 @@ class Led():
         mode (int) : Mode for controling the led
             -If mode == 0: Persistant state
             -If mode == 1: Blinking state
-        option (float or int) :
+            -If mode == 2: Pattern state
+        option (float or int or tuple) :
             -For Persistant state : 0 turn off // 1 turn on
-            -For Blink state : option is the period time of the blinking
+            -For Blink state : option is the time between two toggles of the blinking
+            -For Pattern state : option is a (name of LED_PATTERNS, period time) tuple
         """
-        self.mode = mode
-        self.option = option
+        # The led keeps running its current mode while the urgency level does not change
+        if (mode, option) == (self.mode, self.option):
+            return
+        if mode not in (0, 1, 2) or (mode == 1 and not option) or (mode == 2 and option[0] not in LED_PATTERNS):
+            logger.error("Led mode <%s> with option <%s> incorrect", mode, option)
+            return
+
+        with self.lock:
+            self.cancel()
+            self.mode = mode
+            self.option = option
+            self.start(mode, option)
+        logger.info("Led switched to mode : %s with option : %s", mode, option)
+
+    def start(self, mode, option):
+        """Starts a mode that was checked by set (called with the lock held)"""
 
         # Persistant mode
         if mode == 0:
-            self.cancel()
-            try:
-                if option != self.lastoption and mode != self.lastmode:
-                    GPIO.output(self.LED_1, int(option))
-                    logger.info("Led switched to mode : %s with option : %s", mode, option)
-                    self.lastmode = mode
-            except Exception:
-                print("Error: mode or/and option incorrect")
-        # Blinking mode
+            GPIO.output(self.LED_1, int(option))
+        # Blinking mode, a square signal of period 2 * option
         elif mode == 1:
-            if option != 0 and option != self.lastoption:
-                logger.info("Led switched to mode : %s with option : %s", mode, option)
-                self.lastoption = option
-                self.lastmode = mode
-                self.cancel()
+            if self.pwm is not None:
+                self.pwm.ChangeFrequency(1 / (2 * option))
+                self.pwm.start(50)
+                self.pwmStarted = True
+            else:
                 self.blink()
+                self.timer = self.timers.call_every(option, self.blink, self.generation)
+        # Pattern mode
+        elif mode == 2:
+            name, period = option
+            self.pattern = LED_PATTERNS[name]
+            self.step = 0
+            if self.pwm is not None:
+                self.pwm.ChangeFrequency(LED_DIMMING_FREQUENCY)
+                self.pwm.start(self.pattern[0])
+                self.pwmStarted = True
+            self.play()
+            self.timer = self.timers.call_every(period / len(self.pattern), self.play, self.generation)
 
     def cancel(self):
-        """Cancels the timer to kill the Tread process"""
-        self.timer.cancel()
+        """Stops the PWM output and the pattern or blinking timer"""
+        with self.lock:
+            self.generation += 1
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.pwmStarted:
+                self.pwm.stop()
+                self.pwmStarted = False
 
 
 class Button_Retreiver(threading.Thread):
     """
-    Returns a Led object
+    Returns a Button_Retreiver object that queues the buttons presses detected by GPIO edge interrupts
 
     Attributes
     ----------
-    Button_Buff : list
-        FIFO list that contains tuples of buttons configurations
-    updt_rate : float
-        Time between two update of buttons states in seconds
+    Button_Buff : queue.Queue
+        FIFO of (buttons configuration tuple, press time) presses
+    debounce : int
+        Minimum time between two presses of the same button in milliseconds
     wantstop : boolean
         Shows if the user or program wants to stop the current thread
     BT_UP : int
@@ -123,89 +227,159 @@ class Button_Retreiver(threading.Thread):
         Pin connected to RIGHT Button
     BT_OK : int
         Pin connected to OK Button
+    lastPressLatency : float
+        Time between the last read press and its edge in seconds
+    on_press : function
+        When given, called with (buttons configuration tuple, press time) instead of filling the FIFO
 
     Methods
     -------
     run()
-        Reserved function for the treading process
-    read()
-        Returns the First element and deletes it from the FIFO self.Button_Buff
+        Reserved function for the treading process, registers the edge callbacks
+    edge(pin)
+        GPIO callback called on the rising edge of a button pin
+    push(state, timestamp)
+        Adds a buttons configuration to the FIFO (or sends it to on_press)
+    read(timeout)
+        Returns the first buttons configuration of the FIFO, waiting up to timeout seconds
     stop()
         Stop the current tread
     """
-    def __init__(self, updt_rate=0.2, bt_up=38, bt_dw=31, bt_lf=37, bt_rg=36, bt_ok=33):
-        """Constructs all attributes and set GPIO pins"""
+    def __init__(self, updt_rate=0.2, bt_up=38, bt_dw=31, bt_lf=37, bt_rg=36, bt_ok=33, debounce=50, on_press=None):
+        """Constructs all attributes and set GPIO pins (updt_rate is kept for compatibility, presses are interrupt driven)"""
         threading.Thread.__init__(self)
-        self.Button_Buff = []
-        self.updt_rate = updt_rate
+        self.Button_Buff = queue.Queue()
+        self.debounce = int(debounce)
         self.wantstop = False
+        self.stopEvent = threading.Event()
+        self.lastPressLatency = 0.0
+        self.on_press = on_press
         self.BT_UP = int(bt_up)
         self.BT_DW = int(bt_dw)
         self.BT_LF = int(bt_lf)
         self.BT_RG = int(bt_rg)
         self.BT_OK = int(bt_ok)
+        self.pins = (self.BT_UP, self.BT_DW, self.BT_LF, self.BT_RG, self.BT_OK)
+        self.lastEdge = {pin: 0.0 for pin in self.pins}
 
         # Sets pins references to BOARD
         GPIO.setmode(GPIO.BOARD)
         GPIO.setwarnings(False)
 
         # Registers buttons pins as Input
-        GPIO.setup([self.BT_UP, self.BT_DW, self.BT_LF, self.BT_RG, self.BT_OK], GPIO.IN)
+        GPIO.setup(list(self.pins), GPIO.IN)
 
         logger.warning("Button_Retreiver Thread Initialised")
 
     def run(self):
-        """Reserved function for the treading process"""
+        """Reserved function for the treading process, registers the edge callbacks"""
         logger.warning("Button_Retreiver Thread Started")
-        lastElement = [(GPIO.input(self.BT_UP), GPIO.input(self.BT_DW),
-                        GPIO.input(self.BT_LF), GPIO.input(self.BT_RG),
-                        GPIO.input(self.BT_OK))]
-
-        while not self.wantstop:
-            act_Data = (GPIO.input(self.BT_UP), GPIO.input(self.BT_DW),
-                        GPIO.input(self.BT_LF), GPIO.input(self.BT_RG),
-                        GPIO.input(self.BT_OK))
-
-            # Adding the actual tuple of data in the FIFO
-            if (act_Data != lastElement and act_Data != (0, 0, 0, 0, 0)):
-                self.Button_Buff.append(act_Data)
-                logger.info("Button Pressed : %s", act_Data)
-            lastElement = act_Data
+        for pin in self.pins:
+            GPIO.add_event_detect(pin, GPIO.RISING, callback=self.edge, bouncetime=self.debounce)
+
+        # Nothing to do until the end, the presses are pushed by the GPIO callbacks
+        self.stopEvent.wait()
+        for pin in self.pins:
+            GPIO.remove_event_detect(pin)
+
+    def edge(self, pin):
+        """GPIO callback called on the rising edge of a button pin"""
+        now = time.monotonic()
+        # Software debounce, on top of the bouncetime of RPi.GPIO
+        if now - self.lastEdge[pin] < self.debounce / 1000:
+            return
+        self.lastEdge[pin] = now
+        state = tuple(int(pin == buttonPin) for buttonPin in self.pins)
+        self.push(state, now)
+        logger.info("Button Pressed : %s", state)
+
+    def push(self, state, timestamp=None):
+        """Adds a buttons configuration to the FIFO (or sends it to on_press)"""
+        timestamp = timestamp if timestamp is not None else time.monotonic()
+        if self.on_press is not None:
+            self.on_press(tuple(state), timestamp)
+        else:
+            self.Button_Buff.put((tuple(state), timestamp))
 
-            time.sleep(self.updt_rate)
+    def read(self, timeout=0):
+        """
+        Returns the first buttons configuration of the FIFO, waiting up to timeout seconds
 
-    def read(self):
-        """Returns the First element and deletes it from the FIFO self.Button_Buff"""
-        if self.Button_Buff:
-            recup_line = self.Button_Buff[0]
-            del self.Button_Buff[0]
+        Parameters
+        ----------
+        timeout (float or None) : 0 returns immediately, None waits for a press
 
-            return recup_line
-        else:
+        Returns
+        -------
+        tuple or None : (UP, DOWN, LEFT, RIGHT, OK) states, None if no button was pressed
+        """
+        try:
+            state, timestamp = self.Button_Buff.get(block=timeout != 0, timeout=timeout)
+        except queue.Empty:
             return None
+        self.lastPressLatency = time.monotonic() - timestamp
+        return state
 
     def stop(self):
         """Stops the current tread"""
         logger.warning("Button_Retreiver Thread Stopped")
         self.wantstop = True
+        self.stopEvent.set()
 
 
 class LCDscreen(threading.Thread):
     """
     Returns a LCD screen object that is capable of displays menus and information
 
+    The render thread is the only owner of the lcd, other threads only post messages
+    (mode changes, backlight changes, cursor moves, data updates) on its queue. The menu, cursor and
+    night mode requested by the input side are kept apart (requestedMode, requestedLine, requestedNightMode)
+    and posted as absolute values, so quick presses never act on a state the render thread has not applied yet.
+
     Attributes
     ----------
     lcd : lcddriver.object
         LCD screen object
     mode : int
         Indicates the current menu that is shown on the screen
+    pagesNumber : int
+        Number of menus that can be shown on the screen
+    selectedLine : int
+        Indicates the line selected by the cursor on the switches and settings menus
     wantstop : boolean
         Shows if the user or program want to stop the current thread
     DB_T : DB object
         The DB object used to retrieve autobus information stocked in mysql DB
+    CONNECT_T : Connectivity_Monitor object
+        Monitor whose cached link state selects the "Internet Disconnected" screen (None to ignore)
     nightMode_is_active : boolean
         Indicates if the night mode is active
+    requestedMode : int
+        Menu requested by the last input, read by the dispatcher to look up the actions
+    requestedLine : int
+        Line requested by the last cursor move
+    requestedNightMode : boolean
+        Night mode requested by the last input
+    requestLock : threading.Lock
+        Posts the requested values in the order they are computed
+    queue : queue.Queue
+        FIFO of (kind, value, posting time) messages handled by the render thread
+    ticker : Scheduler.Tick_Scheduler object
+        Wall-clock second ticks on which the frame is redrawn, with their drift and overrun statistics
+    latency : dict
+        Time between the posting of a message and the end of the frame showing it (seconds)
+    pages : list of Templates.Page_Template
+        Compiled menus, rebuilt only when one of their fields changes
+    shownPage : Templates.Page_Template
+        Menu currently drawn on the lcd (None when another frame is shown)
+    lastSecond : int
+        Time (epoch) of the last frame in seconds
+    departuresVersion : int
+        Version of the departures snapshot the timeline was built from
+    timeline : list
+        (label, epoch, realTime) of the departures of every stop, soonest first
+    timelineEpochs : list
+        Epochs of the timeline, searched for the first departure to come
 
     Methods
     -------
@@ -213,27 +387,72 @@ class LCDscreen(threading.Thread):
         Reserved function for the treading process
     stop()
         Stops the current tread
+    post(kind, value)
+        Posts a message to the render thread
+    handle(message)
+        Applies a message in the render thread
+    render(force)
+        Draws the current menu, when the time changed or when force is True
     set(mode)
         Changes the current menu or mode of the screen
+    shift_mode(delta)
+        Moves to the next (delta = 1) or previous (delta = -1) menu
+    move_cursor(delta)
+        Moves the selection cursor down (delta = 1) or up (delta = -1)
+    set_nightmode(state)
+        Activates or deactivates the night mode
+    refresh()
+        Asks for a redraw of the current menu (new data available)
     reset()
         Resets the lcd screen
+    show(rows)
+        Sends a full frame to the lcd, missing lines and columns are filled with blanks
+    next_departures(now)
+        Returns the (label, epoch, realTime) of the next departures of every stop, soonest first
+    page_values(now, departures)
+        Returns the field values of the current menu
     set_backlight()
         Sets the LCD backlight ON or OFF
+    record_latency(latency)
+        Adds a message-to-screen latency to the statistics
+    latency_stats()
+        Returns the message-to-screen latency statistics
     """
     def __init__(self, **kargs):
         """Constructs all attributes, initialised the lcd screen and shows splash screen"""
         threading.Thread.__init__(self)
 
         self.DB_T, self.LED_T, self.METEO_T, self.IMPR3D_GPIO, self.MAINBULB_TUYA = kargs['DB_object'], kargs['LED_object'], kargs['METEO_object'], kargs['IMPR3D_object'], kargs['MAINBULB_TUYA']
+        self.CONNECT_T = kargs.get('CONNECT_object')
 
         # Initialisation of the LCD screen
         self.lcd = lcddriver.lcd()
         self.lcd.lcd_clear()
         self.mode = 0
         self.selectedLine = 2
-        self.available = True
         self.wantstop = False
         self.nightMode_is_active = False
+        self.requestedMode = self.mode
+        self.requestedLine = self.selectedLine
+        self.requestedNightMode = self.nightMode_is_active
+        self.requestLock = threading.Lock()
+        self.queue = queue.Queue()
+        self.ticker = Tick_Scheduler()
+        self.pages = compile_pages(SCREEN_PAGES, lcddriver.LCD_COLS, lcddriver.LCD_ROWS)
+        self.pagesNumber = len(self.pages)
+        self.shownPage = None
+        self.lastSecond = 0
+        self.departuresVersion = None
+        self.timeline = []
+        self.timelineEpochs = []
+        self.latency = {'count': 0, 'last': 0.0, 'max': 0.0, 'total': 0.0}
+        self.renderTime = {page.name: REGISTRY.histogram("lcd_render_seconds", "Time of a frame render", page=page.name)
+                           for page in self.pages}
+        self.messageLatency = REGISTRY.histogram("lcd_message_to_frame_seconds",
+                                                 "Time between a message and the end of the frame showing it")
+        REGISTRY.gauge("lcd_queue_depth", "Messages waiting for the render thread", lambda: self.queue.qsize())
+        REGISTRY.counter("lcd_tick_overruns_total", "Second ticks missed by the render thread",
+                         lambda: self.ticker.stats['overruns'])
 
         # Shows the init screen
         self.lcd.lcd_display_string("*------------------*", 1)
@@ -243,113 +462,219 @@ class LCDscreen(threading.Thread):
 
     def run(self):
         """Reserved function for the treading process"""
-        timenow = datetime.datetime.now()
         while not self.wantstop:
+            # Blocks until a message arrives or the next second boundary
             try:
-                # Check internet connection
-                socket.setdefaulttimeout(1)
-                socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect(("8.8.8.8", 53))
-
-                if self.available is True:
-                    self.available = False
-
-                    # Concatenate Datas from the DB
-                    lasttimenow = timenow
-                    timenow = datetime.datetime.now()
-                    RawData = self.DB_T.read()
-                    if timenow.second != lasttimenow.second and RawData != []:
-                        datas = []
-                        timestr = "%02d:%02d" % (timenow.hour, timenow.minute)
-                        for line in RawData:
-                            deltaT = line[0] - timenow
-                            datas.append(str(str(deltaT).split(".")[0]).split(":"))
-
-                    # Retreive meteo data
-                    current_meteo = self.METEO_T.read()
-                    # Apply different senarios for the led
-                    if 7 < int(datas[0][1]) <= 10:
-                        self.LED_T.set(1, 1)
-                    elif 5 <= int(datas[0][1]) <= 7:
-                        self.LED_T.set(1, 0.5)
-                    elif 2 <= int(datas[0][1]) < 5:
-                        self.LED_T.set(1, 0.25)
-                    else:
-                        self.LED_T.set(0, 0)
-
-                    if self.mode == 0:
-                        if timenow.second != lasttimenow.second and RawData != []:
-                            self.lcd.lcd_display_string(" Prch Passages " + timestr, 1)
-                            for i, data in enumerate(datas, 2):
-                                self.lcd.lcd_display_string("79-Ramon %02dh %02dm %02ds" % (int(data[0]),
-                                                                                            int(data[1]),
-                                                                                            int(data[2])), i)
-                    # Second display mode
-                    elif self.mode == 1:
-                        if timenow.second != lasttimenow.second and RawData != []:
-                            self.lcd.lcd_display_string("     Meteo     " + timestr, 1)
-                            self.lcd.lcd_display_string("Wind: %02dkm/h - %02d" % (current_meteo['Wind_spd'],
-                                                                                   current_meteo['Wind_hdg']), 2)
-                            self.lcd.lcd_display_string("Clouds: %02d%% - Rn: %02d" % (current_meteo['Clds'],
-                                                                                       current_meteo['Rain']), 3)
-                            self.lcd.lcd_display_string("T: %02d/%02dC - H: %02d%%" % (current_meteo['T_real'],
-                                                                                       current_meteo['T_ressent'],
-                                                                                       current_meteo['Hum']), 4)
-                    elif self.mode == 2:
-                        self.lcd.lcd_display_string(" Interrupteurs " + timestr, 1)
-                        self.lcd.lcd_display_string(" Impr 3d         {}".format(" ON" if self.IMPR3D_GPIO.getState() else "OFF"), 2)
-                        self.lcd.lcd_display_string(" Main Bulb      {}".format(self.MAINBULB_TUYA.getState()), 3)
-                        self.lcd.lcd_display_string("                    ", 4)
-                        self.lcd.lcd_display_string(">", self.selectedLine + 2)
-                        time.sleep(0.2)
-                    elif self.mode == 3:
-                        self.lcd.lcd_display_string("  Parametres   " + timestr, 1)
-                        self.lcd.lcd_display_string(" Mode Nuit       {}".format(" ON" if self.nightMode_is_active else "OFF"), 2)
-                        self.lcd.lcd_display_string("                    ", 3)
-                        self.lcd.lcd_display_string("                    ", 4)
-                        self.lcd.lcd_display_string(">", self.selectedLine + 2)
-                        time.sleep(0.2)
-                    self.available = True
-            except socket.error as ex:
-                self.lcd.lcd_display_string("*------------------*", 1)
-                self.lcd.lcd_display_string("|     Internet     |", 2)
-                self.lcd.lcd_display_string("|   Disconnected   |", 3)
-                self.lcd.lcd_display_string("*------------------*", 4)
-            except OSError:
-                logger.error("I/O Error of the LCD screen")
-                self.available = True
-            except ValueError as e:
-                logger.error("Value Error as %s\n With FormDat as %s" % e)
-                self.available = True
-            except NameError as e:
-                logger.error("Name Error as %s" % (e))
-                self.available = True
-            time.sleep(0.2)
+                message = self.queue.get(timeout=self.ticker.timeout())
+            except queue.Empty:
+                message = None
+            ticked = self.ticker.tick() if message is None or self.ticker.timeout() == 0 else False
+
+            # Applies every pending message before drawing a single frame
+            posted = []
+            while message is not None:
+                self.handle(message)
+                posted.append(message[2])
+                try:
+                    message = self.queue.get_nowait()
+                except queue.Empty:
+                    message = None
+
+            if self.wantstop:
+                break
+            if not ticked and not posted:
+                continue
+            start = time.perf_counter()
+            self.render(force=bool(posted))
+            self.renderTime[self.pages[self.mode].name].observe(time.perf_counter() - start)
+
+            now = time.monotonic()
+            for timestamp in posted:
+                self.record_latency(now - timestamp)
+
+    def handle(self, message):
+        """Applies a message in the render thread"""
+        kind, value, timestamp = message
+        if kind == 'mode':
+            self.mode = value
+            logger.info("Screen switched to mode : %d", self.mode)
+            # The bulb state is only polled while the switches page is shown
+            self.MAINBULB_TUYA.set_active(self.mode == 2)
+        elif kind == 'cursor':
+            self.selectedLine = value
+        elif kind == 'backlight':
+            self.lcd.lcd_backlight(value)
+        elif kind == 'nightmode':
+            self.nightMode_is_active = value
+        elif kind == 'reset':
+            self.lcd = lcddriver.lcd()
+            self.lcd.lcd_clear()
+            self.shownPage = None
+
+    def render(self, force=False):
+        """Draws the current menu, when the time changed or when force is True"""
+        try:
+            now = int(time.time())
+            if now == self.lastSecond and not force:
+                return
+            self.lastSecond = now
+
+            departures = self.next_departures(now)
+            # Cached internet link state, the departures page stays shown with the offline timetable
+            if self.CONNECT_T is not None and not self.CONNECT_T.is_online() and not (self.mode == 0 and departures):
+                # No departure is shown, the led must not keep announcing one
+                self.LED_T.set(0, 0)
+                self.show(DISCONNECTED_PAGE)
+                self.shownPage = None
+                return
+
+            # Apply different senarios for the led
+            if departures:
+                minutes = (departures[0][1] - now) // 60
+                if 7 < minutes <= 10:
+                    self.LED_T.set(2, ('fade', 2))
+                elif 5 <= minutes <= 7:
+                    self.LED_T.set(1, 0.5)
+                elif 2 <= minutes < 5:
+                    self.LED_T.set(2, ('double_pulse', 1))
+                else:
+                    self.LED_T.set(0, 0)
+            else:
+                self.LED_T.set(0, 0)
+
+            # The frame is only sent when a field changed or another menu was shown
+            page = self.pages[self.mode]
+            self.lcd.lcd_new_frame()
+            rows, changed = page.render(self.page_values(now, departures))
+            if changed or page is not self.shownPage:
+                self.lcd.lcd_display_frame(rows)
+                self.shownPage = page
+        except OSError:
+            logger.error("I/O Error of the LCD screen")
+            # The panel content is unknown, the next frame must be fully redrawn
+            self.lcd.lcd_invalidate()
+            self.shownPage = None
+        except ValueError as e:
+            logger.error("Value Error as %s", e)
+        except NameError as e:
+            logger.error("Name Error as %s" % (e))
+        except KeyError as e:
+            logger.error("Missing data : %s", e)
+
+    def show(self, rows):
+        """Sends a full frame to the lcd, missing lines and columns are filled with blanks"""
+        rows = list(rows) + [""] * (lcddriver.LCD_ROWS - len(rows))
+        self.lcd.lcd_display_frame([row.ljust(lcddriver.LCD_COLS) for row in rows])
+
+    def next_departures(self, now):
+        """Returns the (label, epoch, realTime) of the next departures of every stop, soonest first"""
+        # The stops are only merged again when a new snapshot was published
+        snapshot = self.DB_T.state.get(DEPARTURES_KEY)
+        if snapshot.version != self.departuresVersion:
+            timeline = []
+            for stop, stopData in (snapshot.value or {}).items():
+                label = stop.replace("_", "-")[:8]
+                timeline.extend((label, departure.epoch, departure.realTime) for departure in stopData)
+            timeline.sort(key=lambda departure: departure[1])
+            self.timeline = timeline
+            self.timelineEpochs = [departure[1] for departure in timeline]
+            self.departuresVersion = snapshot.version
+        first = bisect.bisect_left(self.timelineEpochs, now)
+        return self.timeline[first:first + lcddriver.LCD_ROWS - 1]
+
+    def page_values(self, now, departures):
+        """Returns the field values of the current menu"""
+        values = {'clock': now}
+        if self.mode == 0:
+            for i, (label, epoch, realTime) in enumerate(departures):
+                values['label_%d' % i] = label
+                values['mark_%d' % i] = " " if realTime else "*"
+                values['wait_%d' % i] = epoch - now
+        elif self.mode == 1:
+            current_meteo = self.METEO_T.read()
+            values.update(wind_spd=current_meteo.get('Wind_spd'), wind_hdg=current_meteo.get('Wind_hdg'),
+                          clds=current_meteo.get('Clds'), rain=current_meteo.get('Rain'),
+                          t_real=current_meteo.get('T_real'), t_ressent=current_meteo.get('T_ressent'),
+                          hum=current_meteo.get('Hum'))
+            if current_meteo:
+                # Icons are CGRAM glyphs, only uploaded when they are not resident
+                if current_meteo['Rain']:
+                    sky = 'rain'
+                elif current_meteo['Clds'] >= 50:
+                    sky = 'cloud'
+                else:
+                    sky = 'sun'
+                # The arrow points where the wind blows to, the heading is where it comes from
+                arrow = int((current_meteo['Wind_hdg'] + 180 + 22.5) // 45) % 8
+                values.update(sky=self.lcd.lcd_glyph(sky), wind_dir=self.lcd.lcd_glyph('arrow_%d' % arrow),
+                              thermometer=self.lcd.lcd_glyph('thermometer'), drop=self.lcd.lcd_glyph('drop'))
+                # A refresh running late is not marked, only a forecast older than a failed retry
+                values['stale'] = "!" if self.METEO_T.is_stale(self.METEO_T.retry_rate) else " "
+        else:
+            for i in range(3):
+                values['cursor_%d' % i] = ">" if i == self.selectedLine else " "
+            values.update(impr3d=self.IMPR3D_GPIO.getState(), mainbulb=self.MAINBULB_TUYA.getState(),
+                          nightmode=self.nightMode_is_active)
+        return values
+
+    def record_latency(self, latency):
+        """Adds a message-to-screen latency to the statistics"""
+        self.latency['count'] += 1
+        self.latency['last'] = latency
+        self.latency['total'] += latency
+        self.latency['max'] = max(self.latency['max'], latency)
+        self.messageLatency.observe(latency)
+
+    def latency_stats(self):
+        """Returns the message-to-screen latency statistics"""
+        stats = dict(self.latency)
+        stats['mean'] = stats['total'] / stats['count'] if stats['count'] else 0.0
+        return stats
+
+    def post(self, kind, value=None):
+        """Posts a message to the render thread"""
+        self.queue.put((kind, value, time.monotonic()))
 
     def stop(self):
         """Stops the current tread"""
         self.wantstop = True
+        self.post('stop')
 
     def set(self, mode):
         """Changes the current menu or mode of the screen"""
-        while self.available is False:
-            pass
-        self.available = False
-        self.reset()
-        self.mode = mode
-        logger.info("Screen switched to mode : %d", mode)
-        self.available = True
+        with self.requestLock:
+            self.requestedMode = mode % self.pagesNumber
+            self.post('mode', self.requestedMode)
+
+    def shift_mode(self, delta):
+        """Moves to the next (delta = 1) or previous (delta = -1) menu"""
+        with self.requestLock:
+            self.requestedMode = (self.requestedMode + delta) % self.pagesNumber
+            self.post('mode', self.requestedMode)
+
+    def move_cursor(self, delta):
+        """Moves the selection cursor down (delta = 1) or up (delta = -1)"""
+        with self.requestLock:
+            self.requestedLine = (self.requestedLine + delta) % 3
+            self.post('cursor', self.requestedLine)
+
+    def set_nightmode(self, state):
+        """Activates or deactivates the night mode"""
+        with self.requestLock:
+            self.requestedNightMode = state
+            self.post('nightmode', state)
+
+    def refresh(self):
+        """Asks for a redraw of the current menu (new data available)"""
+        self.post('refresh')
 
     def reset(self):
         """Resets the lcd screen"""
-        self.lcd = lcddriver.lcd()
-        self.lcd.lcd_clear()
+        self.post('reset')
 
     def set_backlight(self, state):
-        while self.available is False:
-            pass
-        self.available = False
-        self.lcd.lcd_backlight(state)
-        self.available = True
+        """Sets the LCD backlight ON or OFF"""
+        self.post('backlight', state)
 
 
 class GPIO_device():
@@ -385,10 +710,13 @@ class GPIO_device():
         logger.info("GPIO device <%s> switched to %s", self.name, state)
 
 
-class TuyaBulb_device():
+class TuyaBulb_device(threading.Thread):
     '''
     Return a TuyaBulb_device that is capable to use tinytuya package and configure it
 
+    The device is only accessed by its own thread, which keeps a persistent socket, polls the state while
+    the device is shown and sends the toggle commands. getState() only reads the cached state.
+
     Attributes
     ----------
     device_id : str
@@ -405,45 +733,126 @@ class TuyaBulb_device():
         Store the result of device.status() function
     device : tinytuya.BulbDevice.object
         BulbDevice object from tinytuya package
+    ttl : float
+        Time after which the cached state is refreshed while the device is shown in seconds
+    state : str
+        Cached state shown on the screen
+    stateTime : float
+        Time (time.monotonic) of the last status received
+    active : boolean
+        Indicates if a page showing the device is visible (the state is only polled while True)
+    commands : queue.Queue
+        Commands sent to the device thread
+    on_change : function
+        Called without argument when the cached state changes
     Methods
     -------
+    run()
+        Reserved function for the treading process
+    refresh()
+        Retreives the state of the bulb and updates the cache (device thread only)
+    set_cache(state)
+        Updates the cached state and tells on_change when it changed
+    set_active(active)
+        Starts or stops the polling of the state
     toggle()
         Toogle the bulb according with the last retreived status
     getState()
-        Change the state of the GPIO device
+        Returns the cached state of the bulb
+    stop()
+        Stops the current tread
     '''
-    def __init__(self, device_id, device_ip, device_key, name, device_version=3.3):
+    def __init__(self, device_id, device_ip, device_key, name, device_version=3.3, ttl=5, device=None):
+        threading.Thread.__init__(self, name="Tuya " + name, daemon=True)
         self.device_id = device_id
         self.device_ip = device_ip
         self.device_key = device_key
         self.name = name
         self.device_version = device_version
+        self.ttl = float(ttl)
+        self.powerStatus = None
+        self.rawStatus = {}
+        self.state = '????'
+        self.stateTime = 0.0
+        self.active = False
+        self.wantstop = False
+        self.commands = queue.Queue()
+        self.on_change = None
 
-        self.device = tinytuya.BulbDevice(device_id, device_ip, device_key)
-        self.device.set_version(device_version)
-        self.device.set_socketTimeout(0.2)
-        self.device.set_socketRetryLimit(1)
+        if device is None:
+            device = tinytuya.BulbDevice(device_id, device_ip, device_key)
+            device.set_version(device_version)
+            device.set_socketTimeout(0.2)
+            device.set_socketRetryLimit(1)
+            device.set_socketPersistent(True)
+        self.device = device
 
-    def getState(self):
-        self.rawStatus = self.device.status()
+    def run(self):
+        """Reserved function for the treading process"""
+        while not self.wantstop:
+            # Sleeps until a command arrives, or until the cache expires while the device is shown
+            timeout = max(0, self.stateTime + self.ttl - time.monotonic()) if self.active else None
+            try:
+                command = self.commands.get(timeout=timeout)
+            except queue.Empty:
+                command = 'refresh'
+            try:
+                if command == 'on':
+                    self.device.turn_on()
+                elif command == 'off':
+                    self.device.turn_off()
+                elif command == 'stop':
+                    break
+                self.refresh()
+            except Exception as e:
+                logger.error("Tuya device <%s> error : %s", self.name, e)
+                self.stateTime = time.monotonic()
+
+    def refresh(self):
+        """Retreives the state of the bulb and updates the cache (device thread only)"""
+        self.rawStatus = self.device.status() or {}
         if self.rawStatus.get('Error', False) == 'Network Error: Device Unreachable':
-            return 'DISC'
+            state = 'DISC'
         elif self.rawStatus.get('dps', {}).get('1') is True:
             self.powerStatus = True
-            return '  ON'
-        elif self.rawStatus.get('dps', None).get('1') is False:
+            state = '  ON'
+        elif self.rawStatus.get('dps', {}).get('1') is False:
             self.powerStatus = False
-            return ' OFF'
+            state = ' OFF'
         else:
             self.powerStatus = None
-            return '????'
+            state = '????'
+        self.stateTime = time.monotonic()
+        self.set_cache(state)
+
+    def set_cache(self, state):
+        """Updates the cached state and tells on_change when it changed"""
+        changed = state != self.state
+        self.state = state
+        if changed and self.on_change is not None:
+            self.on_change()
+
+    def set_active(self, active):
+        """Starts or stops the polling of the state"""
+        if active and not self.active:
+            self.commands.put('refresh')
+        self.active = active
+
+    def getState(self):
+        """Returns the cached state of the bulb"""
+        return self.state
 
     def toggle(self):
         """Toogle the bulb according with the last retreived status"""
-        if self.powerStatus is True:
-            self.device.turn_off()
-        elif self.powerStatus is False:
-            self.device.turn_on()
-        else:
-            pass
-        logger.info("Tuya device <%s> switched to %s", self.name, not self.powerStatus)
\ No newline at end of file
+        if self.powerStatus is None:
+            return
+        # Optimistic update, confirmed by the status read after the command
+        self.powerStatus = not self.powerStatus
+        self.commands.put('on' if self.powerStatus else 'off')
+        self.set_cache('  ON' if self.powerStatus else ' OFF')
+        logger.info("Tuya device <%s> switched to %s", self.name, self.powerStatus)
+
+    def stop(self):
+        """Stops the current tread"""
+        self.wantstop = True
+        self.commands.put('stop')
@@ -0,0 +1,223 @@
+# Modules importation
+import os
+import threading
+import datetime
+import sqlite3
+import time
+import logging
+
+# Logger Init
+logger = logging.getLogger()
+
+CREATE_HISTORY = ("CREATE TABLE IF NOT EXISTS departures ("
+                  "stop TEXT NOT NULL, line TEXT, destination TEXT, "
+                  "scheduled INTEGER, predicted INTEGER NOT NULL, "
+                  "first_seen INTEGER NOT NULL, last_seen INTEGER NOT NULL, "
+                  "realtime INTEGER NOT NULL, observations INTEGER NOT NULL)")
+CREATE_HISTORY_INDEX = ("CREATE INDEX IF NOT EXISTS departures_stop_predicted "
+                        "ON departures (stop, predicted, scheduled, realtime)")
+INSERT_HISTORY = "INSERT INTO departures VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+
+class Departure_History():
+    """
+    Returns a Departure_History object that appends each observed departure once to monthly SQLite files
+
+    A departure is followed across the polls while it is announced, and written when it leaves the feed,
+    so rows are never updated. Times are stored as epoch seconds.
+
+    Attributes
+    ----------
+    directory : str
+        Directory of the monthly departures-YYYY-MM.sqlite files
+    batch_size : int
+        Number of finished departures buffered before a write
+    flush_interval : float
+        Maximum time a finished departure stays in the buffer in seconds
+    match_window : float
+        Maximum shift of the announced time of a departure between two polls in seconds
+    expiry : float
+        Time after which a departure no longer announced is written even if it is not due in seconds
+    tracked : dict
+        Departures currently announced, for each stop
+    buffer : list
+        Finished departures waiting to be written
+
+    Methods
+    -------
+    observe(stop, departures, now)
+        Updates the followed departures of a stop with the departures of a poll
+    flush()
+        Writes the buffered departures, one transaction per monthly file
+    punctuality(stop, start, end)
+        Returns delay and real-time statistics of the departures announced between start and end
+    close()
+        Writes every followed and buffered departure
+    """
+    def __init__(self, directory="history", batch_size=50, flush_interval=300, match_window=600, expiry=7200):
+        """
+        Constructor for Departure_History class
+
+        Parameters
+        ----------
+            directory (str) : Directory of the monthly SQLite files
+            batch_size (int) : Number of finished departures buffered before a write
+            flush_interval (float) : Maximum time a finished departure stays in the buffer in seconds
+            match_window (float) : Maximum shift of the announced time of a departure between two polls in seconds
+            expiry (float) : Time after which a departure no longer announced is written anyway in seconds
+        """
+        self.directory = directory
+        self.batch_size = int(batch_size)
+        self.flush_interval = float(flush_interval)
+        self.match_window = float(match_window)
+        self.expiry = float(expiry)
+        self.tracked = {}
+        self.buffer = []
+        self.lastFlush = time.monotonic()
+        self.lock = threading.Lock()
+        self.connections = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def partition(self, month):
+        """Returns the connection to the file of a "YYYY-MM" month, created if needed"""
+        db = self.connections.get(month)
+        if db is None:
+            db = sqlite3.connect(os.path.join(self.directory, "departures-%s.sqlite" % month),
+                                 check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(CREATE_HISTORY)
+            db.execute(CREATE_HISTORY_INDEX)
+            self.connections[month] = db
+        return db
+
+    def months(self, start, end):
+        """Returns the existing "YYYY-MM" partitions between two epoch times"""
+        months = []
+        day = datetime.date.fromtimestamp(start).replace(day=1)
+        last = datetime.date.fromtimestamp(end)
+        while day <= last:
+            month = day.strftime("%Y-%m")
+            if month in self.connections or os.path.exists(os.path.join(self.directory,
+                                                                          "departures-%s.sqlite" % month)):
+                months.append(month)
+            day = (day + datetime.timedelta(days=32)).replace(day=1)
+        return months
+
+    def observe(self, stop, departures, now=None):
+        """Updates the followed departures of a stop with the departures of a poll"""
+        now = int(now if now is not None else time.time())
+        with self.lock:
+            tracked = self.tracked.setdefault(stop, [])
+            matched = set()
+            for departure in departures:
+                predicted = departure.epoch
+                # Follows the closest departure of the same line and destination
+                best = None
+                for i, entry in enumerate(tracked):
+                    if i in matched or (entry['line'], entry['destination']) != (departure.line, departure.destination):
+                        continue
+                    shift = abs(entry['predicted'] - predicted)
+                    if shift <= self.match_window and (best is None or shift < abs(tracked[best]['predicted'] - predicted)):
+                        best = i
+                if best is None:
+                    tracked.append({'line': departure.line, 'destination': departure.destination,
+                                    'scheduled': None, 'predicted': predicted, 'first_seen': now,
+                                    'last_seen': now, 'realtime': departure.realTime, 'observations': 0})
+                    best = len(tracked) - 1
+                entry = tracked[best]
+                matched.add(best)
+                entry['predicted'] = predicted
+                entry['last_seen'] = now
+                entry['realtime'] = departure.realTime
+                entry['observations'] += 1
+                # Without real time the announced time is the timetable one
+                if not departure.realTime and entry['scheduled'] is None:
+                    entry['scheduled'] = predicted
+
+            # Departures no longer announced are finished once due (or expired)
+            stillTracked = []
+            for i, entry in enumerate(tracked):
+                if i in matched or (entry['predicted'] > now and now - entry['last_seen'] < self.expiry):
+                    stillTracked.append(entry)
+                else:
+                    self.buffer.append((stop, entry))
+            self.tracked[stop] = stillTracked
+
+        if len(self.buffer) >= self.batch_size or time.monotonic() - self.lastFlush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered departures, one transaction per monthly file"""
+        with self.lock:
+            buffer, self.buffer = self.buffer, []
+            self.lastFlush = time.monotonic()
+            if not buffer:
+                return
+            partitions = {}
+            for stop, entry in buffer:
+                month = datetime.datetime.fromtimestamp(entry['predicted']).strftime("%Y-%m")
+                partitions.setdefault(month, []).append((stop, entry['line'], entry['destination'],
+                                                         entry['scheduled'], entry['predicted'],
+                                                         entry['first_seen'], entry['last_seen'],
+                                                         int(entry['realtime']), entry['observations']))
+            try:
+                for month, rows in partitions.items():
+                    db = self.partition(month)
+                    with db:
+                        db.executemany(INSERT_HISTORY, rows)
+                logger.info("%d departures added to the history", len(buffer))
+            except sqlite3.Error as details:
+                logger.error("Error While Writing the History : %s", details)
+
+    def punctuality(self, stop=None, start=None, end=None):
+        """
+        Returns delay and real-time statistics of the departures announced between start and end
+
+        Parameters
+        ----------
+            stop (str) : Stop name (every stop when None)
+            start (float or datetime) : Beginning of the period (30 days before end when None)
+            end (float or datetime) : End of the period (now when None)
+
+        Returns
+        -------
+            dict : departures, realtime ratio, number of delays known, mean, median and 90th percentile
+                   delay (predicted - scheduled) in seconds
+        """
+        self.flush()
+        end = end.timestamp() if isinstance(end, datetime.datetime) else (end if end is not None else time.time())
+        start = start.timestamp() if isinstance(start, datetime.datetime) else (start if start is not None
+                                                                              else end - 30 * 86400)
+        condition = "predicted BETWEEN ? AND ?" + (" AND stop = ?" if stop is not None else "")
+        parameters = (int(start), int(end)) + ((stop,) if stop is not None else ())
+
+        departures, realtime, delays = 0, 0, []
+        with self.lock:
+            for month in self.months(start, end):
+                db = self.partition(month)
+                count, realtimeCount = db.execute("SELECT COUNT(*), TOTAL(realtime) FROM departures WHERE " +
+                                                  condition, parameters).fetchone()
+                departures += count
+                realtime += int(realtimeCount)
+                delays.extend(row[0] for row in db.execute("SELECT predicted - scheduled FROM departures WHERE " +
+                                                           condition + " AND scheduled IS NOT NULL", parameters))
+        delays.sort()
+        return {'departures': departures,
+                'realtime_ratio': realtime / departures if departures else 0.0,
+                'delays': len(delays),
+                'mean_delay': sum(delays) / len(delays) if delays else 0.0,
+                'median_delay': delays[len(delays) // 2] if delays else 0,
+                'p90_delay': delays[int(len(delays) * 0.9)] if delays else 0}
+
+    def close(self):
+        """Writes every followed and buffered departure"""
+        with self.lock:
+            for stop, tracked in self.tracked.items():
+                self.buffer.extend((stop, entry) for entry in tracked)
+            self.tracked = {}
+        self.flush()
+        with self.lock:
+            for db in self.connections.values():
+                db.close()
+            self.connections = {}
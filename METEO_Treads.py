@@ -1,7 +1,10 @@
 # Modules importation
+import os
+import json
 import time
-import threading
 import logging
+import requests
+from Scheduler import shared_timers
 from datetime import datetime
 from meteofrance_api import MeteoFranceClient
 from meteofrance_api.model import Place
@@ -12,44 +15,170 @@ logger = logging.getLogger()
 
 class METEO_Tread():
     """
-    Return a METEO_Tread object
+    Return a METEO_Tread object that serves the last forecast and refreshes it in the background
+
+    The last forecast is saved on disk, so the weather is available as soon as the object is built, and
+    read() keeps returning it while a refresh is running or failing (stale-while-revalidate).
 
     Attributes
     ----------
+    updt_rate : float
+        Time after which the forecast is refreshed in seconds
+    retry_rate : float
+        Time between two refresh attempts after a failure in seconds
+    latitude : float
+        Latitude of the forecast location
+    longitude : float
+        Longitude of the forecast location
+    cache_file : str
+        JSON file storing the last forecast (None to disable the cache)
+    client : MeteoFranceClient object
+        Client of the Meteo France API
+    currentmeteo : dict
+        Last forecast
+    updated : float
+        Time (epoch) of the last forecast, 0 if none
+    firstDataDelay : float
+        Time between the creation of the object and the first forecast available in seconds (None before)
+    connectivity : Connectivity_Monitor object
+        Monitor told about the requests that reached or failed to reach the API (None to disable)
+    timers : Scheduler.Timer_Scheduler object
+        Timers thread which runs the refreshes (on its worker, as they block on the network)
+    timer : Scheduler.Timer_Handle object
+        Timer of the next refresh
 
     Methods
     -------
-
-
+    start()
+        Schedules the first refresh, at once if the cached forecast is stale
+    schedule(delay)
+        Schedules the next refresh in delay seconds
+    refresh()
+        Retreives a new forecast and schedules the next refresh
+    read()
+        Returns the last forecast, even if stale
+    is_stale(margin)
+        Indicates if the forecast is older than the refresh period plus margin seconds
+    retreiveAndExtract()
+        Retreives a new forecast and saves it in the cache
+    set_meteo(meteo, updated)
+        Replaces the forecast
+    load_cache()
+        Loads the last forecast saved on disk
+    save_cache()
+        Saves the forecast on disk
+    stop()
+        Cancels the next refresh
     """
-    def __init__(self, updt_rate=300):
-        self.updt_rate = updt_rate
-        self.client = MeteoFranceClient()
+    def __init__(self, updt_rate=300, connectivity=None, latitude=43.534240, longitude=1.518130,
+                 cache_file="meteo_cache.json", retry_rate=60, client=None, timers=None):
+        self.bootTime = time.monotonic()
+        self.firstDataDelay = None
+        self.updt_rate = float(updt_rate)
+        self.retry_rate = float(retry_rate)
+        self.latitude = float(latitude)
+        self.longitude = float(longitude)
+        self.cache_file = cache_file
+        self.connectivity = connectivity
+        self.client = client if client is not None else MeteoFranceClient()
         self.currentmeteo = {}
-        self.retreiveAndExtract()
+        self.updated = 0
+        self.timers = timers if timers is not None else shared_timers()
+        self.timer = None
+        self.wantstop = False
+        self.load_cache()
+
+    def start(self):
+        """Schedules the first refresh, at once if the cached forecast is stale"""
+        self.schedule(0.0 if self.is_stale() else self.updated + self.updt_rate - time.time())
+
+    def schedule(self, delay):
+        """Schedules the next refresh in delay seconds"""
+        if not self.wantstop:
+            self.timer = self.timers.call_later(delay, self.refresh, blocking=True)
+
+    def refresh(self):
+        """Retreives a new forecast and schedules the next refresh"""
+        try:
+            self.retreiveAndExtract()
+            delay = self.updt_rate
+        except Exception as e:
+            logger.error("Meteo data not retreived : %s", e)
+            delay = self.retry_rate
+        self.schedule(delay)
 
     def read(self):
+        """Returns the last forecast, even if stale"""
         return self.currentmeteo
 
+    def is_stale(self, margin=0):
+        """Indicates if the forecast is older than the refresh period plus margin seconds"""
+        return time.time() - self.updated > self.updt_rate + margin
+
     def retreiveAndExtract(self):
-        rawDatas = self.client.get_forecast(latitude=43.534240, longitude=1.518130)
-        self.timer = threading.Timer(self.updt_rate, self.retreiveAndExtract)
-        self.timer.start()
-        self.currentmeteo = {'T_real': round(rawDatas.current_forecast["T"]["value"]),
-                             'T_ressent': rawDatas.current_forecast["T"]["windchill"],
-                             'Hum': round(rawDatas.current_forecast["humidity"]),
-                             'Wind_spd': rawDatas.current_forecast["wind"]["speed"],
-                             'Wind_hdg': rawDatas.current_forecast["wind"]["direction"],
-                             'Clds': rawDatas.current_forecast["clouds"],
-                             'Rain': rawDatas.current_forecast["rain"]["1h"]}
+        """Retreives a new forecast and saves it in the cache"""
+        try:
+            rawDatas = self.client.get_forecast(latitude=self.latitude, longitude=self.longitude)
+        except (requests.ConnectionError, requests.Timeout):
+            if self.connectivity is not None:
+                self.connectivity.report("Meteo France API", False)
+            raise
+        if self.connectivity is not None:
+            self.connectivity.report("Meteo France API", True)
+        self.set_meteo({'T_real': round(rawDatas.current_forecast["T"]["value"]),
+                        'T_ressent': rawDatas.current_forecast["T"]["windchill"],
+                        'Hum': round(rawDatas.current_forecast["humidity"]),
+                        'Wind_spd': rawDatas.current_forecast["wind"]["speed"],
+                        'Wind_hdg': rawDatas.current_forecast["wind"]["direction"],
+                        'Clds': rawDatas.current_forecast["clouds"],
+                        'Rain': rawDatas.current_forecast["rain"]["1h"]}, time.time())
+        self.save_cache()
         logger.info("New meteo data retreived !")
 
+    def set_meteo(self, meteo, updated):
+        """Replaces the forecast"""
+        self.currentmeteo = meteo
+        self.updated = updated
+        if self.firstDataDelay is None:
+            self.firstDataDelay = time.monotonic() - self.bootTime
+            logger.info("First meteo data available %.3f s after start", self.firstDataDelay)
+
+    def load_cache(self):
+        """Loads the last forecast saved on disk"""
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file) as cache:
+                saved = json.load(cache)
+            # A forecast of another location is not used
+            if (saved['latitude'], saved['longitude']) == (self.latitude, self.longitude):
+                self.set_meteo(saved['meteo'], saved['time'])
+        except (OSError, ValueError, KeyError) as e:
+            logger.error("Meteo cache not loaded : %s", e)
+
+    def save_cache(self):
+        """Saves the forecast on disk"""
+        if self.cache_file is None:
+            return
+        try:
+            # Written aside then renamed, so a power cut never leaves a partial file
+            with open(self.cache_file + ".tmp", 'w') as cache:
+                json.dump({'time': self.updated, 'latitude': self.latitude, 'longitude': self.longitude,
+                           'meteo': self.currentmeteo}, cache)
+            os.replace(self.cache_file + ".tmp", self.cache_file)
+        except OSError as e:
+            logger.error("Meteo cache not saved : %s", e)
+
     def stop(self):
-        self.timer.cancel()
+        """Cancels the next refresh"""
+        self.wantstop = True
+        if self.timer is not None:
+            self.timer.cancel()
 
 
 if __name__ == "__main__":
     met = METEO_Tread()
+    met.start()
     while True:
         print(met.read())
         time.sleep(2)
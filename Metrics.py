@@ -0,0 +1,307 @@
+# Modules importation
+import os
+import json
+import bisect
+import threading
+import time
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Logger Init
+logger = logging.getLogger()
+
+# Default histogram buckets, from 100 us to 10 s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(labels, extra=()):
+    """Returns the {name="value",...} text of Prometheus labels"""
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + "}"
+
+
+def format_value(value):
+    """Returns the Prometheus text of a number"""
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter():
+    """Returns a Counter object, a value that only goes up, read from function when one is given"""
+    kind = 'counter'
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """Adds amount to the counter"""
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        """Returns the (name, labels text, value) samples of the metric"""
+        return read_samples(self, name, labels)
+
+
+class Gauge():
+    """Returns a Gauge object, a value that goes up and down, read from function when one is given"""
+    kind = 'gauge'
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        """Sets the gauge"""
+        self.value = value
+
+    def samples(self, name, labels):
+        """Returns the (name, labels text, value) samples of the metric"""
+        return read_samples(self, name, labels)
+
+
+def read_samples(metric, name, labels):
+    """Returns the sample of a counter or gauge, read from its function when it has one"""
+    value = metric.value
+    if metric.function is not None:
+        try:
+            value = metric.function()
+        except Exception as e:
+            logger.error("Metric %s not read : %s", name, e)
+            return []
+    return [(name, format_labels(labels), value)]
+
+
+class Histogram():
+    """Returns a Histogram object counting the observed values in cumulative buckets"""
+    kind = 'histogram'
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        """Adds a value to the histogram"""
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """Returns a context manager observing the duration of its block"""
+        return Histogram_Timer(self)
+
+    def samples(self, name, labels):
+        """Returns the (name, labels text, value) samples of the metric"""
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        samples = []
+        cumulative = 0
+        for bound, bucketCount in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucketCount
+            samples.append((name + "_bucket", format_labels(labels, [('le', format_value(float(bound)))]), cumulative))
+        samples.append((name + "_sum", format_labels(labels), total))
+        samples.append((name + "_count", format_labels(labels), count))
+        return samples
+
+
+class Histogram_Timer():
+    """Context manager observing the duration of its block in a histogram"""
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Metrics_Registry():
+    """
+    Returns a Metrics_Registry object holding the counters, gauges and histograms of the program
+
+    A metric is created on first use and then returned by the following calls with the same name and
+    labels, so the instrumented code keeps a reference and only pays an addition (and a lock) per update.
+
+    Attributes
+    ----------
+    metrics : dict
+        Metric of each (name, labels)
+    help : dict
+        (type, description) of each metric name
+    lock : threading.Lock
+        Protects the creation of the metrics
+
+    Methods
+    -------
+    counter(name, description, function, **labels)
+        Returns the counter of a name and labels, read from function when one is given
+    gauge(name, description, function, **labels)
+        Returns the gauge of a name and labels, read from function when one is given
+    histogram(name, description, buckets, **labels)
+        Returns the histogram of a name and labels
+    exposition()
+        Returns the metrics in the Prometheus text format
+    snapshot()
+        Returns the value of every sample
+    write_snapshot(path)
+        Writes the snapshot as a JSON file
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.help = {}
+        self.lock = threading.Lock()
+
+    def get(self, cls, name, description, labels, *args):
+        """Returns the metric of a name and labels, created on first use"""
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = self.metrics[key] = cls(*args)
+                    self.help.setdefault(name, (cls.kind, description))
+        return metric
+
+    def counter(self, name, description="", function=None, **labels):
+        """Returns the counter of a name and labels, read from function when one is given"""
+        counter = self.get(Counter, name, description, labels)
+        if function is not None:
+            # The last object registering a function is the one measured
+            counter.function = function
+        return counter
+
+    def gauge(self, name, description="", function=None, **labels):
+        """Returns the gauge of a name and labels, read from function when one is given"""
+        gauge = self.get(Gauge, name, description, labels)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, description="", buckets=LATENCY_BUCKETS, **labels):
+        """Returns the histogram of a name and labels"""
+        return self.get(Histogram, name, description, labels, buckets)
+
+    def exposition(self):
+        """Returns the metrics in the Prometheus text format"""
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        lines = []
+        lastName = None
+        for (name, labels), metric in metrics:
+            if name != lastName:
+                kind, description = self.help[name]
+                lines.append("# HELP %s %s" % (name, description))
+                lines.append("# TYPE %s %s" % (name, kind))
+                lastName = name
+            for sampleName, labelsText, value in metric.samples(name, labels):
+                lines.append("%s%s %s" % (sampleName, labelsText, format_value(value)))
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """Returns the value of every sample"""
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        values = {}
+        for (name, labels), metric in metrics:
+            for sampleName, labelsText, value in metric.samples(name, labels):
+                values[sampleName + labelsText] = value
+        return values
+
+    def write_snapshot(self, path):
+        """Writes the snapshot as a JSON file"""
+        try:
+            # Written aside then renamed, so a reader never gets a partial file
+            with open(path + ".tmp", 'w') as snapshot:
+                json.dump({'time': time.time(), 'metrics': self.snapshot()}, snapshot, indent=1, sort_keys=True)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logger.error("Metrics snapshot not written : %s", e)
+
+
+class Metrics_Handler(BaseHTTPRequestHandler):
+    """Answers GET /metrics with the Prometheus text exposition of the registry"""
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = self.server.registry.exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Metrics endpoint : " + format, *args)
+
+
+class Metrics_Server():
+    """
+    Returns a Metrics_Server object serving a registry on http://host:port/metrics
+
+    Attributes
+    ----------
+    registry : Metrics_Registry object
+        Registry served
+    host : str
+        Address the server listens to (127.0.0.1 only serves the local machine, 0.0.0.0 every interface)
+    port : int
+        Port the server listens to (a free port is picked when 0)
+    thread : threading.Thread
+        Thread running the server
+
+    Methods
+    -------
+    start()
+        Starts serving in a background thread
+    stop()
+        Stops the server
+    """
+    def __init__(self, registry=None, port=9105, host="127.0.0.1"):
+        self.registry = registry if registry is not None else REGISTRY
+        self.host = host
+        self.server = ThreadingHTTPServer((host, int(port)), Metrics_Handler)
+        self.server.daemon_threads = True
+        self.server.registry = self.registry
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name="Metrics endpoint", daemon=True)
+
+    def start(self):
+        """Starts serving in a background thread"""
+        self.thread.start()
+        logger.info("Metrics served on %s:%d", self.host, self.port)
+        return self
+
+    def stop(self):
+        """Stops the server"""
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Registry shared by the whole program
+REGISTRY = Metrics_Registry()
+
+
+if __name__ == "__main__":
+    requests = REGISTRY.counter("demo_requests_total", "Demo requests")
+    latency = REGISTRY.histogram("demo_latency_seconds", "Demo latency")
+    for i in range(10):
+        requests.inc()
+        with latency.time():
+            time.sleep(0.001 * i)
+    print(REGISTRY.exposition())
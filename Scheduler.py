@@ -0,0 +1,342 @@
+# Modules importation
+import heapq
+import itertools
+import threading
+import concurrent.futures
+import time
+import logging
+from Metrics import REGISTRY
+
+# Logger Init
+logger = logging.getLogger()
+
+
+class Tick_Scheduler():
+    """
+    Returns a Tick_Scheduler object that gives the time left until the next wall-clock tick
+
+    Ticks are aligned on multiples of period in epoch time (the second boundaries by default), shifted by
+    lead so a thread woken by a tick always reads the new second. A step of the wall clock (NTP sync of a
+    board without RTC) realigns the next tick instead of sleeping for the step or counting false overruns.
+
+    Attributes
+    ----------
+    period : float
+        Time between two ticks in seconds
+    lead : float
+        Delay after the boundary at which the tick is due in seconds
+    clock : function
+        Returns the current epoch time
+    monotonic : function
+        Returns a time that never steps, used to tell the clock steps from the missed ticks
+    nextTick : float
+        Time (epoch) of the next tick
+    lastTick : tuple
+        (clock, monotonic) times of the last tick
+    stats : dict
+        Number of ticks, early wake-ups, overruns (missed ticks) and clock steps, tick drifts in seconds
+
+    Methods
+    -------
+    timeout()
+        Returns the time left until the next tick in seconds, 0 if it is due
+    tick()
+        Records a tick and schedules the next one
+    read_stats()
+        Returns a copy of the tick counters
+    """
+    def __init__(self, period=1.0, lead=0.002, clock=time.time, monotonic=time.monotonic):
+        """
+        Constructor for Tick_Scheduler class
+
+        Parameters
+        ----------
+            period (float) : Time between two ticks in seconds
+            lead (float) : Delay after the boundary at which the tick is due in seconds
+            clock (function) : Returns the current epoch time
+            monotonic (function) : Returns a time that never steps
+        """
+        self.period = period
+        self.lead = lead
+        self.clock = clock
+        self.monotonic = monotonic
+        self.nextTick = self.boundary(clock())
+        self.lastTick = (clock(), monotonic())
+        self.stats = {'ticks': 0, 'early': 0, 'overruns': 0, 'clock_steps': 0,
+                      'last_drift': 0.0, 'max_drift': 0.0, 'total_drift': 0.0}
+
+    def boundary(self, now):
+        """Returns the time (epoch) of the first tick after now"""
+        return (now - self.lead) // self.period * self.period + self.period + self.lead
+
+    def timeout(self):
+        """Returns the time left until the next tick in seconds (0 if it is due, at most one period)"""
+        now = self.clock()
+        if self.nextTick - now > self.period:
+            # The clock stepped backward, the next tick is the next boundary of the new time
+            self.stats['clock_steps'] += 1
+            logger.warning("Clock stepped back by %.1f s, ticks realigned", self.nextTick - now - self.period)
+            self.nextTick = self.boundary(now)
+        return min(self.period, max(0.0, self.nextTick - now))
+
+    def tick(self):
+        """Records a tick and schedules the next one, returns False if it came before the tick was due"""
+        now = self.clock()
+        drift = now - self.nextTick
+        if drift < 0:
+            # Woken up before the boundary by the timer resolution
+            self.stats['early'] += 1
+            return False
+
+        # A drift longer than a period means the thread missed ticks, unless the clock stepped forward
+        lastClock, lastMonotonic = self.lastTick
+        self.lastTick = (now, self.monotonic())
+        missed = int(drift // self.period)
+        elapsed = self.lastTick[1] - lastMonotonic
+        if missed and (now - lastClock) - elapsed > self.period:
+            # Only the ticks missed in monotonic time are overruns, the step is not a drift
+            self.stats['clock_steps'] += 1
+            logger.warning("Clock stepped forward, ticks realigned")
+            missed = int(max(0.0, elapsed - self.period) // self.period)
+            drift = 0.0
+        else:
+            drift -= missed * self.period
+        if missed:
+            self.stats['overruns'] += missed
+            logger.debug("Tick overrun : %d tick(s) missed", missed)
+        self.stats['ticks'] += 1
+        self.stats['last_drift'] = drift
+        self.stats['total_drift'] += drift
+        self.stats['max_drift'] = max(self.stats['max_drift'], drift)
+        self.nextTick = self.boundary(now)
+        return True
+
+    def read_stats(self):
+        """Returns a copy of the tick counters"""
+        stats = dict(self.stats)
+        stats['mean_drift'] = stats['total_drift'] / stats['ticks'] if stats['ticks'] else 0.0
+        return stats
+
+
+class Timer_Handle():
+    """
+    Returns a Timer_Handle object, a cancellable call of a Timer_Scheduler
+
+    Attributes
+    ----------
+    when : float
+        Time (time.monotonic) of the next call
+    function : function
+        Function called
+    args : tuple
+        Arguments of the function
+    interval : float
+        Time between two calls of a repeated timer in seconds (None for a single call)
+    blocking : boolean
+        Indicates if the function may block, it is then run by a worker instead of the timers thread
+    cancelled : boolean
+        Indicates if the timer was cancelled
+    pending : boolean
+        Indicates if the timer is in the heap of the scheduler
+
+    Methods
+    -------
+    cancel()
+        Cancels the next calls of the timer
+    """
+    def __init__(self, scheduler, when, function, args, interval=None, blocking=False):
+        self.scheduler = scheduler
+        self.when = when
+        self.function = function
+        self.args = args
+        self.interval = interval
+        self.blocking = blocking
+        self.cancelled = False
+        self.pending = False
+
+    def cancel(self):
+        """Cancels the next calls of the timer"""
+        with self.scheduler.condition:
+            if not self.cancelled and self.pending:
+                self.scheduler.cancelled += 1
+            self.cancelled = True
+
+
+class Timer_Scheduler(threading.Thread):
+    """
+    Returns a Timer_Scheduler object that runs every timer of the program from a single thread
+
+    Timers are kept in a heap sorted by due time. The functions must be short, blocking ones (network
+    requests) are given to a single worker thread so they never delay the other timers.
+
+    Attributes
+    ----------
+    heap : list
+        (time, sequence, Timer_Handle) of the pending timers
+    cancelled : int
+        Number of cancelled timers still in the heap
+    condition : threading.Condition
+        Wakes the thread up when a sooner timer is added or when it is stopped
+    worker : concurrent.futures.ThreadPoolExecutor
+        Worker running the blocking functions, created on first use
+    wantstop : boolean
+        Shows if the user or program wants to stop the current thread
+    stats : dict
+        Number of scheduled, fired, cancelled and late (overrun) calls, maximum lateness in seconds
+
+    Methods
+    -------
+    run()
+        Reserved function for the treading process
+    call_later(delay, function, *args, blocking=False)
+        Calls a function after delay seconds and returns its handle
+    call_every(interval, function, *args, delay=None, blocking=False)
+        Calls a function every interval seconds (first call after delay) and returns its handle
+    schedule(handle)
+        Adds a timer to the heap
+    fire(handle)
+        Calls the function of a due timer
+    call(handle)
+        Calls the function of a timer, its errors are logged
+    stop()
+        Stops the current tread and the worker
+    read_stats()
+        Returns a copy of the timer counters
+    """
+    def __init__(self, name="Timers"):
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self.heap = []
+        self.sequence = itertools.count()
+        self.cancelled = 0
+        self.condition = threading.Condition()
+        self.worker = None
+        self.wantstop = False
+        self.stats = {'scheduled': 0, 'fired': 0, 'cancelled': 0, 'overruns': 0, 'max_late': 0.0}
+        REGISTRY.counter("timers_overruns_total", "Repeated timer calls skipped while late",
+                         lambda: self.stats['overruns'], thread=name)
+        REGISTRY.gauge("timers_pending", "Timers waiting in the heap", lambda: len(self.heap) - self.cancelled,
+                       thread=name)
+
+    def run(self):
+        """Reserved function for the treading process"""
+        while True:
+            with self.condition:
+                while not self.wantstop:
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    timeout = self.heap[0][0] - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self.condition.wait(timeout)
+                if self.wantstop:
+                    break
+                when, sequence, handle = heapq.heappop(self.heap)
+                handle.pending = False
+                if handle.cancelled:
+                    self.cancelled -= 1
+                    self.stats['cancelled'] += 1
+                    continue
+                now = time.monotonic()
+                self.stats['max_late'] = max(self.stats['max_late'], now - when)
+                if handle.interval is not None:
+                    # A repeated timer keeps its phase, the calls missed while late are skipped
+                    handle.when = when + handle.interval
+                    if handle.when <= now:
+                        missed = int((now - handle.when) // handle.interval) + 1
+                        self.stats['overruns'] += missed
+                        handle.when += missed * handle.interval
+                    heapq.heappush(self.heap, (handle.when, next(self.sequence), handle))
+                    handle.pending = True
+            self.fire(handle)
+
+    def call_later(self, delay, function, *args, blocking=False):
+        """Calls a function after delay seconds and returns its handle"""
+        return self.schedule(Timer_Handle(self, time.monotonic() + delay, function, args, blocking=blocking))
+
+    def call_every(self, interval, function, *args, delay=None, blocking=False):
+        """Calls a function every interval seconds (first call after delay) and returns its handle"""
+        delay = interval if delay is None else delay
+        return self.schedule(Timer_Handle(self, time.monotonic() + delay, function, args, interval, blocking))
+
+    def schedule(self, handle):
+        """Adds a timer to the heap"""
+        with self.condition:
+            # Cancelled timers are dropped once they are the majority of the heap
+            if self.cancelled > 32 and self.cancelled * 2 > len(self.heap):
+                self.stats['cancelled'] += self.cancelled
+                for entry in self.heap:
+                    entry[2].pending = not entry[2].cancelled
+                self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+                heapq.heapify(self.heap)
+                self.cancelled = 0
+            heapq.heappush(self.heap, (handle.when, next(self.sequence), handle))
+            handle.pending = True
+            self.stats['scheduled'] += 1
+            # Only a new earliest timer changes the sleep of the thread
+            if self.heap[0][2] is handle:
+                self.condition.notify()
+        return handle
+
+    def fire(self, handle):
+        """Calls the function of a due timer"""
+        # A cancel landing after the timer left the heap still prevents the call
+        if handle.cancelled:
+            self.stats['cancelled'] += 1
+            return
+        self.stats['fired'] += 1
+        if handle.blocking:
+            if self.worker is None:
+                self.worker = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                                    thread_name_prefix=self.name + " worker")
+            self.worker.submit(self.call, handle)
+        else:
+            self.call(handle)
+
+    def call(self, handle):
+        """Calls the function of a timer, its errors are logged"""
+        # Checked again on the worker, a blocking call may wait behind another one
+        if handle.cancelled:
+            return
+        try:
+            handle.function(*handle.args)
+        except Exception as e:
+            logger.error("Timer %s failed : %s", getattr(handle.function, '__name__', handle.function), e)
+
+    def stop(self):
+        """Stops the current tread and the worker"""
+        with self.condition:
+            self.wantstop = True
+            self.condition.notify()
+        if self.worker is not None:
+            self.worker.shutdown(wait=False)
+
+    def read_stats(self):
+        """Returns a copy of the timer counters"""
+        with self.condition:
+            stats = dict(self.stats)
+            stats['pending'] = len(self.heap) - self.cancelled
+        return stats
+
+
+# Timers shared by the whole program, started on first use
+sharedTimers = None
+sharedTimersLock = threading.Lock()
+
+
+def shared_timers():
+    """Returns the Timer_Scheduler shared by the whole program"""
+    global sharedTimers
+    with sharedTimersLock:
+        if sharedTimers is None:
+            sharedTimers = Timer_Scheduler()
+            sharedTimers.start()
+    return sharedTimers
+
+
+if __name__ == "__main__":
+    ticker = Tick_Scheduler()
+    for i in range(5):
+        time.sleep(ticker.timeout())
+        ticker.tick()
+        print("%.4f" % (time.time() % 1), ticker.read_stats())
@@ -1,7 +1,16 @@
 # Modules importation
 from HI_Treads import Led, Button_Retreiver, LCDscreen, GPIO_device, TuyaBulb_device
-from DB_Treads import DB_Tread
+from DB_Treads import DB_Tread, DEPARTURES_KEY
 from METEO_Treads import METEO_Tread
+from Dispatcher import Event_Dispatcher
+from Connectivity import Connectivity_Monitor
+from Storage import Departure_Store, SQLite_Backend
+from History import Departure_History
+from Timetable import Timetable, index_outdated, build_index_later
+from Scheduler import shared_timers
+from Metrics import REGISTRY, Metrics_Server
+import hal
+import os
 import time
 import threading
 import configparser
@@ -20,25 +29,40 @@ class DebugShell(threading.Thread):
             if ipt[0] == "button":
                 try:
                     if ipt[1] == "right":
-                        BT_R.Button_Buff.append([0, 0, 0, 1, 0])
+                        BT_R.push((0, 0, 0, 1, 0))
                     elif ipt[1] == "left":
-                        BT_R.Button_Buff.append([0, 0, 1, 0, 0])
+                        BT_R.push((0, 0, 1, 0, 0))
                     elif ipt[1] == "up":
-                        BT_R.Button_Buff.append([1, 0, 0, 0, 0])
+                        BT_R.push((1, 0, 0, 0, 0))
                     elif ipt[1] == "down":
-                        BT_R.Button_Buff.append([0, 1, 0, 0, 0])
+                        BT_R.push((0, 1, 0, 0, 0))
                     elif ipt[1] == "ok":
-                        BT_R.Button_Buff.append([0, 0, 0, 0, 1])
+                        BT_R.push((0, 0, 0, 0, 1))
                     else:
                         print("The specified button does not exist")
                 except IndexError:
                     print("You haven't specified any button to press")
             elif ipt[0] == "clear":
                 LCD.reset()
+            elif ipt[0] == "screen":
+                # Content of the emulated panel, when running off-device
+                if hal.BACKEND == "emulator":
+                    print("\n".join(hal.hw_emulator.LCD_PANEL.screen()))
+                else:
+                    print("The screen can only be read with the emulator backend")
+            elif ipt[0] == "metrics":
+                print(REGISTRY.exposition())
             elif ipt[0] == "exit":
                 BT_R.stop()
                 DB_T.stop()
                 LCD.stop()
+                MAINBULB_TUYA.stop()
+                METEO_T.stop()
+                LED.cancel()
+                TIMERS.stop()
+                if METRICS_SERVER is not None:
+                    METRICS_SERVER.stop()
+                DISPATCHER.stop()
                 print("Bye Bye !!")
                 break
             else:
@@ -61,75 +85,153 @@ logger.addHandler(file_handler)
 threading.current_thread().name = "Main Program"
 
 # Initialisation of Human-Machine Interface and DB_Thread
-LED = Led(config['Buttons&Led_config']['Led_pin'])
-METEO_T = METEO_Tread()
+# Single thread running the led blinking, the meteo refreshes and the night mode timer
+TIMERS = shared_timers()
+CONNECT_T = Connectivity_Monitor()
+LED = Led(config['Buttons&Led_config']['Led_pin'], timers=TIMERS)
+# Forecast location and cache file can be set in an optional [Meteo_config] section
+meteo_config = config['Meteo_config'] if config.has_section('Meteo_config') else {}
+METEO_T = METEO_Tread(connectivity=CONNECT_T,
+                      latitude=meteo_config.get('Latitude', 43.534240),
+                      longitude=meteo_config.get('Longitude', 1.518130),
+                      cache_file=meteo_config.get('Cache_file', "meteo_cache.json"),
+                      timers=TIMERS)
+DISPATCHER = Event_Dispatcher(lambda: LCD.requestedMode)
 BT_R = Button_Retreiver(0.1, config['Buttons&Led_config']['BT_UP'],
                         config['Buttons&Led_config']['BT_DW'],
                         config['Buttons&Led_config']['BT_LF'],
                         config['Buttons&Led_config']['BT_RG'],
-                        config['Buttons&Led_config']['BT_OK'])
+                        config['Buttons&Led_config']['BT_OK'],
+                        on_press=DISPATCHER.post_button)
+
+# One [TisseoStop:<stop name>] section with a Request option per displayed stop
+stops = {section.split(':', 1)[1]: config[section]['Request']
+         for section in config.sections() if section.startswith('TisseoStop:')}
+
+# Offline timetable, used when the API does not answer : a [Timetable] section gives the Index file and
+# the Gtfs feed imported (in the background, once the display runs) when the index is missing or older,
+# each stop section its Gtfs_stops ids and optionally the Gtfs_lines kept
+timetable = None
+rebuild_timetable = False
+timetable_stops = {section.split(':', 1)[1]: ([stop.strip() for stop in config[section]['Gtfs_stops'].split(',')],
+                                              [line.strip() for line in config[section]['Gtfs_lines'].split(',')]
+                                              if config[section].get('Gtfs_lines') else None)
+                   for section in config.sections()
+                   if section.startswith('TisseoStop:') and config[section].get('Gtfs_stops')}
+if config.has_section('Timetable'):
+    index, gtfs = config['Timetable']['Index'], config['Timetable'].get('Gtfs')
+    try:
+        # The current index is used until its rebuild is ready
+        if os.path.exists(index):
+            timetable = Timetable(index)
+    except (OSError, ValueError, KeyError) as e:
+        logger.error("Offline timetable not loaded : %s", e)
+    try:
+        rebuild_timetable = bool(gtfs) and (timetable is None or index_outdated(gtfs, index))
+    except OSError as e:
+        logger.error("GTFS feed not found : %s", e)
+
+# SQLite can replace the mysql DB with Backend = sqlite and Path = <file> in [DB_config]
+storage = None
+if config['DB_config'].get('Backend', 'mysql') == 'sqlite':
+    storage = Departure_Store(SQLite_Backend(config['DB_config']['Path']))
+
+# Departures history, kept when a [History] section gives its Directory
+history = Departure_History(config['History']['Directory']) if config.has_section('History') else None
 
 DB_T = DB_Tread(config['DB_config']['Host'],
                 config['DB_config']['User'],
                 config['DB_config']['Password'],
                 config['DB_config']['Database'],
-                config['TisseoAPI_config']['Request'],
+                stops or config['TisseoAPI_config']['Request'],
                 config['TisseoAPI_config']['API_key'],
-                config['DB_config']['Updt_Rate'])
+                config['DB_config']['Updt_Rate'],
+                storage=storage,
+                history=history,
+                connectivity=CONNECT_T,
+                timetable=timetable,
+                timetable_stops=timetable_stops)
 
 IMPR3D_GPIO = GPIO_device(config['Impr3D_GPIO']['GPIO_pin'], "Impr 3D")
 MAINBULB_TUYA = TuyaBulb_device(config['MainBulb_Tuya']['device_id'], config['MainBulb_Tuya']['device_ip'], config['MainBulb_Tuya']['device_key'], "Main Bulb")
 LCD = LCDscreen(DB_object=DB_T, LED_object=LED, METEO_object=METEO_T,
-                IMPR3D_object=IMPR3D_GPIO, MAINBULB_TUYA=MAINBULB_TUYA)
+                IMPR3D_object=IMPR3D_GPIO, MAINBULB_TUYA=MAINBULB_TUYA, CONNECT_object=CONNECT_T)
+MAINBULB_TUYA.on_change = LCD.refresh
+# New departures are drawn as soon as they are published
+DB_T.state.subscribe(DEPARTURES_KEY, lambda snapshot: LCD.refresh())
+CONNECT_T.start()
+METEO_T.start()
+MAINBULB_TUYA.start()
 BT_R.start()
 DB_T.start()
 LCD.start()
+if rebuild_timetable:
+    build_index_later(gtfs, index, DB_T.set_timetable)
+
+# Metrics endpoint and snapshot file can be set in an optional [Metrics] section
+METRICS_SERVER = None
+if config.has_section('Metrics'):
+    if config['Metrics'].get('Port'):
+        METRICS_SERVER = Metrics_Server(port=config['Metrics']['Port'],
+                                        host=config['Metrics'].get('Host', "127.0.0.1")).start()
+    if config['Metrics'].get('Snapshot_file'):
+        TIMERS.call_every(config['Metrics'].getfloat('Snapshot_interval', 60), REGISTRY.write_snapshot,
+                          config['Metrics']['Snapshot_file'], blocking=True)
+
+
+def start_nightmodeTimer():
+    """Switches the backlight off in 5 seconds, unless a button is pressed"""
+    global nightmodeTimer
+    if nightmodeTimer is not None:
+        nightmodeTimer.cancel()
+    nightmodeTimer = TIMERS.call_later(5, DISPATCHER.post, 'timer', 'NIGHTMODE')
 
-nightmodeTimer = threading.Timer(5, lambda: LCD.set_backlight('off'))
+
+def wake_up(event):
+    """Switches the backlight on when a button is pressed in night mode"""
+    if LCD.requestedNightMode is True:
+        LCD.set_backlight('on')
+        start_nightmodeTimer()
+        logger.info("Screen Waked Up")
+
+
+def switches_ok():
+    """Toggles the device of the selected line of the switches page"""
+    if LCD.requestedLine == 0:
+        IMPR3D_GPIO.setState((IMPR3D_GPIO.getState() + 1) % 2)
+    elif LCD.requestedLine == 1:
+        MAINBULB_TUYA.toggle()
+
+
+def settings_ok():
+    """Toggles the setting of the selected line of the settings page"""
+    if LCD.requestedLine == 0:
+        if LCD.requestedNightMode == True:
+            LCD.set_backlight('on')
+            if nightmodeTimer is not None:
+                nightmodeTimer.cancel()
+        else:
+            start_nightmodeTimer()
+        LCD.set_nightmode(not LCD.requestedNightMode)
+
+
+nightmodeTimer = None
+
+# (page, key) -> action table, a None page matches every page
+DISPATCHER.add_hook('button', wake_up)
+DISPATCHER.bind(None, 'RIGHT', lambda: LCD.shift_mode(1))
+DISPATCHER.bind(None, 'LEFT', lambda: LCD.shift_mode(-1))
+DISPATCHER.bind(2, 'OK', switches_ok)
+DISPATCHER.bind(3, 'OK', settings_ok)
+for page in (2, 3):
+    DISPATCHER.bind(page, 'DOWN', lambda: LCD.move_cursor(1))
+    DISPATCHER.bind(page, 'UP', lambda: LCD.move_cursor(-1))
+DISPATCHER.bind(None, 'NIGHTMODE', lambda: LCD.set_backlight('off'))
 
 debugshell = DebugShell()
 debugshell.start()
 logger.debug("Let's Go !!")
 time.sleep(3)
 
-while True:
-    try:
-        button = BT_R.read()
-        if button is not None:
-            if LCD.nightMode_is_active is True:
-                LCD.set_backlight('on')
-                if nightmodeTimer.is_alive() is True:
-                    nightmodeTimer.cancel()
-                nightmodeTimer = threading.Timer(5, lambda: LCD.set_backlight('off'))
-                nightmodeTimer.start()
-                logger.info("Screen Waked Up")
-
-            if button[4] == 1:
-                if LCD.mode == 2:
-                    if LCD.selectedLine == 0:
-                        IMPR3D_GPIO.setState((IMPR3D_GPIO.getState() + 1) % 2)
-                    elif LCD.selectedLine == 1:
-                        MAINBULB_TUYA.toggle()
-                elif LCD.mode == 3:
-                    if LCD.selectedLine == 0:
-                        if LCD.nightMode_is_active == True:
-                            LCD.set_backlight('on')
-                            nightmodeTimer.cancel()
-                        else:
-                            nightmodeTimer = threading.Timer(5, lambda: LCD.set_backlight('off'))
-                            nightmodeTimer.start()
-                        LCD.nightMode_is_active = not LCD.nightMode_is_active
-            if button[3] == 1:
-                LCD.set((LCD.mode + 1) % 4)
-            if button[2] == 1:
-                LCD.set((LCD.mode - 1) % 4)
-            if button[1] == 1:
-                if LCD.mode == 2 or LCD.mode == 3:
-                    LCD.selectedLine = (LCD.selectedLine + 1) % 3
-            if button[0] == 1:
-                if LCD.mode == 2 or LCD.mode == 3:
-                    LCD.selectedLine = (LCD.selectedLine - 1) % 3
-    except Exception as e:
-        logger.error(e)
-
-    time.sleep(0.01)
+# Sleeps until a button or timer event arrives
+DISPATCHER.run()
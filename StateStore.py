@@ -0,0 +1,127 @@
+# Modules importation
+import collections
+import threading
+import types
+import time
+import logging
+
+# Logger Init
+logger = logging.getLogger()
+
+# Published state of a key : its version (0 before the first publication), time (epoch) and frozen value
+Snapshot = collections.namedtuple('Snapshot', ['version', 'time', 'value'])
+EMPTY_SNAPSHOT = Snapshot(0, 0.0, None)
+
+
+def freeze(value):
+    """Returns a read-only copy of a value : dicts become mappingproxies, lists and sets become tuples and frozensets"""
+    if isinstance(value, (dict, types.MappingProxyType)):
+        return types.MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+
+
+class State_Store():
+    """
+    Returns a State_Store object sharing immutable, versioned snapshots between threads
+
+    A producer publishes a whole new value, which replaces the previous snapshot in a single reference
+    assignment : a reader never sees a partial update and never takes a lock. The version of a key only
+    changes when the published value differs from the current one, so consumers can skip their work
+    while it stays the same.
+
+    Attributes
+    ----------
+    snapshots : dict
+        Current Snapshot of each key
+    listeners : dict
+        Functions called with the new Snapshot of each key
+    condition : threading.Condition
+        Serialises the publications and wakes up the threads waiting for a change
+
+    Methods
+    -------
+    publish(key, value)
+        Publishes a new value of a key and returns its version
+    get(key)
+        Returns the current Snapshot of a key
+    read(key, default)
+        Returns the current value of a key
+    version(key)
+        Returns the current version of a key
+    wait_for_change(key, version, timeout)
+        Waits until the version of a key differs from version and returns its Snapshot
+    subscribe(key, function)
+        Calls function with the new Snapshot each time the key changes
+    """
+    def __init__(self):
+        self.snapshots = {}
+        self.listeners = collections.defaultdict(list)
+        self.condition = threading.Condition()
+
+    def publish(self, key, value):
+        """Publishes a new value of a key and returns its version"""
+        value = freeze(value)
+        with self.condition:
+            current = self.snapshots.get(key, EMPTY_SNAPSHOT)
+            if current.version and current.value == value:
+                return current.version
+            snapshot = Snapshot(current.version + 1, time.time(), value)
+            self.snapshots[key] = snapshot
+            self.condition.notify_all()
+            listeners = list(self.listeners[key])
+
+        # Listeners are called outside the lock, they must not block the producer
+        for function in listeners:
+            try:
+                function(snapshot)
+            except Exception as e:
+                logger.error("State listener of %s failed : %s", key, e)
+        return snapshot.version
+
+    def get(self, key):
+        """Returns the current Snapshot of a key"""
+        return self.snapshots.get(key, EMPTY_SNAPSHOT)
+
+    def read(self, key, default=None):
+        """Returns the current value of a key"""
+        snapshot = self.snapshots.get(key)
+        return default if snapshot is None else snapshot.value
+
+    def version(self, key):
+        """Returns the current version of a key"""
+        return self.get(key).version
+
+    def wait_for_change(self, key, version, timeout=None):
+        """Waits until the version of a key differs from version and returns its Snapshot (None on timeout)"""
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.get(key).version != version, timeout):
+                return None
+            return self.get(key)
+
+    def subscribe(self, key, function):
+        """Calls function with the new Snapshot each time the key changes"""
+        with self.condition:
+            self.listeners[key].append(function)
+
+
+# Test code which publishes from a thread and waits for the changes
+if __name__ == "__main__":
+    store = State_Store()
+
+    def producer():
+        for i in range(3):
+            time.sleep(0.5)
+            store.publish('counter', {'value': i // 2})
+
+    threading.Thread(target=producer, daemon=True).start()
+    version = store.version('counter')
+    while True:
+        snapshot = store.wait_for_change('counter', version, timeout=2)
+        if snapshot is None:
+            break
+        version = snapshot.version
+        print(snapshot.version, dict(snapshot.value))
@@ -0,0 +1,440 @@
+# Modules importation
+import threading
+import collections
+import datetime
+import sqlite3
+import time
+import logging
+from Metrics import REGISTRY
+try:
+    import mysql.connector
+    import mysql.connector.pooling
+except ImportError:
+    mysql = None
+
+# Logger Init
+logger = logging.getLogger()
+
+# Number of departures stored for each stop
+DEPARTURES_NUMBER = 3
+# Table keyed by stop name that stores the next departures
+DEPARTURES_TABLE = "Next_Departures"
+# Highest power of 2 applied to the retry delay after consecutive failed writes
+MAX_RETRY_EXPONENT = 16
+# Policies of a full write queue
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+
+class MySQL_Backend():
+    """
+    Returns a MySQL_Backend object that executes statements through a pool of health-checked connections
+
+    Attributes
+    ----------
+    config : dict
+        Connection parameters of mysql.connector
+    pool_size : int
+        Number of pooled connections
+    health_check : float
+        A connection idle for more than health_check seconds is pinged (and reconnected) before use
+    pool : mysql.connector.pooling.MySQLConnectionPool object
+        Pool of connections, created on first use so that the DB can be down at startup
+    lastUse : dict
+        Last successful use (monotonic time) of each connection handed out by the pool
+
+    Methods
+    -------
+    connection()
+        Returns a healthy connection from the pool
+    execute(statement, rows)
+        Executes a prepared statement for each row and commits, reconnects once if the connection was lost
+    pooled(conn)
+        Returns the connection object kept by the pool behind a connection it handed out
+    close()
+        Closes the pooled connections
+    """
+    CREATE_DEPARTURES = ("CREATE TABLE IF NOT EXISTS `{0}` ("
+                         "Stop_Key VARCHAR(64) NOT NULL PRIMARY KEY, "
+                         "Next_Bus_1 DATETIME NULL, Real_Time_1 BOOLEAN NULL, "
+                         "Next_Bus_2 DATETIME NULL, Real_Time_2 BOOLEAN NULL, "
+                         "Next_Bus_3 DATETIME NULL, Real_Time_3 BOOLEAN NULL)")
+    UPSERT_DEPARTURES = ("INSERT INTO `{0}` "
+                         "(Stop_Key, Next_Bus_1, Real_Time_1, Next_Bus_2, Real_Time_2, Next_Bus_3, Real_Time_3) "
+                         "VALUES (%s, %s, %s, %s, %s, %s, %s) "
+                         "ON DUPLICATE KEY UPDATE Next_Bus_1 = VALUES(Next_Bus_1), Real_Time_1 = VALUES(Real_Time_1), "
+                         "Next_Bus_2 = VALUES(Next_Bus_2), Real_Time_2 = VALUES(Real_Time_2), "
+                         "Next_Bus_3 = VALUES(Next_Bus_3), Real_Time_3 = VALUES(Real_Time_3)")
+
+    def __init__(self, host, user, password, database, pool_size=2, connect_timeout=5, health_check=30):
+        """
+        Constructor for MySQL_Backend class
+
+        Parameters
+        ----------
+            host (str) : Host name or adress for the mysql DB
+            user (str) : User name of mysql DB
+            password (str) : Password for selected user
+            database (str) : Database name that contain your autobus lines data
+            pool_size (int) : Number of pooled connections
+            connect_timeout (float) : Maximum time to connect or wait for the DB in seconds
+            health_check (float) : Idle time after which a connection is pinged before use in seconds
+        """
+        if mysql is None:
+            raise ImportError("mysql.connector is required by the MySQL backend")
+        self.config = {'host': host, 'user': user, 'password': password, 'database': database,
+                       'connection_timeout': int(connect_timeout)}
+        self.pool_size = pool_size
+        self.health_check = health_check
+        self.pool = None
+        self.lastUse = {}
+
+    def connection(self):
+        """Returns a healthy connection from the pool"""
+        if self.pool is None:
+            self.pool = mysql.connector.pooling.MySQLConnectionPool(pool_name="TisseoDisplay",
+                                                                    pool_size=self.pool_size,
+                                                                    pool_reset_session=False,
+                                                                    **self.config)
+            logger.warning("Connection Opened !!")
+        conn = self.pool.get_connection()
+        now = time.monotonic()
+        if now - self.lastUse.setdefault(self.pooled(conn), 0) > self.health_check:
+            conn.ping(reconnect=True, attempts=1, delay=0)
+        return conn
+
+    def execute(self, statement, rows=None):
+        """Executes a prepared statement for each row and commits, reconnects once if the connection was lost"""
+        for attempt in (1, 2):
+            conn = None
+            try:
+                conn = self.connection()
+                cursor = conn.cursor(prepared=True)
+                if rows is None:
+                    cursor.execute(statement)
+                else:
+                    cursor.executemany(statement, rows)
+                conn.commit()
+                cursor.close()
+                self.lastUse[self.pooled(conn)] = time.monotonic()
+                return
+            except (mysql.connector.InterfaceError, mysql.connector.OperationalError,
+                    mysql.connector.PoolError) as details:
+                logger.error("DataBase connection lost, reconnecting : %s", details)
+                if conn is not None:
+                    try:
+                        conn.reconnect(attempts=1)
+                    except mysql.connector.Error:
+                        pass
+                if attempt == 2:
+                    raise
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    @staticmethod
+    def pooled(conn):
+        """Returns the connection object kept by the pool behind a connection it handed out"""
+        # The server connection id changes on reconnect and get_connection returns a new wrapper
+        # each time, the wrapped connection is the one staying in the pool
+        return conn._cnx
+
+    def close(self):
+        """Closes the pooled connections"""
+        if self.pool is None:
+            return
+        # Every connection handed out is known by lastUse, they are disconnected without going
+        # through the pool (get_connection would reconnect them)
+        for conn in self.lastUse:
+            try:
+                conn.disconnect()
+            except mysql.connector.Error:
+                pass
+        self.lastUse.clear()
+        self.pool = None
+        logger.warning("Connection Closed !!")
+
+
+class SQLite_Backend():
+    """
+    Returns a SQLite_Backend object that executes statements on a local SQLite file, used for tests and benchmarks
+
+    Attributes
+    ----------
+    path : str
+        Path of the SQLite file (":memory:" for an in-memory DB)
+    db : sqlite3.Connection object
+        Connection shared by the threads, protected by lock
+
+    Methods
+    -------
+    execute(statement, rows)
+        Executes a statement for each row and commits
+    close()
+        Closes the connection
+    """
+    CREATE_DEPARTURES = ("CREATE TABLE IF NOT EXISTS \"{0}\" ("
+                         "Stop_Key TEXT NOT NULL PRIMARY KEY, "
+                         "Next_Bus_1 TEXT, Real_Time_1 INTEGER, "
+                         "Next_Bus_2 TEXT, Real_Time_2 INTEGER, "
+                         "Next_Bus_3 TEXT, Real_Time_3 INTEGER)")
+    UPSERT_DEPARTURES = ("INSERT INTO \"{0}\" "
+                         "(Stop_Key, Next_Bus_1, Real_Time_1, Next_Bus_2, Real_Time_2, Next_Bus_3, Real_Time_3) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                         "ON CONFLICT(Stop_Key) DO UPDATE SET Next_Bus_1 = excluded.Next_Bus_1, "
+                         "Real_Time_1 = excluded.Real_Time_1, Next_Bus_2 = excluded.Next_Bus_2, "
+                         "Real_Time_2 = excluded.Real_Time_2, Next_Bus_3 = excluded.Next_Bus_3, "
+                         "Real_Time_3 = excluded.Real_Time_3")
+
+    def __init__(self, path=":memory:", timeout=5):
+        """
+        Constructor for SQLite_Backend class
+
+        Parameters
+        ----------
+            path (str) : Path of the SQLite file (":memory:" for an in-memory DB)
+            timeout (float) : Maximum time to wait for a lock on the file in seconds
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+
+    def execute(self, statement, rows=None):
+        """Executes a statement for each row and commits"""
+        with self.lock:
+            if rows is None:
+                self.db.execute(statement)
+            else:
+                # sqlite3 caches the prepared statement between the rows
+                self.db.executemany(statement, ([value.isoformat(' ') if isinstance(value, datetime.datetime) else value
+                                                 for value in row] for row in rows))
+            self.db.commit()
+
+    def close(self):
+        """Closes the connection"""
+        with self.lock:
+            self.db.close()
+
+
+class Departure_Store():
+    """
+    Returns a Departure_Store object that writes the next departures of each stop on a storage backend
+
+    Writes are queued and executed by a background writer (write-behind), so a slow or locked DB never
+    delays the caller. A queued update of a stop is replaced by a newer one (coalescing), the writer sends
+    up to batch_size stops in a single transaction, and a full queue applies the overflow policy :
+    'drop_oldest' drops the oldest queued stop, 'drop_newest' drops the new update and 'block' waits up
+    to deadline seconds for room before dropping it.
+
+    Attributes
+    ----------
+    backend : MySQL_Backend or SQLite_Backend object
+        Backend executing the statements
+    table : str
+        Name of the table keyed by stop name
+    deadline : float
+        Maximum time a write may block the caller in seconds (block policy), and time given to close to flush
+    maxPending : int
+        Maximum number of stops waiting in the queue
+    batchSize : int
+        Maximum number of stops written in a single transaction
+    batchDelay : float
+        Time the writer waits for other updates before writing a partial batch in seconds
+    retryDelay : float
+        Time before the first retry of a failed write in seconds, doubled after each failure
+    maxRetryDelay : float
+        Maximum time between two retries in seconds
+    overflow : str
+        Policy of a full queue ('drop_oldest', 'drop_newest' or 'block')
+    queue : collections.OrderedDict
+        Row waiting to be written of each stop, oldest first
+    condition : threading.Condition
+        Protects the queue and wakes the writer up
+    writing : boolean
+        Indicates if a batch is being written
+    failures : int
+        Number of consecutive failed writes
+    writer : threading.Thread
+        Thread executing the writes
+
+    Methods
+    -------
+    write(stopsData)
+        Queues the next departures of every stop, returns False if an update was dropped
+    make_room()
+        Applies the overflow policy to the full queue, returns True if a row can be queued
+    run()
+        Writes the queued rows in batches, executed by the writer
+    requeue(rows)
+        Queues failed rows again ahead of the newer ones, within maxPending
+    execute_write(rows)
+        Creates the table if needed and upserts the rows
+    flush(timeout)
+        Waits until every queued row is written, returns False on timeout
+    close()
+        Writes the queued rows (within deadline seconds) and closes the backend
+    """
+    def __init__(self, backend, table=DEPARTURES_TABLE, deadline=2.0, max_pending=64, batch_size=16,
+                 batch_delay=0.05, retry_delay=1.0, max_retry_delay=60.0, overflow='drop_oldest'):
+        """
+        Constructor for Departure_Store class
+
+        Parameters
+        ----------
+            backend (MySQL_Backend or SQLite_Backend) : Backend executing the statements
+            table (str) : Name of the table keyed by stop name
+            deadline (float) : Maximum time a write may block the caller in seconds
+            max_pending (int) : Maximum number of stops waiting in the queue
+            batch_size (int) : Maximum number of stops written in a single transaction
+            batch_delay (float) : Time the writer waits for other updates before writing a partial batch in seconds
+            retry_delay (float) : Time before the first retry of a failed write in seconds
+            max_retry_delay (float) : Maximum time between two retries in seconds
+            overflow (str) : Policy of a full queue ('drop_oldest', 'drop_newest' or 'block')
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy : %s" % overflow)
+        self.backend = backend
+        self.table = table
+        self.deadline = float(deadline)
+        self.maxPending = int(max_pending)
+        self.batchSize = int(batch_size)
+        self.batchDelay = float(batch_delay)
+        self.retryDelay = float(retry_delay)
+        self.maxRetryDelay = float(max_retry_delay)
+        self.overflow = overflow
+        self.upsert = backend.UPSERT_DEPARTURES.format(table)
+        self.tableCreated = False
+        self.queue = collections.OrderedDict()
+        self.condition = threading.Condition()
+        self.writing = False
+        self.closing = False
+        self.failures = 0
+        self.writeTime = REGISTRY.histogram("db_write_seconds", "Time of a departures upsert")
+        self.writeFailures = REGISTRY.counter("db_write_failures_total", "Departures writes failed")
+        self.writeSkipped = REGISTRY.counter("db_write_skipped_total", "Departures updates dropped, write queue full")
+        self.writeCoalesced = REGISTRY.counter("db_write_coalesced_total",
+                                               "Queued departures updates replaced by a newer one")
+        self.batchRows = REGISTRY.histogram("db_write_batch_rows", "Stops written per transaction",
+                                            buckets=(1, 2, 4, 8, 16, 32, 64))
+        REGISTRY.gauge("db_write_pending", "Stops waiting in the write queue", lambda: len(self.queue))
+        self.writer = threading.Thread(target=self.run, name="DB write", daemon=True)
+        self.writer.start()
+
+    def write(self, stopsData):
+        """Queues the next departures of every stop, returns False if an update was dropped"""
+        accepted = True
+        with self.condition:
+            for stop, departures in stopsData.items():
+                row = [stop]
+                for i in range(DEPARTURES_NUMBER):
+                    row.extend(departures[i][:2] if i < len(departures) else (None, None))
+
+                if stop in self.queue:
+                    # The queued update is superseded, the stop keeps its place in the queue
+                    self.queue[stop] = row
+                    self.writeCoalesced.inc()
+                elif len(self.queue) < self.maxPending or self.make_room():
+                    self.queue[stop] = row
+                else:
+                    accepted = False
+            self.condition.notify_all()
+        return accepted
+
+    def make_room(self):
+        """Applies the overflow policy to the full queue, returns True if a row can be queued (condition held)"""
+        if self.overflow == 'block':
+            self.condition.wait_for(lambda: len(self.queue) < self.maxPending or self.closing, self.deadline)
+            if len(self.queue) < self.maxPending and not self.closing:
+                return True
+
+        self.writeSkipped.inc()
+        if self.overflow == 'drop_oldest':
+            stop, row = self.queue.popitem(last=False)
+            logger.error("DataBase write queue full, departures of %s dropped", stop)
+            return True
+        logger.error("DataBase write queue full, new departures dropped")
+        return False
+
+    def run(self):
+        """Writes the queued rows in batches, executed by the writer"""
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queue or self.closing)
+                if not self.queue:
+                    break
+                # Gathers the updates arriving just after the first one in the same transaction
+                if not self.closing and len(self.queue) < self.batchSize:
+                    self.condition.wait(self.batchDelay)
+                rows = [self.queue.popitem(last=False)[1] for i in range(min(self.batchSize, len(self.queue)))]
+                self.writing = True
+                self.condition.notify_all()
+
+            delay = 0
+            try:
+                self.execute_write(rows)
+                self.batchRows.observe(len(rows))
+                self.failures = 0
+            except Exception as details:
+                logger.critical("Error While Uploading to the DataBase : %s", details)
+                self.writeFailures.inc()
+                self.failures += 1
+                # The exponent is capped, 2 ** 1024 overflows a float and would kill the writer
+                delay = min(self.maxRetryDelay, self.retryDelay * 2 ** min(self.failures - 1, MAX_RETRY_EXPONENT))
+                with self.condition:
+                    self.requeue(rows)
+            finally:
+                with self.condition:
+                    self.writing = False
+                    self.condition.notify_all()
+
+            if delay:
+                with self.condition:
+                    if self.closing:
+                        logger.error("DataBase unreachable, %d stop(s) not saved", len(self.queue))
+                        self.queue.clear()
+                        self.condition.notify_all()
+                        break
+                    self.condition.wait_for(lambda: self.closing, delay)
+
+    def requeue(self, rows):
+        """Queues failed rows again ahead of the newer ones, within maxPending (condition held)"""
+        # Rows superseded while they were written are not queued again
+        rows = [row for row in rows if row[0] not in self.queue]
+        # The failed rows are the oldest updates, so a full queue drops them whatever the policy
+        # (the writer never blocks itself waiting for room)
+        dropped = max(0, len(rows) - max(0, self.maxPending - len(self.queue)))
+        if dropped:
+            self.writeSkipped.inc(dropped)
+            logger.error("DataBase write queue full, departures of %s dropped",
+                         ", ".join(row[0] for row in rows[:dropped]))
+        for row in reversed(rows[dropped:]):
+            self.queue[row[0]] = row
+            self.queue.move_to_end(row[0], last=False)
+
+    def execute_write(self, rows):
+        """Creates the table if needed and upserts the rows, executed by the writer"""
+        with self.writeTime.time():
+            if not self.tableCreated:
+                self.backend.execute(self.backend.CREATE_DEPARTURES.format(self.table))
+                self.tableCreated = True
+            self.backend.execute(self.upsert, rows)
+
+    def flush(self, timeout=None):
+        """Waits until every queued row is written, returns False on timeout"""
+        with self.condition:
+            self.condition.notify_all()
+            return self.condition.wait_for(lambda: not self.queue and not self.writing, timeout)
+
+    def close(self):
+        """Writes the queued rows (within deadline seconds) and closes the backend"""
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        self.writer.join(self.deadline)
+        if self.writer.is_alive():
+            logger.error("DataBase writer still running after %.1f s", self.deadline)
+        try:
+            self.backend.close()
+        except Exception as details:
+            logger.error("Error While Disconnecting from the DataBase : %s", details)
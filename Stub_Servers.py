@@ -0,0 +1,276 @@
+# Modules importation
+import os
+import csv
+import threading
+import datetime
+import hashlib
+import gzip
+import time
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Logger Init
+logger = logging.getLogger()
+
+
+class StubTisseoHandler(BaseHTTPRequestHandler):
+    """Answers the stops_schedules requests with generated departures"""
+    protocol_version = "HTTP/1.1"
+    # Headers and body leave in a single write (flushed after each request) and without Nagle delay,
+    # otherwise every keep-alive request waits for the delayed ACK of the client
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        stub = self.server.stub
+        query = parse_qs(urlparse(self.path).query)
+        stop = query.get('stopPointId', ['0'])[0]
+        number = int(query.get('number', [stub.departures])[0])
+
+        with stub.lock:
+            stub.requests += 1
+        if stub.latency:
+            time.sleep(stub.latency)
+
+        body = stub.build_departures(stop, number)
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if stub.etag and self.headers.get('If-None-Match') == etag:
+            with stub.lock:
+                stub.not_modified += 1
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        headers = {'Content-Type': 'application/xml; charset=utf-8'}
+        if stub.etag:
+            headers['ETag'] = etag
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        headers['Content-Length'] = str(len(body))
+
+        self.send_response(200)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Stub Tisseo API : " + format, *args)
+
+
+class StubTisseoServer():
+    """
+    Returns a local HTTP server that mimics the Tisseo stops_schedules API, used for offline tests and benchmarks
+
+    Attributes
+    ----------
+    port : int
+        Port the server listens to (a free port is picked when 0)
+    departures : int
+        Number of departures returned when the request does not specify it
+    interval : int
+        Time between two generated departures in seconds
+    latency : float
+        Delay added before each answer in seconds
+    etag : boolean
+        Indicates if ETag conditional requests are supported
+    requests : int
+        Number of requests received
+    not_modified : int
+        Number of 304 Not Modified answers
+
+    Methods
+    -------
+    start()
+        Starts serving in a background thread
+    stop()
+        Stops the server
+    url(stop)
+        Returns the request url of a stop (without the API key)
+    build_departures(stop, number)
+        Returns the XML body of the departures of a stop
+    """
+    def __init__(self, port=0, departures=3, interval=600, latency=0.0, etag=True):
+        self.departures = departures
+        self.interval = interval
+        self.latency = latency
+        self.etag = etag
+        self.requests = 0
+        self.not_modified = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), StubTisseoHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name="Stub Tisseo API", daemon=True)
+
+    def start(self):
+        """Starts serving in a background thread"""
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stops the server"""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def url(self, stop=0):
+        """Returns the request url of a stop (without the API key)"""
+        return "http://127.0.0.1:%d/api/v2/stops_schedules.xml?stopPointId=%s&number=%d" % (self.port, stop,
+                                                                                           self.departures)
+
+    def build_departures(self, stop, number):
+        """Returns the XML body of the departures of a stop"""
+        # Departures are aligned on the interval so the body only changes when a bus leaves
+        now = int(time.time())
+        first = now - now % self.interval + self.interval
+        lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+                 '<departures expirationDate="%s">' % datetime.datetime.fromtimestamp(first).strftime("%Y-%m-%d %H:%M"),
+                 '<stop id="%s" name="Stub stop %s" operator="Tisseo"/>' % (stop, stop)]
+        for i in range(number):
+            dateTime = datetime.datetime.fromtimestamp(first + i * self.interval).strftime("%Y-%m-%d %H:%M:%S")
+            lines.append('<departure dateTime="%s" realTime="%s">'
+                         '<line id="11821953316814915" shortName="79" name="Ramonville / Périgord"/>'
+                         '<destination id="1970324837185012" name="Périgord" cityName="TOULOUSE"/>'
+                         '</departure>' % (dateTime, "yes" if i % 2 == 0 else "no"))
+        lines.append('</departures>')
+        return "\n".join(lines).encode('utf-8')
+
+
+class StubForecast():
+    """Forecast object holding a current_forecast dict like the meteofrance_api one"""
+    def __init__(self, temperature):
+        self.current_forecast = {'T': {'value': temperature, 'windchill': temperature - 2},
+                                 'humidity': 60, 'wind': {'speed': 12, 'direction': 225},
+                                 'clouds': 40, 'rain': {'1h': 0}}
+
+
+class StubMeteoClient():
+    """
+    Returns a stand-in of MeteoFranceClient that answers get_forecast after a configurable latency
+
+    Attributes
+    ----------
+    latency : float
+        Delay of each get_forecast call in seconds
+    calls : int
+        Number of get_forecast calls
+    """
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+
+    def get_forecast(self, latitude, longitude):
+        """Returns a forecast after latency seconds"""
+        self.calls += 1
+        time.sleep(self.latency)
+        return StubForecast(18 + self.calls % 5)
+
+
+class StubTuyaDevice():
+    """
+    Returns a stand-in of tinytuya.BulbDevice that keeps the power state in memory
+
+    Attributes
+    ----------
+    latency : float
+        Delay of each call in seconds
+    power : boolean
+        Power state of the bulb
+    calls : int
+        Number of calls
+    """
+    def __init__(self, latency=0.0, power=False):
+        self.latency = latency
+        self.power = power
+        self.calls = 0
+
+    def call(self):
+        """Counts a call and waits latency seconds"""
+        self.calls += 1
+        time.sleep(self.latency)
+
+    def status(self):
+        """Returns the data points of the bulb"""
+        self.call()
+        return {'dps': {'1': self.power}}
+
+    def turn_on(self):
+        """Switches the bulb on"""
+        self.call()
+        self.power = True
+
+    def turn_off(self):
+        """Switches the bulb off"""
+        self.call()
+        self.power = False
+
+
+def write_stub_gtfs(directory, lines=100, stops_per_line=30, trips_per_day=120, headway=480):
+    """
+    Writes a synthetic GTFS feed the size of the Toulouse network (about 2 million stop times), returns its directory
+
+    Each line runs both ways on weekdays, saturdays and sundays with its own stop points, a trip
+    every headway seconds from 5:00 (the last ones run after midnight, over 24:00:00).
+
+    Parameters
+    ----------
+        directory (str) : Directory where the txt files are written
+        lines (int) : Number of lines
+        stops_per_line (int) : Number of stops of each way of a line
+        trips_per_day (int) : Number of trips of each way of a line per service day
+        headway (int) : Time between two trips in seconds
+    """
+    os.makedirs(directory, exist_ok=True)
+    services = {'WEEK': "1,1,1,1,1,0,0", 'SAT': "0,0,0,0,0,1,0", 'SUN': "0,0,0,0,0,0,1"}
+    year = datetime.date.today().year
+
+    def table(name, header, rows):
+        with open(os.path.join(directory, name), 'w', newline='', encoding='utf-8') as output:
+            writer = csv.writer(output)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+    table('calendar.txt', ['service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday',
+                           'sunday', 'start_date', 'end_date'],
+          ([service] + days.split(",") + ["%d0101" % (year - 1), "%d1231" % (year + 1)]
+           for service, days in services.items()))
+    table('routes.txt', ['route_id', 'route_short_name', 'route_type'],
+          (["R%d" % line, str(line), 3] for line in range(lines)))
+    table('stops.txt', ['stop_id', 'stop_name', 'parent_station'],
+          (["S%d_%d_%d" % (line, way, stop), "Stop %d %d" % (line, stop), "A%d_%d" % (line, stop)]
+           for line in range(lines) for way in range(2) for stop in range(stops_per_line)))
+    table('trips.txt', ['route_id', 'service_id', 'trip_id', 'trip_headsign'],
+          (["R%d" % line, service, "T%d_%d_%s_%d" % (line, way, service, trip), "Terminus %d-%d" % (line, way)]
+           for line in range(lines) for way in range(2) for service in services for trip in range(trips_per_day)))
+
+    def stop_times():
+        for line in range(lines):
+            for way in range(2):
+                for service in services:
+                    for trip in range(trips_per_day):
+                        seconds = 5 * 3600 + trip * headway + line * 7
+                        for stop in range(stops_per_line):
+                            text = "%02d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+                            yield ["T%d_%d_%s_%d" % (line, way, service, trip), text, text,
+                                   "S%d_%d_%d" % (line, way, stop), stop, 1 if stop == stops_per_line - 1 else 0]
+                            seconds += 90
+    table('stop_times.txt', ['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence',
+                             'pickup_type'], stop_times())
+    return directory
+
+
+# Test code which serves stub departures on http://127.0.0.1:8080
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    stub = StubTisseoServer(port=8080).start()
+    print("Stub Tisseo API on", stub.url(1))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stub.stop()
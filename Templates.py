@@ -0,0 +1,177 @@
+# Modules importation
+import re
+import time
+import logging
+
+# Logger Init
+logger = logging.getLogger()
+
+# {name:kind:width} field of a row template
+FIELD_PATTERN = re.compile(r"\{(\w+):(\w+):(\d+)\}")
+
+# Longest countdown that can be shown (99h 59m 59s)
+COUNTDOWN_MAX = 99 * 3600 + 59 * 60 + 59
+
+# Offset between UTC and local time, cached for the current hour
+utcOffset = [None, 0]
+
+
+def local_offset(epoch):
+    """Returns the offset between UTC and local time in seconds (DST changes happen on hour boundaries)"""
+    hour = epoch // 3600
+    if utcOffset[0] != hour:
+        utcOffset[0], utcOffset[1] = hour, time.localtime(epoch).tm_gmtoff
+    return utcOffset[1]
+
+
+def format_str(value, width):
+    """Left aligned text"""
+    return str(value)[:width].ljust(width)
+
+
+def format_rstr(value, width):
+    """Right aligned text"""
+    return str(value)[:width].rjust(width)
+
+
+def format_int(value, width):
+    """Zero padded integer, clamped to the width"""
+    value = int(round(value))
+    return "%0*d" % (width, max(-(10 ** (width - 1) - 1), min(value, 10 ** width - 1)))
+
+
+def format_onoff(value, width):
+    """ON / OFF state"""
+    return (" ON" if value else "OFF").rjust(width)
+
+
+def format_clock(epoch, width):
+    """Local HH:MM of an epoch time"""
+    epoch = int(epoch)
+    minutes = (epoch + local_offset(epoch)) // 60 % 1440
+    return ("%02d:%02d" % divmod(minutes, 60))[:width]
+
+
+def format_countdown(seconds, width):
+    """HHh MMm SSs countdown of a number of seconds, 0 when passed"""
+    seconds = max(0, min(int(seconds), COUNTDOWN_MAX))
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return ("%02dh %02dm %02ds" % (hours, minutes, seconds))[:width]
+
+
+FORMATS = {'str': format_str, 'rstr': format_rstr, 'int': format_int, 'onoff': format_onoff,
+           'clock': format_clock, 'countdown': format_countdown}
+
+
+class Row_Template():
+    """
+    Returns a Row_Template object compiled from a row made of fixed text and {name:kind:width} fields
+
+    Attributes
+    ----------
+    parts : list
+        Fixed texts and (name, format function, width) fields of the row
+    fields : tuple
+        Names of the fields, in the order of the row
+    width : int
+        Width of the built rows
+    values : tuple
+        Values of the fields of the last built row
+    row : str
+        Last built row
+
+    Methods
+    -------
+    build(values)
+        Returns the row built from a dict of field values and the names of the fields that changed
+    reset()
+        Forgets the last built row
+    """
+    def __init__(self, text, width=20):
+        self.width = width
+        self.parts = []
+        position = 0
+        for match in FIELD_PATTERN.finditer(text):
+            if match.start() > position:
+                self.parts.append(text[position:match.start()])
+            name, kind, fieldWidth = match.group(1), match.group(2), int(match.group(3))
+            if kind not in FORMATS:
+                raise ValueError("Unknown field kind <%s> in template %r" % (kind, text))
+            self.parts.append((name, FORMATS[kind], fieldWidth))
+            position = match.end()
+        if position < len(text):
+            self.parts.append(text[position:])
+        self.fields = tuple(part[0] for part in self.parts if isinstance(part, tuple))
+        self.reset()
+
+    def build(self, values):
+        """Returns the row built from a dict of field values and the names of the fields that changed"""
+        current = tuple(values.get(name) for name in self.fields)
+        if current == self.values:
+            return self.row, ()
+        if self.values is None:
+            changed = self.fields
+        else:
+            changed = tuple(name for name, old, new in zip(self.fields, self.values, current) if old != new)
+
+        text = []
+        for part in self.parts:
+            if isinstance(part, str):
+                text.append(part)
+            else:
+                name, format_field, fieldWidth = part
+                value = values.get(name)
+                text.append(" " * fieldWidth if value is None else format_field(value, fieldWidth))
+        self.row = "".join(text)[:self.width].ljust(self.width)
+        self.values = current
+        return self.row, changed
+
+    def reset(self):
+        """Forgets the last built row"""
+        self.values = None
+        self.row = " " * self.width
+
+
+class Page_Template():
+    """
+    Returns a Page_Template object, a screen page declared once as rows of fixed text and typed fields
+
+    Attributes
+    ----------
+    name : str
+        Name of the page
+    rows : list of Row_Template
+        Compiled rows of the page
+
+    Methods
+    -------
+    render(values)
+        Returns the rows of the page built from a dict of field values and the set of changed fields
+    reset()
+        Forgets the last built rows
+    """
+    def __init__(self, name, rows, width=20, height=4):
+        self.name = name
+        rows = list(rows) + [""] * (height - len(rows))
+        self.rows = [Row_Template(row, width) for row in rows[:height]]
+
+    def render(self, values):
+        """Returns the rows of the page built from a dict of field values and the set of changed fields"""
+        rows = []
+        changed = set()
+        for row in self.rows:
+            text, rowChanged = row.build(values)
+            rows.append(text)
+            changed.update(rowChanged)
+        return rows, changed
+
+    def reset(self):
+        """Forgets the last built rows"""
+        for row in self.rows:
+            row.reset()
+
+
+def compile_pages(pages, width=20, height=4):
+    """Compiles a list of (name, rows) page declarations into Page_Template objects"""
+    return [Page_Template(name, rows, width, height) for name, rows in pages]
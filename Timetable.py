@@ -0,0 +1,338 @@
+# Modules importation
+import os
+import io
+import sys
+import csv
+import json
+import mmap
+import math
+import array
+import bisect
+import struct
+import zipfile
+import threading
+import datetime
+import time
+import logging
+
+# Logger Init
+logger = logging.getLogger()
+
+# Index file layout : magic, JSON header length, JSON header padded to 4 bytes,
+# departure times (uint32 per departure) then departure infos (service, line, headsign as 3 x uint16)
+INDEX_MAGIC = b"TISSEOTT"
+INDEX_VERSION = 1
+# Days searched after the requested one when a stop has no more departure
+SEARCH_DAYS = 7
+# Columns of calendar.txt, bit 0 of the service days mask is monday
+WEEKDAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+
+def gtfs_seconds(text):
+    """Returns the seconds after the start of the service day of a GTFS HH:MM:SS time (hours may exceed 24)"""
+    hours, minutes, seconds = text.strip().split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def service_day_start(day):
+    """Returns the epoch time from which the GTFS times of a service day are counted : noon minus 12 h"""
+    # Midnight on most days, but 23:00 or 01:00 of the day before on DST change days, so that the
+    # departures keep their local time
+    noon = time.mktime((day.year, day.month, day.day, 12, 0, 0, 0, 0, -1))
+    return int(noon) - 12 * 3600
+
+
+def read_gtfs(gtfs, name, optional=False):
+    """Yields the rows (dicts) of a file of a GTFS feed, given as a directory or a zip archive"""
+    if os.path.isdir(gtfs):
+        path = os.path.join(gtfs, name)
+        if optional and not os.path.exists(path):
+            return
+        with open(path, newline='', encoding='utf-8-sig') as table:
+            yield from csv.DictReader(table)
+    else:
+        with zipfile.ZipFile(gtfs) as archive:
+            if optional and name not in archive.namelist():
+                return
+            with archive.open(name) as table:
+                yield from csv.DictReader(io.TextIOWrapper(table, encoding='utf-8-sig', newline=''))
+
+
+def index_of(table, value):
+    """Returns the index of value in a {value: index} table, added at the end if missing"""
+    return table.setdefault(value, len(table))
+
+
+def build_index(gtfs, path):
+    """
+    Imports the stop_times, trips, routes and calendars of a GTFS feed into an index file, returns the number of departures
+
+    Parameters
+    ----------
+        gtfs (str) : GTFS directory or zip archive
+        path (str) : Index file written
+    """
+    start = time.perf_counter()
+    services, lines, headsigns = {}, {}, {}
+
+    routes = {row['route_id']: row.get('route_short_name') or row.get('route_long_name', "")
+              for row in read_gtfs(gtfs, 'routes.txt')}
+    trips = {}
+    for row in read_gtfs(gtfs, 'trips.txt'):
+        trips[row['trip_id']] = (index_of(services, row['service_id']),
+                                 index_of(lines, routes.get(row['route_id'], row['route_id'])),
+                                 index_of(headsigns, row.get('trip_headsign', "")))
+    if max(len(services), len(lines), len(headsigns)) > 0xFFFF:
+        raise ValueError("Too many services, lines or headsigns for the index")
+
+    # Departures of each stop, packed as seconds in the 32 upper bits and row in the 32 lower bits, so
+    # they are sorted one stop at a time without a Python object per row of the feed
+    stopKeys = {}
+    infos = array.array('H')
+    for row in read_gtfs(gtfs, 'stop_times.txt'):
+        # Stops where passengers can not board (terminus, drop off only) are not departures
+        if row.get('pickup_type') == '1':
+            continue
+        trip = trips.get(row['trip_id'])
+        text = row.get('departure_time') or row.get('arrival_time')
+        if trip is None or not text:
+            continue
+        keys = stopKeys.get(row['stop_id'])
+        if keys is None:
+            keys = stopKeys[row['stop_id']] = array.array('Q')
+        keys.append(gtfs_seconds(text) << 32 | len(infos) // 3)
+        infos.extend(trip)
+
+    times = array.array('I')
+    sortedInfos = array.array('H')
+    stopRanges = {}
+    for stop, keys in stopKeys.items():
+        first = len(times)
+        for key in sorted(keys):
+            position = 3 * (key & 0xFFFFFFFF)
+            times.append(key >> 32)
+            sortedInfos.extend(infos[position:position + 3])
+        stopRanges[stop] = [first, len(times)]
+    del stopKeys, infos
+
+    # Stop areas (parent stations) are resolved to their stop points
+    areas, names = {}, {}
+    for row in read_gtfs(gtfs, 'stops.txt'):
+        names[row['stop_id']] = row.get('stop_name', "")
+        if row.get('parent_station'):
+            areas.setdefault(row['parent_station'], []).append(row['stop_id'])
+
+    calendar = [[0, 0, 0] for service in services]
+    for row in read_gtfs(gtfs, 'calendar.txt', optional=True):
+        if row['service_id'] in services:
+            mask = sum(1 << day for day, name in enumerate(WEEKDAYS) if row[name] == '1')
+            calendar[services[row['service_id']]] = [mask, int(row['start_date']), int(row['end_date'])]
+    exceptions = [[services[row['service_id']], int(row['date']), int(row['exception_type'])]
+                  for row in read_gtfs(gtfs, 'calendar_dates.txt', optional=True) if row['service_id'] in services]
+
+    header = json.dumps({'version': INDEX_VERSION, 'byteorder': sys.byteorder, 'count': len(times),
+                         'stops': stopRanges, 'areas': areas,
+                         'names': {stop: names.get(stop, "") for stop in stopRanges},
+                         'lines': list(lines), 'headsigns': list(headsigns),
+                         'calendar': calendar, 'exceptions': exceptions}).encode('utf-8')
+    header += b" " * (-(len(INDEX_MAGIC) + 4 + len(header)) % 4)
+
+    # Written aside then renamed, so a running Timetable never maps a partial file
+    with open(path + ".tmp", 'wb') as index:
+        index.write(INDEX_MAGIC + struct.pack('<I', len(header)) + header)
+        times.tofile(index)
+        sortedInfos.tofile(index)
+    os.replace(path + ".tmp", path)
+    logger.info("Timetable index of %d departures built in %.1f s", len(times), time.perf_counter() - start)
+    return len(times)
+
+
+def index_outdated(gtfs, path):
+    """Returns True if the index of a GTFS feed is missing or older than the feed"""
+    return not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(gtfs)
+
+
+def build_index_later(gtfs, path, on_ready):
+    """Builds the index of a GTFS feed in a background thread then calls on_ready with its Timetable, returns the thread"""
+    def build():
+        try:
+            build_index(gtfs, path)
+            on_ready(Timetable(path))
+        except Exception as e:
+            logger.error("Timetable index of %s not built : %s", gtfs, e)
+
+    thread = threading.Thread(target=build, name="Timetable import", daemon=True)
+    thread.start()
+    return thread
+
+
+class Timetable():
+    """
+    Returns a Timetable object answering the next departures of a stop from a memory-mapped index file
+
+    The departures of each stop are sorted by time in the index, so a query is a binary search followed
+    by a short scan skipping the services not running that day. Only the pages read are loaded in memory.
+
+    Attributes
+    ----------
+    path : str
+        Index file
+    times : memoryview
+        Departure time of each departure, in seconds after the start of its service day
+    infos : memoryview
+        (service, line, headsign) indexes of each departure
+    stops : dict
+        [first, last) departures range of each stop point
+    areas : dict
+        Stop points of each stop area
+    names : dict
+        Name of each stop point
+    lines : list
+        Short name of each line
+    headsigns : list
+        Destination of each headsign index
+    calendar : list
+        [days mask, first date, last date] of each service
+    exceptions : dict
+        {service: 1 added or 2 removed} of each date (YYYYMMDD int)
+    activeDays : dict
+        Running flags of the services of the last dates queried
+    dayStarts : dict
+        Start (epoch) of the service day of the last dates queried
+
+    Methods
+    -------
+    active_services(day)
+        Returns the running flag of each service on a date
+    day_start(day)
+        Returns the epoch time from which the GTFS times of a date are counted
+    ranges(stop_ids)
+        Returns the departures ranges of stop points or stop areas
+    next_departures(stop_ids, after, number, lines)
+        Returns the (dateTime, line, destination) of the next departures of stops, soonest first
+    close()
+        Unmaps the index file
+    """
+    def __init__(self, path):
+        """
+        Constructor for Timetable class
+
+        Parameters
+        ----------
+            path (str) : Index file written by build_index
+        """
+        self.path = path
+        with open(path, 'rb') as index:
+            self.map = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError("%s is not a timetable index" % path)
+        length, = struct.unpack_from('<I', self.map, len(INDEX_MAGIC))
+        offset = len(INDEX_MAGIC) + 4
+        header = json.loads(self.map[offset:offset + length])
+        if header['version'] != INDEX_VERSION or header['byteorder'] != sys.byteorder:
+            raise ValueError("%s was built by another version or machine, import it again" % path)
+
+        offset += length
+        count = header['count']
+        self.view = memoryview(self.map)
+        self.times = self.view[offset:offset + 4 * count].cast('I')
+        self.infos = self.view[offset + 4 * count:offset + 10 * count].cast('H')
+        self.stops = header['stops']
+        self.areas = header['areas']
+        self.names = header['names']
+        self.lines = header['lines']
+        self.lineIndex = {line: i for i, line in enumerate(self.lines)}
+        self.headsigns = header['headsigns']
+        self.calendar = header['calendar']
+        self.exceptions = {}
+        for service, date, kind in header['exceptions']:
+            self.exceptions.setdefault(date, {})[service] = kind
+        self.activeDays = {}
+        self.dayStarts = {}
+
+    def active_services(self, day):
+        """Returns the running flag of each service on a date"""
+        key = day.year * 10000 + day.month * 100 + day.day
+        active = self.activeDays.get(key)
+        if active is None:
+            bit = 1 << day.weekday()
+            active = bytearray(bool(mask & bit) and first <= key <= last for mask, first, last in self.calendar)
+            for service, kind in self.exceptions.get(key, {}).items():
+                active[service] = kind == 1
+            if len(self.activeDays) > 16:
+                self.activeDays.clear()
+            self.activeDays[key] = active
+        return active
+
+    def day_start(self, day):
+        """Returns the epoch time from which the GTFS times of a date are counted"""
+        start = self.dayStarts.get(day)
+        if start is None:
+            if len(self.dayStarts) > 16:
+                self.dayStarts.clear()
+            start = self.dayStarts[day] = service_day_start(day)
+        return start
+
+    def ranges(self, stop_ids):
+        """Returns the departures ranges of stop points or stop areas"""
+        return [self.stops[stop] for stopId in stop_ids for stop in self.areas.get(stopId, (stopId,))
+                if stop in self.stops]
+
+    def next_departures(self, stop_ids, after, number=3, lines=None):
+        """
+        Returns the (dateTime, line, destination) of the next departures of stops, soonest first
+
+        Parameters
+        ----------
+            stop_ids (list) : GTFS ids of the stop points or stop areas
+            after (datetime.datetime) : Time from which the departures are searched (naive is local time)
+            number (int) : Maximum number of departures returned
+            lines (list) : Short names of the lines kept (every line when None)
+        """
+        ranges = self.ranges(stop_ids)
+        wanted = None if lines is None else {self.lineIndex[line] for line in lines if line in self.lineIndex}
+        times, infos = self.times, self.infos
+        after = after.timestamp()
+        found = []
+        # The trips of the previous service day may run after midnight (times over 24:00:00)
+        day = datetime.date.fromtimestamp(after) - datetime.timedelta(days=1)
+        for i in range(SEARCH_DAYS + 2):
+            base = self.day_start(day)
+            if len(found) >= number and found[number - 1][0] <= base:
+                break
+            active = self.active_services(day)
+            threshold = max(0, math.ceil(after - base))
+            for first, last in ranges:
+                index = bisect.bisect_left(times, threshold, first, last)
+                taken = 0
+                while index < last and taken < number:
+                    service, line = infos[3 * index], infos[3 * index + 1]
+                    if active[service] and (wanted is None or line in wanted):
+                        found.append((base + times[index], line, infos[3 * index + 2]))
+                        taken += 1
+                    index += 1
+            found.sort()
+            day += datetime.timedelta(days=1)
+        return [(datetime.datetime.fromtimestamp(epoch), self.lines[line], self.headsigns[headsign])
+                for epoch, line, headsign in found[:number]]
+
+    def close(self):
+        """Unmaps the index file"""
+        self.times.release()
+        self.infos.release()
+        self.view.release()
+        self.map.close()
+
+
+# Imports a GTFS feed : Timetable.py import <gtfs dir or zip> <index>
+# Queries an index : Timetable.py <index> <stop id> [number]
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1] == "import":
+        build_index(sys.argv[2], sys.argv[3])
+    else:
+        timetable = Timetable(sys.argv[1])
+        for dateTime, line, destination in timetable.next_departures([sys.argv[2]], datetime.datetime.now(),
+                                                                     int(sys.argv[3]) if len(sys.argv) > 3 else 3):
+            print(dateTime.strftime("%Y-%m-%d %H:%M"), line, destination)
+        timetable.close()
@@ -0,0 +1,28 @@
+# Modules importation
+import os
+import logging
+
+# Logger Init
+logger = logging.getLogger()
+
+# Hardware backend, selected by the TISSEO_HARDWARE environment variable :
+#   device   : Raspberry Pi GPIO and I2C bus (default)
+#   emulator : in-process HD44780, I2C bus and GPIO models of hw_emulator
+BACKEND = os.environ.get("TISSEO_HARDWARE", "device")
+
+if BACKEND == "emulator":
+    import hw_emulator
+    GPIO = hw_emulator.GPIO
+    SMBus = hw_emulator.SMBus_Emulator
+    i2c_msg = None
+    logger.warning("Hardware emulator backend selected")
+elif BACKEND == "device":
+    import RPi.GPIO as GPIO
+    # smbus2 is preferred as it supports combined i2c_rdwr transfers
+    try:
+        from smbus2 import SMBus, i2c_msg
+    except ImportError:
+        from smbus import SMBus
+        i2c_msg = None
+else:
+    raise ImportError("Unknown hardware backend <%s> (device or emulator)" % BACKEND)
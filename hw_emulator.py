@@ -0,0 +1,396 @@
+# Modules importation
+import threading
+import time
+import logging
+
+# Logger Init
+logger = logging.getLogger()
+
+# PCF8574 pins wired to the HD44780
+PCF_RS = 0x01
+PCF_RW = 0x02
+PCF_EN = 0x04
+PCF_BACKLIGHT = 0x08
+
+# DDRAM address of the first cell of each line of a 20x4 panel
+PANEL_ROW_OFFSETS = (0x00, 0x40, 0x14, 0x54)
+
+
+class HD44780_Emulator():
+    """
+    Returns a HD44780_Emulator object modelling a HD44780 lcd driven through a PCF8574 I2C expander
+
+    The bytes written to the expander are decoded like the real chip does : a nibble is latched on each
+    falling edge of EN, in 8 bits mode until a function set selects the 4 bits mode.
+
+    Attributes
+    ----------
+    rows : int
+        Number of lines of the panel
+    cols : int
+        Number of characters per line of the panel
+    ddram : bytearray
+        Display data RAM (character codes)
+    cgram : bytearray
+        Character generator RAM (8 custom characters of 8 rows)
+    address : int
+        Address counter
+    target : str
+        RAM written by the data bytes ('ddram' or 'cgram')
+    fourBits : boolean
+        Indicates if the interface is in 4 bits mode
+    displayOn : boolean
+        Indicates if the display is on
+    backlight : boolean
+        Indicates if the backlight is on
+    counters : dict
+        Number of bytes received, commands and data bytes decoded
+
+    Methods
+    -------
+    write(byte)
+        Receives a byte written to the PCF8574
+    latch(nibble, rs)
+        Latches a nibble on a falling edge of EN
+    execute(value, rs)
+        Executes a command or writes a data byte
+    screen()
+        Returns the lines shown by the panel (custom characters as codes 0 to 7)
+    glyph(code)
+        Returns the 8 rows of a custom character
+    reset_counters()
+        Resets the activity counters
+    """
+    def __init__(self, rows=4, cols=20):
+        self.rows = rows
+        self.cols = cols
+        self.ddram = bytearray(b" " * 128)
+        self.cgram = bytearray(64)
+        self.address = 0
+        self.target = 'ddram'
+        self.fourBits = False
+        self.pending = None
+        self.displayOn = False
+        self.backlight = False
+        self.lastByte = 0
+        self.lock = threading.Lock()
+        self.counters = {'bytes': 0, 'commands': 0, 'data': 0}
+
+    def write(self, byte):
+        """Receives a byte written to the PCF8574"""
+        with self.lock:
+            self.counters['bytes'] += 1
+            self.backlight = bool(byte & PCF_BACKLIGHT)
+            # The HD44780 latches the data lines on the falling edge of EN
+            if self.lastByte & PCF_EN and not byte & PCF_EN and not self.lastByte & PCF_RW:
+                self.latch(self.lastByte >> 4, self.lastByte & PCF_RS)
+            self.lastByte = byte
+
+    def latch(self, nibble, rs):
+        """Latches a nibble on a falling edge of EN"""
+        if not self.fourBits:
+            # Only the 4 upper data lines are wired, the lower ones read as 0
+            self.execute(nibble << 4, rs)
+        elif self.pending is None:
+            self.pending = nibble
+        else:
+            value, self.pending = (self.pending << 4) | nibble, None
+            self.execute(value, rs)
+
+    def execute(self, value, rs):
+        """Executes a command or writes a data byte"""
+        if rs:
+            self.counters['data'] += 1
+            if self.target == 'ddram':
+                self.ddram[self.address & 0x7F] = value
+                self.address = (self.address + 1) & 0x7F
+            else:
+                self.cgram[self.address & 0x3F] = value & 0x1F
+                self.address = (self.address + 1) & 0x3F
+            return
+
+        self.counters['commands'] += 1
+        if value & 0x80:
+            self.target, self.address = 'ddram', value & 0x7F
+        elif value & 0x40:
+            self.target, self.address = 'cgram', value & 0x3F
+        elif value & 0x20:
+            # Function set : DL selects the 8 or 4 bits interface
+            fourBits = not value & 0x10
+            if fourBits != self.fourBits:
+                self.fourBits, self.pending = fourBits, None
+        elif value & 0x08:
+            self.displayOn = bool(value & 0x04)
+        elif value & 0x02:
+            self.target, self.address = 'ddram', 0
+        elif value & 0x01:
+            self.ddram[:] = b" " * 128
+            self.target, self.address = 'ddram', 0
+
+    def screen(self):
+        """Returns the lines shown by the panel (custom characters as codes 0 to 7)"""
+        with self.lock:
+            return ["".join(chr(code) for code in self.ddram[offset:offset + self.cols])
+                    for offset in PANEL_ROW_OFFSETS[:self.rows]]
+
+    def glyph(self, code):
+        """Returns the 8 rows of a custom character"""
+        with self.lock:
+            return tuple(self.cgram[(code & 0x07) * 8:(code & 0x07) * 8 + 8])
+
+    def reset_counters(self):
+        """Resets the activity counters"""
+        with self.lock:
+            self.counters = dict.fromkeys(self.counters, 0)
+
+
+class SMBus_Emulator():
+    """
+    Returns a SMBus_Emulator object, a SMBus compatible bus forwarding the written bytes to emulated devices
+
+    Attributes
+    ----------
+    port : int
+        Number of the I2C bus
+    devices : dict
+        Emulated device of each address
+    transactions : int
+        Number of bus transactions
+    bytes_written : int
+        Number of bytes written on the bus
+
+    Methods
+    -------
+    device(addr)
+        Returns the emulated device of an address, an OSError is raised if nothing answers
+    send(addr, data)
+        Writes bytes to a device in a single transaction
+    write_byte, write_bytes, write_byte_data, write_i2c_block_data, write_block_data, read_byte,
+    read_byte_data, read_block_data, close
+        Same as smbus.SMBus
+    """
+    def __init__(self, port=1, devices=None):
+        self.port = port
+        self.devices = devices if devices is not None else DEVICES
+        self.transactions = 0
+        self.bytes_written = 0
+
+    def device(self, addr):
+        """Returns the emulated device of an address, an OSError is raised if nothing answers"""
+        if addr not in self.devices:
+            raise OSError(121, "Remote I/O error")
+        return self.devices[addr]
+
+    def send(self, addr, data):
+        """Writes bytes to a device in a single transaction"""
+        device = self.device(addr)
+        self.transactions += 1
+        self.bytes_written += len(data)
+        for byte in data:
+            device.write(byte)
+
+    def write_byte(self, addr, val):
+        self.send(addr, (val,))
+
+    def write_bytes(self, addr, data):
+        self.send(addr, data)
+
+    def write_byte_data(self, addr, cmd, val):
+        self.send(addr, (cmd, val))
+
+    def write_i2c_block_data(self, addr, cmd, data):
+        self.send(addr, [cmd] + list(data))
+
+    def write_block_data(self, addr, cmd, data):
+        self.send(addr, [cmd, len(data)] + list(data))
+
+    def read_byte(self, addr):
+        self.device(addr)
+        return 0
+
+    def read_byte_data(self, addr, cmd):
+        self.device(addr)
+        return 0
+
+    def read_block_data(self, addr, cmd):
+        self.device(addr)
+        return []
+
+    def close(self):
+        pass
+
+
+class PWM_Emulator():
+    """Returns a PWM_Emulator object recording the frequency and duty cycle of a RPi.GPIO.PWM output"""
+    def __init__(self, gpio, channel, frequency):
+        self.gpio = gpio
+        self.channel = channel
+        self.frequency = frequency
+        self.dutyCycle = 0
+        self.running = False
+        self.changes = 0
+
+    def start(self, dutyCycle):
+        self.running = True
+        self.ChangeDutyCycle(dutyCycle)
+
+    def stop(self):
+        self.running = False
+        self.changes += 1
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+        self.changes += 1
+
+    def ChangeDutyCycle(self, dutyCycle):
+        self.dutyCycle = dutyCycle
+        self.changes += 1
+
+
+class GPIO_Emulator():
+    """
+    Returns a GPIO_Emulator object that replaces the RPi.GPIO module, button edges can be injected
+
+    The edge callbacks are called from the thread injecting the edge, like RPi.GPIO calls them from its
+    own thread.
+
+    Attributes
+    ----------
+    levels : dict
+        Level of each pin
+    directions : dict
+        Direction (IN or OUT) of each set up pin
+    callbacks : dict
+        (edge, callback, bouncetime in ms) of each pin with an event detection
+    lastEdge : dict
+        Time (time.monotonic) of the last callback of each pin, for the bouncetime
+    pwms : dict
+        PWM_Emulator of each pin
+    counters : dict
+        Number of outputs, injected edges and callbacks
+
+    Methods
+    -------
+    press(pin, duration)
+        Injects a button press : a rising edge, then a falling edge after duration seconds
+    set_level(pin, level)
+        Sets the level of an input pin and calls its edge callbacks
+    reset_counters()
+        Resets the activity counters
+    """
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self.mode = None
+        self.levels = {}
+        self.directions = {}
+        self.callbacks = {}
+        self.lastEdge = {}
+        self.pwms = {}
+        self.lock = threading.Lock()
+        self.counters = {'outputs': 0, 'edges': 0, 'callbacks': 0}
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def getmode(self):
+        return self.mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, channel, direction, pull_up_down=None, initial=None):
+        for pin in channel if isinstance(channel, (list, tuple)) else (channel,):
+            self.directions[pin] = direction
+            self.levels.setdefault(pin, initial if initial is not None else
+                                   (self.HIGH if pull_up_down == self.PUD_UP else self.LOW))
+
+    def input(self, channel):
+        return self.levels.get(channel, self.LOW)
+
+    def output(self, channel, state):
+        for pin in channel if isinstance(channel, (list, tuple)) else (channel,):
+            self.levels[pin] = int(bool(state))
+            self.counters['outputs'] += 1
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        if channel in self.callbacks:
+            raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+        self.callbacks[channel] = [edge, [callback] if callback else [], bouncetime or 0]
+
+    def add_event_callback(self, channel, callback):
+        self.callbacks[channel][1].append(callback)
+
+    def remove_event_detect(self, channel):
+        self.callbacks.pop(channel, None)
+
+    def cleanup(self, channel=None):
+        for pin in (channel if isinstance(channel, (list, tuple)) else (channel,)) if channel else list(self.levels):
+            self.callbacks.pop(pin, None)
+            self.directions.pop(pin, None)
+
+    def PWM(self, channel, frequency):
+        self.pwms[channel] = PWM_Emulator(self, channel, frequency)
+        return self.pwms[channel]
+
+    def set_level(self, pin, level):
+        """Sets the level of an input pin and calls its edge callbacks"""
+        with self.lock:
+            previous = self.levels.get(pin, self.LOW)
+            self.levels[pin] = level
+            if previous == level:
+                return
+            self.counters['edges'] += 1
+            detection = self.callbacks.get(pin)
+            if detection is None:
+                return
+            edge, callbacks, bouncetime = detection
+            if edge != self.BOTH and edge != (self.RISING if level else self.FALLING):
+                return
+            now = time.monotonic()
+            if now - self.lastEdge.get(pin, -bouncetime) < bouncetime / 1000:
+                return
+            self.lastEdge[pin] = now
+        for callback in callbacks:
+            self.counters['callbacks'] += 1
+            callback(pin)
+
+    def press(self, pin, duration=0.0):
+        """Injects a button press : a rising edge, then a falling edge after duration seconds"""
+        self.set_level(pin, self.HIGH)
+        if duration:
+            time.sleep(duration)
+        self.set_level(pin, self.LOW)
+
+    def reset_counters(self):
+        """Resets the activity counters"""
+        self.counters = dict.fromkeys(self.counters, 0)
+        for pwm in self.pwms.values():
+            pwm.changes = 0
+
+
+# Emulated board : the lcd panel at its I2C address and the GPIO pins
+LCD_PANEL = HD44780_Emulator()
+DEVICES = {0x27: LCD_PANEL}
+GPIO = GPIO_Emulator()
+
+
+# Test code which draws a frame through lcddriver and prints the emulated panel
+if __name__ == "__main__":
+    import lcddriver
+    screen = lcddriver.lcd(bus=SMBus_Emulator())
+    screen.lcd_display_frame(["*------------------*", "|  Tisseo Display  |",
+                              "|     Emulator     |", "*------------------*"])
+    print("\n".join(LCD_PANEL.screen()))
+    print(LCD_PANEL.counters)
@@ -4,27 +4,82 @@
 
 import sys
 sys.path.append("./lib")
-import smbus
+# the I2C bus (real or emulated) is given by the hardware abstraction layer
+from hal import SMBus, i2c_msg
+from Metrics import REGISTRY
 from time import *
 
+# Largest transfer accepted by write_i2c_block_data (command byte + 32 data bytes)
+SMBUS_BLOCK_MAX = 33
+
 class i2c_device:
-   def __init__(self, addr, port=1):
+   # bus : any SMBus compatible object, a new hal.SMBus(port) is opened when None
+   def __init__(self, addr, port=1, bus=None):
       self.addr = addr
-      self.bus = smbus.SMBus(port)
+      self.bus = bus if bus is not None else SMBus(port)
+      # Bus activity counters (one transaction per SMBus call)
+      self.transactions = 0
+      self.bytes_written = 0
+      # Shared metrics of the stream writes
+      self.writeTime = REGISTRY.histogram("i2c_write_seconds", "Time of an I2C stream write", addr=hex(addr))
+      self.writeBytes = REGISTRY.counter("i2c_written_bytes_total", "Bytes of the I2C stream writes", addr=hex(addr))
+      self.writeTransactions = REGISTRY.counter("i2c_transactions_total", "Transactions of the I2C stream writes",
+                                                addr=hex(addr))
+
+# Reset the bus activity counters
+   def reset_counters(self):
+      self.transactions = 0
+      self.bytes_written = 0
 
 # Write a single command
    def write_cmd(self, cmd):
       self.bus.write_byte(self.addr, cmd)
+      self.transactions += 1
+      self.bytes_written += 1
+      sleep(0.0001)
+
+# Write a stream of bytes in as few bus transfers as the backend allows
+   def write_stream(self, data):
+      data = bytes(data)
+      if not data:
+         return
+      start = perf_counter()
+      transactions = self.transactions
+      if hasattr(self.bus, "write_bytes"):
+         self.bus.write_bytes(self.addr, data)
+         self.transactions += 1
+      elif i2c_msg is not None and hasattr(self.bus, "i2c_rdwr"):
+         self.bus.i2c_rdwr(i2c_msg.write(self.addr, data))
+         self.transactions += 1
+      elif hasattr(self.bus, "write_i2c_block_data"):
+         # The PCF8574 has no register, the "command" byte is latched like any other byte
+         for i in range(0, len(data), SMBUS_BLOCK_MAX):
+            chunk = data[i:i + SMBUS_BLOCK_MAX]
+            self.bus.write_i2c_block_data(self.addr, chunk[0], list(chunk[1:]))
+            self.transactions += 1
+      else:
+         # Per-byte fallback
+         for byte in data:
+            self.bus.write_byte(self.addr, byte)
+            self.transactions += 1
+      self.bytes_written += len(data)
+      self.writeTime.observe(perf_counter() - start)
+      self.writeBytes.inc(len(data))
+      self.writeTransactions.inc(self.transactions - transactions)
       sleep(0.0001)
 
 # Write a command and argument
    def write_cmd_arg(self, cmd, data):
       self.bus.write_byte_data(self.addr, cmd, data)
+      self.transactions += 1
+      self.bytes_written += 2
       sleep(0.0001)
 
 # Write a block of data
    def write_block_data(self, cmd, data):
       self.bus.write_block_data(self.addr, cmd, data)
+      self.transactions += 1
+      self.bytes_written += 2 + len(data)
       sleep(0.0001)
 
 # Read a single byte
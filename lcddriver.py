@@ -6,11 +6,19 @@ import sys
 sys.path.append("./lib")
 
 import i2c_lib
+import collections
 from time import *
 
 # LCD Address
 ADDRESS = 0x27
 
+# LCD geometry
+LCD_ROWS = 4
+LCD_COLS = 20
+
+# DDRAM address of the first cell of each line
+LCD_ROW_OFFSETS = (0x00, 0x40, 0x14, 0x54)
+
 # commands
 LCD_CLEARDISPLAY = 0x01
 LCD_RETURNHOME = 0x02
@@ -57,11 +65,39 @@ En = 0b00000100 # Enable bit
 Rw = 0b00000010 # Read/Write bit
 Rs = 0b00000001 # Register select bit
 
+# Execution time of the clear display and return home commands
+LCD_SLOW_CMD_DELAY = 0.002
+
+# Number of custom characters of the CGRAM
+LCD_CGRAM_SLOTS = 8
+
+# custom 5x8 glyphs : name -> (ascii fallback, one 5 bits row per pixel line)
+GLYPHS = {
+   'sun': ('*', (0b00100, 0b10101, 0b01110, 0b11111, 0b01110, 0b10101, 0b00100, 0b00000)),
+   'cloud': ('c', (0b00000, 0b00110, 0b01001, 0b10001, 0b10001, 0b01110, 0b00000, 0b00000)),
+   'rain': (',', (0b01110, 0b10001, 0b01110, 0b00000, 0b01010, 0b00000, 0b10101, 0b00000)),
+   'drop': ('H', (0b00100, 0b00100, 0b01010, 0b01010, 0b10001, 0b10001, 0b01110, 0b00000)),
+   'thermometer': ('T', (0b00100, 0b01010, 0b01010, 0b01010, 0b01110, 0b11111, 0b11111, 0b01110)),
+   # arrows pointing to N, NE, E, SE, S, SW, W and NW
+   'arrow_0': ('^', (0b00100, 0b01110, 0b10101, 0b00100, 0b00100, 0b00100, 0b00100, 0b00000)),
+   'arrow_1': ('/', (0b00000, 0b01111, 0b00011, 0b00101, 0b01001, 0b10000, 0b00000, 0b00000)),
+   'arrow_2': ('>', (0b00000, 0b00100, 0b00010, 0b11111, 0b00010, 0b00100, 0b00000, 0b00000)),
+   'arrow_3': ('\\', (0b00000, 0b10000, 0b01001, 0b00101, 0b00011, 0b01111, 0b00000, 0b00000)),
+   'arrow_4': ('v', (0b00100, 0b00100, 0b00100, 0b00100, 0b10101, 0b01110, 0b00100, 0b00000)),
+   'arrow_5': ('/', (0b00000, 0b00001, 0b10010, 0b10100, 0b11000, 0b11110, 0b00000, 0b00000)),
+   'arrow_6': ('<', (0b00000, 0b00100, 0b01000, 0b11111, 0b01000, 0b00100, 0b00000, 0b00000)),
+   'arrow_7': ('\\', (0b00000, 0b11110, 0b11000, 0b10100, 0b10010, 0b00001, 0b00000, 0b00000)),
+}
+
 class lcd:
    #initializes objects and lcd
-   def __init__(self):
-      self.lcd_device = i2c_lib.i2c_device(ADDRESS)
+   # batched : sends whole commands and strings in one bus transfer instead of byte per byte
+   # bus : SMBus compatible backend given to i2c_device (the real I2C bus when None)
+   def __init__(self, batched=True, bus=None):
+      self.lcd_device = i2c_lib.i2c_device(ADDRESS, bus=bus)
       self.lcdBacklight_state = LCD_BACKLIGHT
+      # the power-on sequence always goes through the slow per-byte path
+      self.batched = False
 
       self.lcd_write(0x03)
       self.lcd_write(0x03)
@@ -74,6 +110,15 @@ class lcd:
       self.lcd_write(LCD_ENTRYMODESET | LCD_ENTRYLEFT)
       sleep(0.2)
 
+      # Shadow copy of what is currently shown on the panel
+      self.framebuffer = [[" "] * LCD_COLS for _ in range(LCD_ROWS)]
+      self.batched = batched
+
+      # glyphs resident in the CGRAM : name -> [slot, frame of last use], least recently used first
+      self.cgram = collections.OrderedDict()
+      self.frames = 0
+      self.glyphStats = {'hits': 0, 'uploads': 0, 'evictions': 0, 'fallbacks': 0}
+
    # clocks EN to latch command
    def lcd_strobe(self, data):
       self.lcd_device.write_cmd(data | En | self.lcdBacklight_state)
@@ -85,11 +130,37 @@ class lcd:
       self.lcd_device.write_cmd(data | self.lcdBacklight_state)
       self.lcd_strobe(data)
 
+   # bytes clocking one nibble in : data, EN high, EN low
+   def lcd_nibble_bytes(self, data):
+      data |= self.lcdBacklight_state
+      return (data, data | En, data & ~En)
+
+   # bytes sending a whole command (or character when mode is Rs) to the lcd
+   def lcd_command_bytes(self, cmd, mode=0):
+      return (self.lcd_nibble_bytes(mode | (cmd & 0xF0)) +
+              self.lcd_nibble_bytes(mode | ((cmd << 4) & 0xF0)))
+
    # write a command to lcd
    def lcd_write(self, cmd, mode=0):
-      self.lcd_write_four_bits(mode | (cmd & 0xF0))
-      self.lcd_write_four_bits(mode | ((cmd << 4) & 0xF0))
-      
+      if self.batched:
+         self.lcd_device.write_stream(self.lcd_command_bytes(cmd, mode))
+         if mode == 0 and cmd in (LCD_CLEARDISPLAY, LCD_RETURNHOME):
+            sleep(LCD_SLOW_CMD_DELAY)
+      else:
+         self.lcd_write_four_bits(mode | (cmd & 0xF0))
+         self.lcd_write_four_bits(mode | ((cmd << 4) & 0xF0))
+
+   # write a list of (cmd, mode) to lcd, in a single bus transfer when batched
+   def lcd_write_commands(self, commands):
+      if self.batched:
+         stream = bytearray()
+         for cmd, mode in commands:
+            stream.extend(self.lcd_command_bytes(cmd, mode))
+         self.lcd_device.write_stream(stream)
+      else:
+         for cmd, mode in commands:
+            self.lcd_write(cmd, mode)
+
    #turn on/off the lcd backlight
    def lcd_backlight(self, state):
       if state in ("on","On","ON"):
@@ -101,21 +172,92 @@ class lcd:
       else:
          print ("Unknown State!")
 
-   # put string function
+   # returns the commands updating the cells of a line that differ from the framebuffer
+   def lcd_diff_line(self, string, line):
+      row = self.framebuffer[line - 1]
+      commands = []
+      cursor = None
+
+      for col, char in enumerate(string[:LCD_COLS]):
+         if row[col] == char:
+            continue
+         # jump to the start of a new run of changed cells
+         if cursor != col:
+            commands.append((LCD_SETDDRAMADDR | (LCD_ROW_OFFSETS[line - 1] + col), 0))
+         commands.append((ord(char), Rs))
+         row[col] = char
+         cursor = col + 1
+      return commands
+
+   # put string function, only the cells that differ from the framebuffer are sent
    def lcd_display_string(self, string, line):
-      if line == 1:
-         self.lcd_write(0x80)
-      if line == 2:
-         self.lcd_write(0xC0)
-      if line == 3:
-         self.lcd_write(0x94)
-      if line == 4:
-         self.lcd_write(0xD4)
-
-      for char in string:
-         self.lcd_write(ord(char), Rs)
+      self.lcd_write_commands(self.lcd_diff_line(string, line))
+
+   # put a whole frame (one string per line) function
+   def lcd_display_frame(self, rows):
+      commands = []
+      for line, string in enumerate(rows, 1):
+         commands.extend(self.lcd_diff_line(string, line))
+      self.lcd_write_commands(commands)
+
+   # starts a new frame : the glyphs looked up until the next call are kept resident together
+   def lcd_new_frame(self):
+      self.frames += 1
+
+   # returns the character showing a glyph of GLYPHS, the glyph is only uploaded when not resident
+   # the least recently used slot is evicted, unless all slots are used by the frame being built
+   # (the ascii fallback of the glyph is returned then)
+   def lcd_glyph(self, name):
+      fallback, bitmap = GLYPHS[name]
+      entry = self.cgram.get(name)
+      if entry is not None:
+         entry[1] = self.frames
+         self.cgram.move_to_end(name)
+         self.glyphStats['hits'] += 1
+         return chr(entry[0])
+
+      if len(self.cgram) < LCD_CGRAM_SLOTS:
+         slot = min(set(range(LCD_CGRAM_SLOTS)) - set(entry[0] for entry in self.cgram.values()))
+      else:
+         victim, (slot, frame) = next(iter(self.cgram.items()))
+         if frame == self.frames:
+            self.glyphStats['fallbacks'] += 1
+            return fallback
+         del self.cgram[victim]
+         self.glyphStats['evictions'] += 1
+         # the panel shows the new glyph in the cells of the evicted one, they must be redrawn
+         code = chr(slot)
+         for row in self.framebuffer:
+            for col, char in enumerate(row):
+               if char == code:
+                  row[col] = None
+
+      self.lcd_load_glyph(slot, bitmap)
+      self.cgram[name] = [slot, self.frames]
+      self.glyphStats['uploads'] += 1
+      return chr(slot)
+
+   # upload a 5x8 bitmap in a CGRAM slot, the next write sets its DDRAM address again
+   def lcd_load_glyph(self, slot, bitmap):
+      commands = [(LCD_SETCGRAMADDR | (slot << 3), 0)]
+      commands.extend((row & 0x1F, Rs) for row in bitmap)
+      self.lcd_write_commands(commands)
+
+   # forget the framebuffer content so that the next frame is fully redrawn
+   # (and the CGRAM content, the panel may have been reset)
+   def lcd_invalidate(self):
+      self.framebuffer = [[None] * LCD_COLS for _ in range(LCD_ROWS)]
+      self.cgram.clear()
+
+   # returns the number of I2C transactions and bytes sent since the last reset
+   def lcd_bus_stats(self, reset=False):
+      stats = (self.lcd_device.transactions, self.lcd_device.bytes_written)
+      if reset:
+         self.lcd_device.reset_counters()
+      return stats
 
    # clear lcd and set to home
    def lcd_clear(self):
       self.lcd_write(LCD_CLEARDISPLAY)
       self.lcd_write(LCD_RETURNHOME)
+      self.framebuffer = [[" "] * LCD_COLS for _ in range(LCD_ROWS)]